@@ -0,0 +1 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
@@ -0,0 +1,51 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import time
+from mangrove.datastore.instrumentation import _percentile
+
+
+class RoundTripCounter(object):
+    """A database observer that counts the calls made and the bytes moved while it is registered."""
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def __call__(self, event):
+        self.calls += 1
+        self.bytes += event.size or 0
+
+
+def measure(dbm, operation, iterations, warmup=1):
+    """
+    Calls operation(i) iterations times after warmup untimed calls and returns a dict with
+    operations, ops_per_second, the mean, p50, p95, p99 and max latencies in milliseconds,
+    and the database round_trips_per_operation and bytes_per_operation.
+    """
+    assert iterations > 0
+    for i in range(warmup):
+        operation(i)
+    counter = RoundTripCounter()
+    latencies = []
+    dbm.add_observer(counter)
+    try:
+        for i in range(iterations):
+            started = time.time()
+            operation(warmup + i)
+            latencies.append(time.time() - started)
+    finally:
+        dbm.remove_observer(counter)
+    total = sum(latencies)
+    latencies.sort()
+    return dict(operations=iterations,
+                ops_per_second=iterations / total if total else None,
+                mean_ms=_milliseconds(total / iterations),
+                p50_ms=_milliseconds(_percentile(latencies, 50)),
+                p95_ms=_milliseconds(_percentile(latencies, 95)),
+                p99_ms=_milliseconds(_percentile(latencies, 99)),
+                max_ms=_milliseconds(latencies[-1]),
+                round_trips_per_operation=float(counter.calls) / iterations,
+                bytes_per_operation=float(counter.bytes) / iterations)
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 3)
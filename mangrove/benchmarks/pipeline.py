@@ -0,0 +1,205 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Benchmarks for the submission pipeline and the aggregation queries.
+
+    python -m mangrove.benchmarks.pipeline --entities 100 --records 20 --reporters 10 --output results.json
+
+Runs against the in-memory database unless --server names a CouchDB server, and prints (or writes)
+one JSON document with the configuration and, per benchmark, ops/s, latency percentiles and the
+database round trips per operation, so that runs can be compared to catch regressions.
+"""
+import argparse
+import datetime
+import json
+import sys
+import xlwt
+from StringIO import StringIO
+from pytz import UTC
+from mangrove.benchmarks.harness import measure
+from mangrove.bootstrap import initializer
+from mangrove.datastore import data
+from mangrove.datastore.aggregrate import aggregate_by_form_code_python, Sum as PythonSum, Latest as PythonLatest,\
+    Average as PythonAverage
+from mangrove.datastore.data import EntityAggregration
+from mangrove.datastore.database import get_db_manager, _delete_db_and_remove_db_manager
+from mangrove.datastore.datadict import DataDictType
+from mangrove.datastore.entity import create_entity
+from mangrove.datastore.entity_type import define_type
+from mangrove.datastore.memory_database import MEMORY_URL_SCHEME
+from mangrove.datastore.time_period_aggregation import aggregate_for_time_period, Month, Sum, Latest
+from mangrove.form_model.field import TextField, IntegerField
+from mangrove.form_model.form_model import FormModel, MOBILE_NUMBER_FIELD, NAME_FIELD
+from mangrove.transport.facade import TransportInfo, Request
+from mangrove.transport.player.parser import CsvParser, XlsParser
+from mangrove.transport.player.player import SMSPlayer, WebPlayer, XFormPlayer, FilePlayer
+from mangrove.transport.reporter import REPORTER_ENTITY_TYPE
+
+DATABASE_NAME = "mangrove-benchmark"
+ENTITY_TYPE = ["clinic"]
+FORM_CODE = "cli"
+FIELDS = ["beds", "patients"]
+SEED_MONTH = (1, 2011)
+
+
+class PipelineBenchmark(object):
+    """
+    Seeds a database with entities entities of type clinic, records data records per entity and
+    reporters reporters, then measures the players and the aggregation queries against it.
+    """
+
+    def __init__(self, server=MEMORY_URL_SCHEME, database=DATABASE_NAME, entities=100, records=10,
+                 reporters=10, import_rows=100):
+        assert entities > 0 and reporters > 0
+        self.config = dict(server=server, database=database, entities=entities, records=records,
+                           reporters=reporters, import_rows=import_rows)
+        self.dbm = get_db_manager(server, database)
+        _delete_db_and_remove_db_manager(self.dbm)
+        self.dbm = get_db_manager(server, database)
+
+    def setup(self):
+        initializer.run(self.dbm)
+        define_type(self.dbm, ENTITY_TYPE)
+        self.ddtypes = dict((field, DataDictType(self.dbm, name=field, slug=field, primitive_type='integer'))
+                            for field in FIELDS)
+        entity_id_type = DataDictType(self.dbm, name='Entity Id', slug='entity_id', primitive_type='string')
+        for ddtype in self.ddtypes.values() + [entity_id_type]:
+            ddtype.save()
+        fields = [TextField(name="clinic", code="EID", label="Clinic", entity_question_flag=True,
+                            ddtype=entity_id_type)]
+        fields += [IntegerField(name=field, code=field.upper(), label=field, ddtype=self.ddtypes[field])
+                   for field in FIELDS]
+        FormModel(self.dbm, entity_type=ENTITY_TYPE, name="clinic report", label="Clinic report",
+                  form_code=FORM_CODE, type='survey', fields=fields).save()
+        self._create_clinics()
+        self._create_reporters()
+
+    def _create_clinics(self):
+        month, year = SEED_MONTH
+        self.short_codes = []
+        for i in range(self.config['entities']):
+            clinic = create_entity(self.dbm, entity_type=ENTITY_TYPE, short_code="cli%d" % i,
+                                   location=["India", "MH", "Pune"])
+            for record in range(self.config['records']):
+                event_time = datetime.datetime(year, month, 1 + record % 28, tzinfo=UTC)
+                clinic.add_data(data=[(field, record + i, self.ddtypes[field]) for field in FIELDS],
+                                event_time=event_time, submission=dict(form_code=FORM_CODE))
+            self.short_codes.append(clinic.short_code)
+
+    def _create_reporters(self):
+        phone_type = DataDictType(self.dbm, name='Phone', slug='phone', primitive_type='string')
+        name_type = DataDictType(self.dbm, name='Reporter name', slug='reporter_name', primitive_type='string')
+        self.mobile_numbers = []
+        for i in range(self.config['reporters']):
+            reporter = create_entity(self.dbm, entity_type=REPORTER_ENTITY_TYPE, short_code="rep%d" % i,
+                                     location=["India", "MH", "Pune"])
+            mobile_number = "99%08d" % i
+            reporter.add_data(data=[(MOBILE_NUMBER_FIELD, mobile_number, phone_type),
+                                    (NAME_FIELD, "reporter %d" % i, name_type)])
+            self.mobile_numbers.append(mobile_number)
+
+    def _short_code(self, i):
+        return self.short_codes[i % len(self.short_codes)]
+
+    def _transport(self, channel, i):
+        return TransportInfo(transport=channel, source=self.mobile_numbers[i % len(self.mobile_numbers)],
+                             destination="5678")
+
+    def _sms(self, i):
+        message = "%s .EID %s .BEDS %d .PATIENTS %d" % (FORM_CODE, self._short_code(i), i % 50, i % 20)
+        SMSPlayer(self.dbm).accept(Request(message=message, transportInfo=self._transport("sms", i)))
+
+    def _web(self, i):
+        message = {'form_code': FORM_CODE, 'EID': self._short_code(i), 'BEDS': str(i % 50),
+                   'PATIENTS': str(i % 20)}
+        WebPlayer(self.dbm).accept(Request(message=message, transportInfo=self._transport("web", i)))
+
+    def _xform(self, i):
+        message = "<data><form_code>%s</form_code><EID>%s</EID><BEDS>%d</BEDS><PATIENTS>%d</PATIENTS></data>" % (
+            FORM_CODE, str(self._short_code(i)), i % 50, i % 20)
+        XFormPlayer(self.dbm).accept(Request(message=message, transportInfo=self._transport("smartPhone", i)))
+
+    def _import_rows(self, i):
+        return [[FORM_CODE, self._short_code(i + row), str(row % 50), str(row % 20)]
+                for row in range(self.config['import_rows'])]
+
+    def _csv_file(self, i):
+        lines = ["form_code,EID,BEDS,PATIENTS"] + [",".join(row) for row in self._import_rows(i)]
+        return "\n".join(lines)
+
+    def _xls_file(self, i):
+        workbook = xlwt.Workbook()
+        sheet = workbook.add_sheet("data")
+        for row_number, row in enumerate([["form_code", "EID", "BEDS", "PATIENTS"]] + self._import_rows(i)):
+            for column, value in enumerate(row):
+                sheet.write(row_number, column, value)
+        contents = StringIO()
+        workbook.save(contents)
+        return contents.getvalue()
+
+    def _benchmarks(self):
+        month, year = SEED_MONTH
+        csv_files, xls_files = {}, {}
+        return [
+            ("sms_player_accept", self._sms),
+            ("web_player_accept", self._web),
+            ("xform_player_accept", self._xform),
+            ("csv_import", lambda i: FilePlayer(self.dbm, CsvParser(), "csv").accept(
+                csv_files.setdefault(i, self._csv_file(i)))),
+            ("xls_import", lambda i: FilePlayer(self.dbm, XlsParser(), "xls").accept(
+                xls_files.setdefault(i, self._xls_file(i)))),
+            ("data_aggregate", lambda i: data.aggregate(self.dbm, entity_type=ENTITY_TYPE,
+                aggregates={"*": data.reduce_functions.LATEST}, aggregate_on=EntityAggregration())),
+            ("aggregate_by_form_code_python", lambda i: aggregate_by_form_code_python(self.dbm, FORM_CODE,
+                aggregates=[PythonSum("beds"), PythonLatest("patients")], aggregate_on=EntityAggregration())),
+            ("aggregate_by_form_code_python_approximate", lambda i: aggregate_by_form_code_python(self.dbm,
+                FORM_CODE, aggregates=[PythonSum("beds"), PythonAverage("patients")],
+                aggregate_on=EntityAggregration(), approximate=True)),
+            ("aggregate_for_time_period", lambda i: aggregate_for_time_period(self.dbm, FORM_CODE,
+                period=Month(month, year), aggregates=[Sum("beds"), Latest("patients")])),
+        ]
+
+    def run(self, iterations=20, only=None):
+        """
+        Returns the configuration and the measurements of each benchmark, or only of those named in only.
+        """
+        results = {}
+        for name, operation in self._benchmarks():
+            if only is None or name in only:
+                results[name] = measure(self.dbm, operation, iterations)
+        return dict(config=dict(self.config, iterations=iterations), results=results)
+
+    def teardown(self):
+        _delete_db_and_remove_db_manager(self.dbm)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the mangrove submission pipeline.")
+    parser.add_argument("--server", default=MEMORY_URL_SCHEME,
+                        help="CouchDB server url, or memory:// for the in-memory database")
+    parser.add_argument("--database", default=DATABASE_NAME)
+    parser.add_argument("--entities", type=int, default=100)
+    parser.add_argument("--records", type=int, default=10, help="data records per entity")
+    parser.add_argument("--reporters", type=int, default=10)
+    parser.add_argument("--import-rows", type=int, default=100, help="rows per imported CSV or XLS file")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--only", action="append", help="run only the named benchmark, may be repeated")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    options = parser.parse_args(argv)
+
+    benchmark = PipelineBenchmark(options.server, options.database, options.entities, options.records,
+                                  options.reporters, options.import_rows)
+    try:
+        benchmark.setup()
+        results = benchmark.run(options.iterations, options.only)
+    finally:
+        benchmark.teardown()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as results_file:
+            results_file.write(output)
+    else:
+        print output
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
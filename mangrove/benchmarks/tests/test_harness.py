@@ -0,0 +1,43 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from mock import Mock
+from mangrove.benchmarks.harness import measure
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.instrumentation import QueryEvent, Operations
+
+
+class TestMeasure(unittest.TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.observers = []
+        self.dbm.add_observer.side_effect = self.observers.append
+        self.dbm.remove_observer.side_effect = self.observers.remove
+
+    def _query_twice(self, i):
+        for observer in self.observers:
+            observer(QueryEvent(Operations.VIEW, "by_values", {}, 1, 100, 0.001))
+            observer(QueryEvent(Operations.GET, "some id", {}, 1, 50, 0.001))
+
+    def test_should_report_round_trips_and_bytes_per_operation(self):
+        result = measure(self.dbm, self._query_twice, iterations=4)
+
+        self.assertEqual(4, result['operations'])
+        self.assertEqual(2.0, result['round_trips_per_operation'])
+        self.assertEqual(150.0, result['bytes_per_operation'])
+        self.assertEqual([], self.observers)
+
+    def test_should_not_count_warmup_calls(self):
+        calls = []
+
+        result = measure(self.dbm, calls.append, iterations=3, warmup=2)
+
+        self.assertEqual([0, 1, 2, 3, 4], calls)
+        self.assertEqual(3, result['operations'])
+        self.assertEqual(0.0, result['round_trips_per_operation'])
+
+    def test_should_remove_observer_when_operation_fails(self):
+        def fail(i):
+            raise ValueError()
+
+        self.assertRaises(ValueError, measure, self.dbm, fail, 1, 0)
+        self.assertEqual([], self.observers)
@@ -0,0 +1,21 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from mangrove.benchmarks.pipeline import PipelineBenchmark
+from mangrove.datastore.memory_database import MEMORY_URL_SCHEME
+
+
+class TestPipelineBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.benchmark = PipelineBenchmark(MEMORY_URL_SCHEME, "mangrove-benchmark-test", entities=2, records=2,
+                                           reporters=1, import_rows=2)
+        self.benchmark.setup()
+
+    def tearDown(self):
+        self.benchmark.teardown()
+
+    def test_should_run_every_benchmark(self):
+        results = self.benchmark.run(iterations=1)['results']
+
+        self.assertEqual(sorted(name for name, operation in self.benchmark._benchmarks()), sorted(results.keys()))
+        for name, result in results.items():
+            self.assertEqual(1, result['operations'], name)
@@ -0,0 +1,17 @@
+function(doc) {
+    if (!doc.void && doc.document_type == "DataRecord"
+)
+    {
+        var bucket = 0;
+        for (var i = 0; i < doc._id.length; i++) {
+            bucket = (bucket * 31 + doc._id.charCodeAt(i)) % 1024;
+        }
+        var date = Date.parse(doc.event_time);
+        var entity_id = doc.entity._id;
+        var form_code = doc.submission.form_code;
+        for (k in doc.data) {
+            key = [form_code,bucket,date,entity_id,k];
+            emit(key, doc.data[k].value);
+        }
+    }
+}
@@ -0,0 +1,14 @@
+function(doc) {
+    if (!doc.void && doc.document_type == "DataRecord"
+)
+    {
+        var date = Date.parse(doc.event_time);
+        var entity_id = doc.entity._id;
+        for (k in doc.data) {
+            value = {};
+            value["timestamp"] = date;
+            value["value"] = doc.data[k].value;
+            emit([entity_id,k], value);
+        }
+    }
+}
@@ -0,0 +1,5 @@
+function(doc) {
+    if (doc.document_type == "Entity" && doc.aggregation_paths._type[0] == 'reporter' && !doc.void && doc.data.mobile_number) {
+        emit(doc.data.mobile_number.value, null);
+    }
+}
@@ -0,0 +1,20 @@
+function(key, values, rereduce) {
+    result = {latest: null, timestamp: null, sum: 0, count: 0, min: null, max: null};
+    for (i in values) {
+        x = values[i];
+        if (rereduce == false) {
+            number = typeof(x.value) == 'number';
+            x = {latest: x.value, timestamp: x.timestamp, sum: number ? x.value : 0, count: number ? 1 : 0,
+                min: number ? x.value : null, max: number ? x.value : null};
+        }
+        if (result.timestamp == null || x.timestamp > result.timestamp) {
+            result.latest = x.latest;
+            result.timestamp = x.timestamp;
+        }
+        result.sum += x.sum;
+        result.count += x.count;
+        if (x.min != null && (result.min == null || x.min < result.min)) result.min = x.min;
+        if (x.max != null && (result.max == null || x.max > result.max)) result.max = x.max;
+    }
+    return result;
+}
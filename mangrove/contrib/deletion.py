@@ -1,7 +1,7 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 from mangrove.contrib.delete_validators import EntityShouldExistValidator
 from mangrove.form_model.validators import MandatoryValidator
-from mangrove.datastore.datadict import get_or_create_data_dict
+from mangrove.datastore.datadict import get_or_create_data_dicts
 from mangrove.form_model.field import HierarchyField, TextField
 from mangrove.form_model.form_model import ENTITY_TYPE_FIELD_NAME, ENTITY_TYPE_FIELD_CODE, SHORT_CODE, SHORT_CODE_FIELD, FormModel
 from mangrove.form_model.validation import TextLengthConstraint
@@ -15,8 +15,9 @@ def create_default_delete_form_model(manager):
 
 
 def _construct_global_deletion_form(manager):
-    entity_id_dd = get_or_create_data_dict(manager, name='Entity Id', slug='entity_id', primitive_type='string')
-    entity_type_dd = get_or_create_data_dict(manager, name='Entity Type', slug='entity_type', primitive_type='string')
+    entity_id_dd, entity_type_dd = get_or_create_data_dicts(manager, [
+        dict(name='Entity Id', slug='entity_id', primitive_type='string'),
+        dict(name='Entity Type', slug='entity_type', primitive_type='string')])
 
     question1 = HierarchyField(name=ENTITY_TYPE_FIELD_NAME, code=ENTITY_TYPE_FIELD_CODE,
         label="What is the entity type",
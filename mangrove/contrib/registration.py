@@ -1,7 +1,7 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 from mangrove.contrib.registration_validators import MobileNumberValidationsForReporterRegistrationValidator, AtLeastOneLocationFieldMustBeAnsweredValidator
 from mangrove.form_model.validators import MandatoryValidator
-from mangrove.datastore.datadict import get_or_create_data_dict
+from mangrove.datastore.datadict import get_or_create_data_dicts
 from mangrove.form_model.field import HierarchyField, TextField, TelephoneNumberField, GeoCodeField
 from mangrove.form_model.form_model import ENTITY_TYPE_FIELD_NAME, ENTITY_TYPE_FIELD_CODE, NAME_FIELD, NAME_FIELD_CODE, SHORT_CODE, SHORT_CODE_FIELD, LOCATION_TYPE_FIELD_NAME, LOCATION_TYPE_FIELD_CODE, MOBILE_NUMBER_FIELD, MOBILE_NUMBER_FIELD_CODE, DESCRIPTION_FIELD_CODE, GEO_CODE_FIELD_NAME, FormModel, GEO_CODE, DESCRIPTION_FIELD, REGISTRATION_FORM_CODE
 from mangrove.form_model.validation import TextLengthConstraint, RegexConstraint
@@ -23,12 +23,12 @@ def _create_constraints_for_mobile_number():
 
 
 def construct_global_registration_form(manager):
-    location_type = get_or_create_data_dict(manager, name='Location Type', slug='location', primitive_type='string')
-    geo_code_type = get_or_create_data_dict(manager, name='GeoCode Type', slug='geo_code', primitive_type='geocode')
-    mobile_number_type = get_or_create_data_dict(manager, name='Mobile Number Type', slug='mobile_number',
-                                                 primitive_type='string')
-    name_type = get_or_create_data_dict(manager, name='Name', slug='name', primitive_type='string')
-    entity_id_type = get_or_create_data_dict(manager, name='Entity Id Type', slug='entity_id', primitive_type='string')
+    location_type, geo_code_type, mobile_number_type, name_type, entity_id_type = get_or_create_data_dicts(manager, [
+        dict(name='Location Type', slug='location', primitive_type='string'),
+        dict(name='GeoCode Type', slug='geo_code', primitive_type='geocode'),
+        dict(name='Mobile Number Type', slug='mobile_number', primitive_type='string'),
+        dict(name='Name', slug='name', primitive_type='string'),
+        dict(name='Entity Id Type', slug='entity_id', primitive_type='string')])
 
     question1 = HierarchyField(name=ENTITY_TYPE_FIELD_NAME, code=ENTITY_TYPE_FIELD_CODE,
                                label="What is associated subject type?", ddtype=entity_id_type, instruction="Enter a type for the subject")
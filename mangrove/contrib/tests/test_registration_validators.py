@@ -8,6 +8,7 @@ from mangrove.form_model.field import HierarchyField, GeoCodeField, TextField
 from mangrove.form_model.form_model import LOCATION_TYPE_FIELD_NAME, LOCATION_TYPE_FIELD_CODE, GEO_CODE_FIELD_NAME, GEO_CODE, REPORTER
 from mangrove.contrib.registration_validators import AtLeastOneLocationFieldMustBeAnsweredValidator, MobileNumberValidationsForReporterRegistrationValidator
 from mangrove.datastore.datadict import DataDictType
+from mangrove.datastore.documents import EntityDocument
 
 class TestAtLeastOneLocationFieldMustBeAnsweredValidator(unittest.TestCase):
     def setUp(self):
@@ -51,8 +52,8 @@ class TestMobileNumberMandatoryValidationsForReporterRegistrationValidator(unitt
         self.field2 = TextField('m', 'm', 'm', Mock(spec=DataDictType))
         self.fields = [self.field1, self.field2]
         self.dbm = Mock(spec=DatabaseManager)
-        self.patcher = patch('mangrove.transport.reporter.get_all_entities')
-        self.get_all_entities_mock = self.patcher.start()
+        self.patcher = patch('mangrove.transport.reporter._load_reporter_docs')
+        self.load_reporter_docs_mock = self.patcher.start()
 
     def tearDown(self):
         self.patcher.stop()
@@ -64,14 +65,12 @@ class TestMobileNumberMandatoryValidationsForReporterRegistrationValidator(unitt
         self.assertTrue('m' in error_dict.keys())
 
     def test_should_return_error_dict_if_mobile_number_allready_exist(self):
-        entity_mock = Mock()
-        entity_mock.value.return_value='123'
-        self.get_all_entities_mock.return_value = [entity_mock]
+        self.load_reporter_docs_mock.return_value = [EntityDocument(short_code='rep1').unwrap()]
         values = dict(t='reporter', m='123')
         error_dict = self.validator.validate(values, self.fields, self.dbm)
         self.assertEqual(1, len(error_dict))
         self.assertTrue('m' in error_dict.keys())
-        self.get_all_entities_mock.assert_called_once_with(self.dbm, entity_type=[REPORTER])
+        self.load_reporter_docs_mock.assert_called_once_with(self.dbm, '123')
 
     def test_should_create_mobile_number_mandatory_for_reporter_validator_from_json(self):
         validator_json = {
@@ -87,32 +86,26 @@ class TestMobileNumberMandatoryValidationsForReporterRegistrationValidator(unitt
         self.assertEqual(expected_json, self.validator.to_json())
 
     def test_should_return_error_if_mobile_number_comes_in_epsilon_format_from_excel_file(self):
-        entity_mock = Mock()
-        entity_mock.value.return_value='266123321435'
-        self.get_all_entities_mock.return_value = [entity_mock]
+        self.load_reporter_docs_mock.return_value = [EntityDocument(short_code='rep1').unwrap()]
         values = dict(t='reporter', m='2.66123321435e+11')
         error_dict = self.validator.validate(values, self.fields, self.dbm)
         self.assertEqual(1, len(error_dict))
         self.assertTrue('m' in error_dict.keys())
-        self.get_all_entities_mock.assert_called_once_with(self.dbm, entity_type=[REPORTER])
+        self.load_reporter_docs_mock.assert_called_once_with(self.dbm, '266123321435')
 
     def test_should_return_error_if_mobile_number_has_hyphens_from_excel_file(self):
-        entity_mock = Mock()
-        entity_mock.value.return_value='266123321435'
-        self.get_all_entities_mock.return_value = [entity_mock]
+        self.load_reporter_docs_mock.return_value = [EntityDocument(short_code='rep1').unwrap()]
         values = dict(t='reporter', m='266-123321435')
         error_dict = self.validator.validate(values, self.fields, self.dbm)
         self.assertEqual(1, len(error_dict))
         self.assertTrue('m' in error_dict.keys())
-        self.get_all_entities_mock.assert_called_once_with(self.dbm, entity_type=[REPORTER])
+        self.load_reporter_docs_mock.assert_called_once_with(self.dbm, '266123321435')
 
     def test_should_return_error_if_mobile_number_comes_as_floating_point_number_from_excel_file(self):
-        entity_mock = Mock()
-        entity_mock.value.return_value='266123321435'
-        self.get_all_entities_mock.return_value = [entity_mock]
+        self.load_reporter_docs_mock.return_value = [EntityDocument(short_code='rep1').unwrap()]
         values = dict(t='reporter', m='266123321435.0')
         error_dict = self.validator.validate(values, self.fields, self.dbm)
         self.assertEqual(1, len(error_dict))
         self.assertTrue('m' in error_dict.keys())
-        self.get_all_entities_mock.assert_called_once_with(self.dbm, entity_type=[REPORTER])
+        self.load_reporter_docs_mock.assert_called_once_with(self.dbm, '266123321435')
 
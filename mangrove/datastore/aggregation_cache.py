@@ -0,0 +1,199 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+A per DatabaseManager cache of aggregation results, for dashboards that repeat the same queries.
+
+    enable_aggregation_cache(dbm, max_size=500, stale_while_revalidate=True)
+    values = data.aggregate(dbm, ...)   # computed
+    values = data.aggregate(dbm, ...)   # from the cache
+
+Results are keyed by the aggregation function and its normalized arguments. Before every lookup the
+cache reads the _changes feed since its last lookup, which costs one small request when nothing
+changed, and invalidates the results of the forms and entity types of the changed data records,
+entities and form models. Changes made by other processes are seen the same way as local ones.
+
+With stale_while_revalidate an invalidated result is still returned while a background thread
+computes the new one; otherwise it is computed before returning.
+"""
+import copy
+import inspect
+from functools import wraps
+from threading import Lock, Thread
+from mangrove.utils.cache import LRUCache
+from mangrove.utils.types import is_string
+
+DEFAULT_MAX_SIZE = 500
+CHANGES_BATCH_SIZE = 500
+_EVERYTHING = ("*",)
+
+_caches = {}
+_caches_lock = Lock()
+
+
+def enable_aggregation_cache(dbm, max_size=DEFAULT_MAX_SIZE, stale_while_revalidate=False):
+    """Caches the results of the aggregation functions for this dbm, at most max_size of them."""
+    with _caches_lock:
+        if dbm not in _caches:
+            _caches[dbm] = AggregationCache(dbm, max_size, stale_while_revalidate)
+        return _caches[dbm]
+
+
+def disable_aggregation_cache(dbm):
+    with _caches_lock:
+        cache = _caches.pop(dbm, None)
+    if cache is not None:
+        cache.wait_for_refreshes()
+
+
+def aggregation_cache(dbm):
+    return _caches.get(dbm)
+
+
+def cached_aggregation(function):
+    """
+    Serves the results of an aggregation function from the cache of its dbm, when one is enabled. The
+    results are invalidated by changes to the form_code or form_codes, and to the entity_type, it is
+    called with.
+    """
+
+    @wraps(function)
+    def _cached(dbm, *args, **kwargs):
+        cache = _caches.get(dbm)
+        if cache is None:
+            return function(dbm, *args, **kwargs)
+        arguments = inspect.getcallargs(function, dbm, *args, **kwargs)
+        del arguments['dbm']
+        key = (function.__module__, function.__name__, _normalize(arguments))
+        return cache.get_or_compute(key, _tags_of_arguments(arguments), lambda: function(dbm, *args, **kwargs))
+
+    return _cached
+
+
+class AggregationCache(object):
+    def __init__(self, dbm, max_size=DEFAULT_MAX_SIZE, stale_while_revalidate=False):
+        self.dbm = dbm
+        self.stale_while_revalidate = stale_while_revalidate
+        self.seq = dbm.update_seq()
+        self._entries = LRUCache(max_size)
+        self._invalidated_at = {}
+        self._refreshing = {}
+        self._lock = Lock()
+
+    def get_or_compute(self, key, tags, compute):
+        seq = self.catch_up()
+        entry = self._entries.get(key)
+        if entry is not None and (not entry.stale or self.stale_while_revalidate):
+            if entry.stale:
+                self._refresh(key, tags, compute)
+            return copy.deepcopy(entry.value)
+        return copy.deepcopy(self._compute(key, tags, compute, seq))
+
+    def catch_up(self):
+        """Invalidates the results that the changes since the last call affect, and returns the current seq."""
+        with self._lock:
+            if self.dbm.update_seq() == self.seq:
+                return self.seq
+            while True:
+                results, last_seq = self.dbm.changes(since=self.seq, limit=CHANGES_BATCH_SIZE)
+                self._invalidate(set(tag for result in results for tag in _tags_of_change(result)), last_seq)
+                self.seq = last_seq
+                if len(results) < CHANGES_BATCH_SIZE:
+                    return self.seq
+
+    def invalidate(self, tags):
+        """Invalidates the results for tags such as ("form", "CL1") or ("entity_type", ("clinic",))."""
+        with self._lock:
+            self._invalidate(set(tags), self.seq)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return self._entries.stats()
+
+    def wait_for_refreshes(self):
+        with self._lock:
+            threads = self._refreshing.values()
+        for thread in threads:
+            thread.join()
+
+    def _invalidate(self, tags, seq):
+        if not tags:
+            return
+        for tag in tags:
+            self._invalidated_at[tag] = seq
+        for key, entry in self._entries.items():
+            if _EVERYTHING in tags or entry.tags & tags:
+                entry.stale = True
+
+    def _compute(self, key, tags, compute, seq):
+        value = compute()
+        with self._lock:
+            stale = any(self._invalidated_at.get(tag, seq) > seq for tag in tags | set([_EVERYTHING]))
+            self._entries.put(key, _Entry(value, tags, stale))
+        return value
+
+    def _refresh(self, key, tags, compute):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            thread = self._refreshing[key] = Thread(target=self._refresh_in_background,
+                                                    args=(key, tags, compute, self.seq))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_in_background(self, key, tags, compute, seq):
+        try:
+            self._compute(key, tags, compute, seq)
+        except Exception:
+            # the next lookup computes the result itself, and raises the error to its caller
+            self._entries.invalidate(key)
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+
+
+class _Entry(object):
+    def __init__(self, value, tags, stale=False):
+        self.value = value
+        self.tags = tags
+        self.stale = stale
+
+
+def _normalize(value):
+    if isinstance(value, dict):
+        return tuple(sorted((_normalize(k), _normalize(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return (type(value).__name__, _normalize(vars(value)))
+    return value
+
+
+def _entity_type_tag(entity_type):
+    return "entity_type", tuple([entity_type] if is_string(entity_type) else entity_type)
+
+
+def _tags_of_arguments(arguments):
+    tags = set()
+    if arguments.get('form_code') is not None:
+        tags.add(("form", arguments['form_code']))
+    for form_code in arguments.get('form_codes') or []:
+        tags.add(("form", form_code))
+    if arguments.get('entity_type') is not None:
+        tags.add(_entity_type_tag(arguments['entity_type']))
+    return tags
+
+
+def _tags_of_change(result):
+    doc = result.get('doc')
+    if doc is None or doc.get('_deleted'):
+        return [_EVERYTHING]
+    document_type = doc.get('document_type')
+    if document_type == "DataRecord":
+        return [("form", doc.get('submission', {}).get('form_code')),
+                _entity_type_tag(doc['entity']['aggregation_paths']['_type'])]
+    if document_type == "Entity":
+        return [_entity_type_tag(doc['aggregation_paths']['_type'])]
+    if document_type == "FormModel":
+        return [("form", doc.get('form_code'))]
+    return []
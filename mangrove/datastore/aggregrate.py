@@ -2,11 +2,22 @@
 # performing all aggregation in python
 
 from _collections import defaultdict
+from functools import partial
+from math import ceil
 import time
+from couchdb.client import Row
+from mangrove.datastore.aggregation_cache import cached_aggregation
 from mangrove.datastore.data import BY_VALUES_FORM_CODE_INDEX, BY_VALUES_EVENT_TIME_INDEX, EntityAggregration
-from mangrove.form_model.form_model import get_form_model_by_code
+from mangrove.errors.MangroveException import AggregationNotSupportedForTypeException
+from mangrove.form_model.form_model import get_form_model_by_code, get_form_models_by_code
+from mangrove.utils.concurrency import run_concurrently
 from mangrove.utils.dates import convert_date_string_in_UTC_to_epoch
-from mangrove.utils.types import is_string, is_empty
+from mangrove.utils.types import is_string, is_empty, is_sequence
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Sum(object):
     def __init__(self, field_name):
@@ -66,30 +77,148 @@ class Average(object):
         if count > 0:
             return float(sum(list_of_values)) / count
 
+SAMPLE_BUCKETS = 1024
+DEFAULT_ERROR = 0.05
+SAMPLED_AGGREGATES = (Sum, Count, Average)
+
 AGGREGATION_DICTIONARY = dict(latest=Latest, sum=Sum, min=Min, max=Max, count=Count, average=Average)
 
 def aggregation_factory(key, field_name):
     return AGGREGATION_DICTIONARY.get(key)(field_name)
 
 
+@cached_aggregation
 def aggregate_by_form_code_python(dbm, form_code, aggregates=None, aggregate_on=None, filter=None,
-                                  starttime=None, endtime=None,include_grand_totals = False):
+                                  starttime=None, endtime=None,include_grand_totals = False, approximate=False,
+                                  error=DEFAULT_ERROR):
+    """
+    With approximate, the aggregates are computed over a sample of about 1 / error ** 2 rows of the form
+    between starttime and endtime, whatever their number, and sums and counts are scaled up to all of
+    them; windows smaller than that are read whole and so are exact. error is roughly the relative
+    standard error of sums, counts and averages of fields found in most records of the window. Only sum,
+    count and average can be estimated from a sample, other aggregates raise
+    AggregationNotSupportedForTypeException. With EntityAggregration the values of each entity are
+    estimated from its own sampled records, so entities with few records are far less accurate than the
+    grand totals and those with no record in the sample are missing from the result.
+
+    Median, percentile and count distinct are not offered here, since every call reads the raw rows of
+    the window; aggregate_for_time_period gives them from the summaries stored in the period rollups.
+    """
     assert is_string(form_code)
-    aggregates = [] if aggregates is None else aggregates
 
     form = get_form_model_by_code(dbm, form_code)
+    return _aggregate_form_code(dbm, form, aggregates, aggregate_on, starttime, endtime, include_grand_totals,
+                                approximate, error)
+
+
+@cached_aggregation
+def aggregate_by_form_codes_python(dbm, form_codes, aggregates=None, aggregate_on=None, starttime=None, endtime=None,
+                                   include_grand_totals=False, approximate=False, error=DEFAULT_ERROR):
+    """
+    Returns {form code: what aggregate_by_form_code_python returns for it}. The form models are read
+    with one multi-key request and the by_form_code_time ranges of the forms are read concurrently.
+    """
+    assert is_sequence(form_codes)
+    forms = get_form_models_by_code(dbm, form_codes)
+    results = run_concurrently([partial(_aggregate_form_code, dbm, form, aggregates, aggregate_on, starttime,
+                                        endtime, include_grand_totals, approximate, error)
+                                for form in forms.values()])
+    return dict(zip(forms.keys(), results))
+
+
+def _aggregate_form_code(dbm, form, aggregates, aggregate_on, starttime, endtime, include_grand_totals,
+                         approximate=False, error=DEFAULT_ERROR):
+    aggregates = [] if aggregates is None else aggregates
+    form_code = form.form_code
+    if approximate:
+        _check_sampled_aggregates(aggregates)
+        rows, scale = _load_sample(dbm, form_code, starttime, endtime, error)
+        values = _map_rows(rows, aggregate_on, include_grand_totals)
+        return _scale(_reduce(aggregates, values), aggregates, scale)
+    if numpy is not None:
+        columns = _load_columns(dbm, form_code, starttime, endtime)
+        return _reduce_columns(aggregates, columns, isinstance(aggregate_on, EntityAggregration),
+                               include_grand_totals or aggregate_on is None)
     values = _map(dbm, form.entity_type, BY_VALUES_FORM_CODE_INDEX, form_code, starttime, endtime, aggregate_on, include_grand_totals)
     return _reduce(aggregates, values)
 
 
-def _map(dbm, type_path, group_level, form_code=None, start_time=None, end_time=None, aggregate_on=None, include_grand_totals=False):
+def _load_rows(dbm, form_code, start_time, end_time):
 # currently it assumes one to one mapping between form code and entity type and hence only filter on form code
-    view_name = "by_form_code_time"
+    start_key, end_key = _time_range(form_code, start_time, end_time)
+    return dbm.iter_view_rows("by_form_code_time", startkey=start_key, endkey=end_key)
+
+
+def _time_range(form_code, start_time, end_time):
     epoch_start = convert_date_string_in_UTC_to_epoch(start_time)
     epoch_end = convert_date_string_in_UTC_to_epoch(end_time)
     start_key = [form_code, epoch_start] if epoch_start is not None else [form_code]
     end_key = [form_code, epoch_end] if epoch_end is not None else [form_code, {}]
-    rows = dbm.load_all_rows_in_view(view_name, startkey=start_key, endkey=end_key)
+    return start_key, end_key
+
+
+def _count_rows(dbm, view_name, start_key, end_key):
+    counts = dbm.load_all_rows_in_view(view_name, startkey=start_key, endkey=end_key)
+    return counts[0].value if counts else 0
+
+
+def _check_sampled_aggregates(aggregates):
+    for aggregate in aggregates:
+        if not isinstance(aggregate, SAMPLED_AGGREGATES):
+            raise AggregationNotSupportedForTypeException(aggregate.field_name,
+                                                          "approximate %s" % type(aggregate).__name__.lower())
+
+
+def _load_sample(dbm, form_code, start_time, end_time, error):
+    """
+    Returns rows shaped like those of _load_rows for a pseudo-random sample of the data records of the
+    form between start_time and end_time, and the factor that scales sums and counts over the sample up
+    to all of them. Records are sampled whole, by the hash bucket of their id that by_form_code_sample
+    keys them by, and enough buckets are read for about 1 / error ** 2 rows of the window. The window is
+    read whole when it is smaller than that, or when the buckets would hold as many rows as the window.
+    """
+    assert 0 < error < 1
+    sample_size = 1.0 / (error * error)
+    form_total = _count_rows(dbm, "by_form_code_sample", [form_code], [form_code, {}])
+    if start_time is None and end_time is None:
+        window_total = form_total
+    else:
+        window_total = _count_rows(dbm, "by_form_code_time_count", *_time_range(form_code, start_time, end_time))
+    if window_total <= sample_size:
+        return list(_load_rows(dbm, form_code, start_time, end_time)), 1
+    buckets = int(ceil(SAMPLE_BUCKETS * sample_size / window_total))
+    if form_total * buckets >= window_total * SAMPLE_BUCKETS:
+        return list(_load_rows(dbm, form_code, start_time, end_time)), 1
+    epoch_start = convert_date_string_in_UTC_to_epoch(start_time)
+    epoch_end = convert_date_string_in_UTC_to_epoch(end_time)
+    rows = []
+    for row in dbm.iter_view_rows("by_form_code_sample", reduce=False, startkey=[form_code, 0],
+                                  endkey=[form_code, buckets - 1, {}]):
+        form_code, bucket, timestamp, entity_id, field = row.key
+        if epoch_start is not None and timestamp < epoch_start or epoch_end is not None and timestamp >= epoch_end:
+            continue
+        rows.append(Row(key=[form_code, timestamp, entity_id, field], value=row.value))
+    rows.sort(key=lambda row: row.key[1:])
+    return rows, float(SAMPLE_BUCKETS) / buckets
+
+
+def _scale(result, aggregates, scale):
+    if scale == 1:
+        return result
+    for result_key, fields in result.items():
+        for field_name, value in fields.items():
+            aggregate = Sum('') if result_key == 'GrandTotals' else _get_aggregate_for_field(aggregates, field_name)
+            if isinstance(aggregate, (Sum, Count)) and value is not None:
+                fields[field_name] = value * scale
+    return result
+
+
+def _map(dbm, type_path, group_level, form_code=None, start_time=None, end_time=None, aggregate_on=None, include_grand_totals=False):
+    rows = _load_rows(dbm, form_code, start_time, end_time)
+    return _map_rows(rows, aggregate_on, include_grand_totals)
+
+
+def _map_rows(rows, aggregate_on, include_grand_totals):
     values = []
     for row in rows:
         form_code, timestamp, entity_id, field = row.key
@@ -123,6 +252,96 @@ def _reduce(aggregates, values):
     return result
 
 
+def _load_columns(dbm, form_code, start_time, end_time):
+    """
+    Returns {field: (entity ids, values)} with the values of each field in the event time order of the view.
+    """
+    columns = defaultdict(lambda: ([], []))
+    for row in _load_rows(dbm, form_code, start_time, end_time):
+        form_code, timestamp, entity_id, field = row.key
+        entity_ids, values = columns[field]
+        entity_ids.append(entity_id)
+        values.append(row.value)
+    return columns
+
+
+def _reduce_columns(aggregates, columns, per_entity, grand_totals):
+    """
+    Computes the same result as _reduce from the columns of _load_columns. Fields whose values are
+    all numbers are reduced per entity with numpy; any other field goes through the aggregate objects.
+    """
+    result = defaultdict(dict)
+    for field_name, (entity_ids, values) in columns.items():
+        aggregate = _get_aggregate_for_field(aggregates, field_name) if per_entity else None
+        if aggregate is None and not grand_totals:
+            continue
+        numeric = _numeric_array(values)
+        if grand_totals:
+            result['GrandTotals'][field_name] = numeric.sum().item() if numeric is not None else Sum('').reduce(values)
+        if aggregate is None:
+            continue
+        reduce_columns = _COLUMN_REDUCERS.get(type(aggregate))
+        if numeric is not None and reduce_columns is not None:
+            entity_names, entity_codes = _factorize(entity_ids)
+            order = numpy.argsort(entity_codes, kind='mergesort')
+            starts = numpy.flatnonzero(numpy.diff(entity_codes[order])) + 1
+            starts = numpy.concatenate(([0], starts))
+            ends = numpy.concatenate((starts[1:], [len(order)]))
+            reduced = reduce_columns(numeric[order], starts, ends)
+            for entity_id, value in zip(entity_names, reduced.tolist()):
+                result[entity_id][field_name] = value
+        else:
+            values_by_entity = defaultdict(list)
+            for entity_id, value in zip(entity_ids, values):
+                values_by_entity[entity_id].append(value)
+            for entity_id, value_list in values_by_entity.items():
+                result[entity_id][field_name] = aggregate.reduce(value_list)
+    return result
+
+
+def _numeric_array(values):
+    """
+    Returns values as a numpy array when numpy reduces them to what the aggregate objects give, or None:
+    ints whose sum fits in int64, or floats. Mixed ints and floats would make Min and Max return floats.
+    """
+    if not values:
+        return None
+    if all(type(value) is int for value in values):
+        if max(abs(min(values)), abs(max(values))) * len(values) > _INT64_MAX:
+            return None
+        return numpy.array(values, dtype=numpy.int64)
+    if all(type(value) is float for value in values):
+        return numpy.array(values, dtype=numpy.float64)
+    return None
+
+
+_INT64_MAX = 2 ** 63 - 1
+
+
+def _factorize(keys):
+    """Returns the distinct keys in order of first appearance, and the array of their indexes for keys."""
+    codes = {}
+    indexes = [codes.setdefault(key, len(codes)) for key in keys]
+    names = [None] * len(codes)
+    for key, index in codes.items():
+        names[index] = key
+    return names, numpy.array(indexes, dtype=numpy.int64)
+
+
+def _average(values, starts, ends):
+    return numpy.add.reduceat(values, starts).astype(numpy.float64) / (ends - starts)
+
+# each takes the values sorted by entity, in event time order per entity, and the start and end of every entity
+_COLUMN_REDUCERS = {
+    Sum: lambda values, starts, ends: numpy.add.reduceat(values, starts),
+    Min: lambda values, starts, ends: numpy.minimum.reduceat(values, starts),
+    Max: lambda values, starts, ends: numpy.maximum.reduceat(values, starts),
+    Latest: lambda values, starts, ends: values[ends - 1],
+    Count: lambda values, starts, ends: ends - starts,
+    Average: _average,
+}
+
+
 def _form_code_filter(row, group_level, form_code):
     return True if form_code is None else row.key[group_level] == form_code
 
@@ -1,8 +1,12 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from functools import partial
 from documents import attributes
+from mangrove.datastore import summaries
+from mangrove.datastore.aggregation_cache import cached_aggregation
 from mangrove.errors.MangroveException import AggregationNotSupportedForTypeException
-from mangrove.form_model.form_model import get_form_model_by_code
-from mangrove.utils.types import is_string
+from mangrove.form_model.form_model import get_form_model_by_code, get_form_models_by_code
+from mangrove.utils.concurrency import run_concurrently
+from mangrove.utils.types import is_string, is_sequence
 
 BY_VALUES_ENTITY_ID_INDEX = 1
 BY_VALUES_FIELD_INDEX = BY_VALUES_ENTITY_ID_INDEX + 1
@@ -12,6 +16,9 @@ BY_VALUES_EVENT_TIME_INDEX = BY_VALUES_FORM_CODE_INDEX + 1
 FORM_CODE_GROUP_LEVEL = BY_VALUES_FORM_CODE_INDEX + 1
 ENTITY_GROUP_LEVEL = BY_VALUES_FIELD_INDEX + 1
 
+VALUES_VIEWS = ("by_values", "by_values_latest")
+STATS_FIELDS = ('sum', 'count', 'min', 'max')
+
 class reduce_functions(object):
     """""Constants for referencing reduce functions. """""
     SUM = "sum"
@@ -67,6 +74,7 @@ def get_latest(dbm, entity_type):
     return _load_entity_attributes(dbm, entity_type)
 
 
+@cached_aggregation
 def aggregate(dbm, entity_type, aggregates=None, aggregate_on=None,
               filter=None, starttime=None, endtime=None):
     """
@@ -117,7 +125,10 @@ def aggregate(dbm, entity_type, aggregates=None, aggregate_on=None,
         )
 
     This returns you one row per entity for all entities of type
-    entity_type in Pune with the aggregations applied per field.
+    entity_type in Pune with the aggregations applied per field. The
+    entities currently in Pune are read from by_location, and all of their
+    data records, wherever they were made, are aggregated with one
+    multi-key request of aggregates_by_type_field_entity.
 
     4. Aggregate on a location level = 2, but filter by location,
 
@@ -153,16 +164,29 @@ def aggregate(dbm, entity_type, aggregates=None, aggregate_on=None,
             },
         aggregate_on=EntityAggregration()
         )
+
+    Median, percentile and count distinct are not supported here and raise
+    AggregationNotSupportedForTypeException: they would have to be built
+    from every data record of the entities on each call. aggregate_for_time_period
+    gives them from the summaries stored in the period rollups.
     """
     result = {}
     aggregates = {} if aggregates is None else aggregates
-
-    aggregate, group_level = _get_aggregate_strategy(aggregate_on)
-    values = aggregate(dbm, entity_type, group_level, aggregate_on)
+    _check_summary_functions(aggregates)
     interested_keys = None
+    ranges = None
+
+    by_path = isinstance(aggregate_on, LocationAggregration) or isinstance(aggregate_on, TypeAggregration)
 
-    if isinstance(filter, LocationFilter):
-        interested_keys = _get_interested_keys_for_location(aggregate_on, dbm, entity_type, filter.location)
+    if isinstance(filter, LocationFilter) and not by_path:
+        entity_ids = _get_entities_for_location(dbm, entity_type, filter.location)
+        values = _load_entities_aggregated(dbm, entity_type, entity_ids, aggregates)
+    else:
+        if isinstance(filter, LocationFilter):
+            interested_keys = set([tuple(filter.location)])
+            ranges = _get_ranges_for_location(aggregate_on, dbm, entity_type, aggregates, filter.location)
+        aggregate, group_level = _get_aggregate_strategy(aggregate_on, streaming=True)
+        values = aggregate(dbm, entity_type, group_level, aggregate_on, ranges=ranges)
 
     _parse_key = _get_key_strategy(aggregate_on, dict())
 
@@ -178,22 +202,46 @@ def aggregate(dbm, entity_type, aggregates=None, aggregate_on=None,
         if "*" in aggregates:
             interested_aggregate = aggregates.get("*")
         if interested_aggregate:
-            try:
-                result.setdefault(result_key, {})[field] = val[interested_aggregate]
-            except KeyError:
-                raise AggregationNotSupportedForTypeException(field, interested_aggregate)
+            result.setdefault(result_key, {})[field] = _aggregate_value(val, field, interested_aggregate)
     return result
 
 
+@cached_aggregation
 def aggregate_for_form(dbm, form_code, aggregates=None, aggregate_on=None, filter=None, starttime=None, endtime=None):
     assert is_string(form_code)
-    result = {}
     aggregates = {} if aggregates is None else aggregates
+    _check_summary_functions(aggregates)
 
     form = get_form_model_by_code(dbm, form_code)
     aggregate, group_level = _get_aggregate_strategy(aggregate_on, for_form_code=True)
     values = aggregate(dbm, form.entity_type, group_level, aggregate_on)
+    return _aggregate_values_for_form(values, form_code, aggregates, aggregate_on)
+
+
+@cached_aggregation
+def aggregate_for_forms(dbm, form_codes, aggregates=None, aggregate_on=None):
+    """
+    Returns {form code: what aggregate_for_form returns for it}. The form models are read with one
+    multi-key request, and the values are loaded once per entity type, concurrently, since the forms
+    of an entity type share the same by_values rows.
+    """
+    assert is_sequence(form_codes)
+    aggregates = {} if aggregates is None else aggregates
+    _check_summary_functions(aggregates)
+
+    forms = get_form_models_by_code(dbm, form_codes)
+    entity_types = list(set(tuple(form.entity_type) for form in forms.values()))
+    aggregate, group_level = _get_aggregate_strategy(aggregate_on, for_form_code=True)
+    loaded = run_concurrently([partial(aggregate, dbm, list(entity_type), group_level, aggregate_on)
+                               for entity_type in entity_types])
+    values = dict(zip(entity_types, loaded))
+    return dict((form_code, _aggregate_values_for_form(values[tuple(form.entity_type)], form_code, aggregates,
+                                                       aggregate_on))
+                for form_code, form in forms.items())
+
 
+def _aggregate_values_for_form(values, form_code, aggregates, aggregate_on):
+    result = {}
     interested_keys = _get_interested_keys_for_form_code(values, form_code)
 
     _parse_key = _get_key_strategy(aggregate_on, {'form_code': form_code})
@@ -210,13 +258,56 @@ def aggregate_for_form(dbm, form_code, aggregates=None, aggregate_on=None, filte
         if "*" in aggregates:
             interested_aggregate = aggregates.get("*")
         if interested_aggregate:
-            try:
-                result.setdefault(result_key, {})[field] = val[interested_aggregate]
-            except KeyError:
-                raise AggregationNotSupportedForTypeException(field, interested_aggregate)
+            result.setdefault(result_key, {})[field] = _aggregate_value(val, field, interested_aggregate)
     return result
 
 
+def _aggregate_value(value, field, function):
+    try:
+        return value[function]
+    except KeyError:
+        raise AggregationNotSupportedForTypeException(field, function)
+
+
+def _check_summary_functions(aggregates):
+    for field, function in aggregates.items():
+        if summaries.is_summary_function(function):
+            raise AggregationNotSupportedForTypeException(field, function)
+
+
+def _load_entities_aggregated(dbm, entity_type, entity_ids, aggregates):
+    """
+    Returns the (key, value) pairs _iter_all_fields_aggregated gives for entity_ids.
+    aggregates_by_type_field_entity is keyed [entity_type, field, entity_id], so the groups of the
+    entities are read with one multi-key request, plus one for the fields of entity_type with "*".
+    """
+    if not entity_ids:
+        return []
+    view_name = "aggregates_by_type_field_entity"
+    if "*" in aggregates:
+        fields = [row.key[1] for row in dbm.load_all_rows_in_view(view_name, group_level=2, startkey=[entity_type],
+                                                                   endkey=[entity_type, {}])]
+    else:
+        fields = sorted(aggregates.keys())
+    keys = [[entity_type, field, entity_id] for field in fields for entity_id in entity_ids]
+    return [(_by_values_key(row.key), _values_of(row.value))
+            for row in dbm.load_all_rows_in_view(view_name, group=True, keys=keys)]
+
+
+def _by_values_key(key):
+    """Returns a key of aggregates_by_type_field_entity as the by_values views group it."""
+    entity_type, field, entity_id = key
+    return [entity_type, entity_id, field]
+
+
+def _values_of(aggregated):
+    """Returns what aggregates_by_type_field_entity reduces a group to as _iter_all_fields_aggregated gives it."""
+    value = dict(latest=aggregated['latest'], timestamp=aggregated['timestamp'])
+    if aggregated['count']:
+        _add_stats(value, dict((name, aggregated[name]) for name in STATS_FIELDS))
+    return value
+
+
 def _get_interested_keys_for_form_code(values, form_code):
     interested_keys = []
     for k, d in values:
@@ -225,12 +316,31 @@ def _get_interested_keys_for_form_code(values, form_code):
     return interested_keys
 
 
-def _get_interested_keys_for_location(aggregate_on, dbm, entity_type, location):
-    if isinstance(aggregate_on, LocationAggregration) or isinstance(aggregate_on, TypeAggregration):
-        interested_keys = [tuple(location)]
+def _get_ranges_for_location(aggregate_on, dbm, entity_type, aggregates, location):
+    """
+    Returns the (startkey, endkey) ranges of by_aggregation_path that aggregate_on reads under a location
+    filter, one per field.
+    """
+    prefix = [entity_type, _translate_aggregation_type(aggregate_on)]
+    if "*" in aggregates:
+        fields = _get_fields_by_aggregation_path(dbm, prefix)
     else:
-        interested_keys = _get_entities_for_location(dbm, entity_type, location)
-    return interested_keys
+        fields = sorted(aggregates.keys())
+    return [(prefix + [field] + list(location), prefix + [field] + list(location) + [{}]) for field in fields]
+
+
+def _get_fields_by_aggregation_path(dbm, prefix):
+    rows = dbm.load_all_rows_in_view("by_aggregation_path", group_level=len(prefix) + 1, startkey=prefix,
+                                     endkey=prefix + [{}])
+    return [row.key[len(prefix)] for row in rows]
+
+
+def _read_ranges(read, ranges):
+    """Calls read(startkey, endkey) for each of ranges, concurrently, and returns the rows they read in order."""
+    rows = []
+    for range_rows in run_concurrently([partial(read, startkey, endkey) for startkey, endkey in ranges]):
+        rows.extend(range_rows)
+    return rows
 
 
 def _get_key_strategy(aggregate_on, filter):
@@ -261,12 +371,12 @@ def _get_key_strategy(aggregate_on, filter):
         return _aggregate_by_entity
 
 
-def _get_aggregate_strategy(aggregate_on, for_form_code=False):
+def _get_aggregate_strategy(aggregate_on, for_form_code=False, streaming=False):
     if isinstance(aggregate_on, LocationAggregration) or isinstance(aggregate_on, TypeAggregration):
         return _load_all_fields_by_aggregation_path, aggregate_on.level
     else:
         group_level = FORM_CODE_GROUP_LEVEL if for_form_code is True else ENTITY_GROUP_LEVEL
-        return _load_all_fields_aggregated, group_level
+        return (_iter_all_fields_aggregated if streaming else _load_all_fields_aggregated), group_level
 
 
 def _load_all_fields_latest_values(dbm, type_path, group_level, filter=None):
@@ -286,48 +396,73 @@ def _load_all_fields_latest_values(dbm, type_path, group_level, filter=None):
     return values
 
 
-def _find_in(values, key):
-    for k, v in values:
-        if k == key:
-            return v
-    return None
-
-
-def _load_all_fields_aggregated(dbm, type_path, group_level, filter=None):
+def _load_all_fields_stats(dbm, type_path, group_level):
     view_name = "by_values"
-    startkey = [type_path]
-    endkey = [type_path, {}]
-    #    if filter is not None and filter.get('form_code') is not None:
-    #        view_group_level = BY_VALUES_FORM_CODE_INDEX + 1
-    #    else:
-    #        view_group_level = BY_VALUES_FIELD_INDEX + 1
     rows = dbm.load_all_rows_in_view(view_name, group_level=group_level,
-                                     startkey=startkey,
-                                     endkey=endkey)
+                                     startkey=[type_path],
+                                     endkey=[type_path, {}])
     values = []
     for row in rows:
         values.append((row.key, row.value))
+    return values
 
-    latest_values = _load_all_fields_latest_values(dbm, type_path, group_level, filter)
 
-    for k, v in values:
-        v["latest"] = _find_in(latest_values, k)["latest"]
-        v['average'] = v['sum'] / v['count']
+def _hashable(key):
+    if isinstance(key, list):
+        return tuple(_hashable(part) for part in key)
+    return key
 
-    for k, v in latest_values:
-        v_dict = _find_in(values, k)
-        if v_dict is not None:
-            v.update(v_dict)
+
+def _add_stats(latest_value, stats_value):
+    stats_value["latest"] = latest_value["latest"]
+    stats_value['average'] = stats_value['sum'] / stats_value['count']
+    latest_value.update(stats_value)
+
+
+def _load_all_fields_aggregated(dbm, type_path, group_level, filter=None):
+    """
+    Returns (key, value) for every group of by_values_latest, with the by_values stats of the group
+    merged in for numeric fields. The stats are joined to the latest values through a dict on the key.
+    """
+    latest_values = _load_all_fields_latest_values(dbm, type_path, group_level, filter)
+    latest_by_key = dict((_hashable(k), v) for k, v in latest_values)
+
+    for k, v in _load_all_fields_stats(dbm, type_path, group_level):
+        _add_stats(latest_by_key[_hashable(k)], v)
 
     return latest_values
 
 
-def _load_all_fields_by_aggregation_path(dbm, entity_type, aggregate_on_level, aggregate_on):
+def _iter_all_fields_aggregated(dbm, type_path, group_level, filter=None, ranges=None):
+    """
+    Yields the same (key, value) pairs as _load_all_fields_aggregated while streaming both views.
+
+    by_values only emits the numeric subset of the keys by_values_latest emits and both are in the
+    same collation order, so walking the two in lock-step merges them in one pass.
+    """
+    return _iter_range_aggregated(dbm, group_level, [type_path], [type_path, {}])
+
+
+def _iter_range_aggregated(dbm, group_level, startkey, endkey, views=VALUES_VIEWS):
+    stats_view, latest_view = views
+    view_values = dict(group_level=group_level, startkey=startkey, endkey=endkey)
+    stats_rows = dbm.iter_view_rows(stats_view, **view_values)
+    stats = next(stats_rows, None)
+    for row in dbm.iter_view_rows(latest_view, **view_values):
+        if stats is not None and stats.key == row.key:
+            _add_stats(row.value, stats.value)
+            stats = next(stats_rows, None)
+        yield row.key, row.value
+
+
+def _load_all_fields_by_aggregation_path(dbm, entity_type, aggregate_on_level, aggregate_on, ranges=None):
     view_name = "by_aggregation_path"
     aggregation_type = _translate_aggregation_type(aggregate_on)
-    rows = dbm.load_all_rows_in_view(view_name, group_level=aggregate_on_level + 3,
-                                     startkey=[entity_type, aggregation_type],
-                                     endkey=[entity_type, aggregation_type, {}])
+    if ranges is None:
+        ranges = [([entity_type, aggregation_type], [entity_type, aggregation_type, {}])]
+    rows = _read_ranges(lambda startkey, endkey: dbm.load_all_rows_in_view(view_name,
+                                                                          group_level=aggregate_on_level + 3,
+                                                                          startkey=startkey, endkey=endkey), ranges)
     values = []
     for row in rows:
         values.append((row.key, row.value))
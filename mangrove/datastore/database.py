@@ -1,23 +1,35 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+import json
+import logging
 from threading import Lock
+import time
 from couchdb import http
 
 from couchdb.design import ViewDefinition
-from couchdb.http import ResourceNotFound
+from couchdb.http import ResourceNotFound, ResourceConflict
 import couchdb.client
 
 import settings
 from documents import DocumentBase
+from instrumentation import QueryEvent, Operations, json_size
+from memory_database import MEMORY_URL_SCHEME, memory_server
+from memory_views import collation_key
 from datetime import datetime
 from mangrove.utils import dates
 from mangrove.utils.types import is_empty, is_sequence
-from mangrove.errors.MangroveException import NoDocumentError, DataObjectNotFound, FailedToSaveDataObject
+from mangrove.errors.MangroveException import NoDocumentError, DataObjectNotFound, FailedToSaveDataObject, InvalidContinuationTokenException
 
+VOID_BATCH_SIZE = 500
+VOID_ATTEMPTS = 3
 
 _dbms = {}
 _dbms_lock = Lock()
 
+logger = logging.getLogger(__name__)
+
 
 def get_db_manager(server=None, database=None):
     global _dbms
@@ -58,6 +70,67 @@ def _delete_db_and_remove_db_manager(dbm):
         del dbm.server[dbm.database_name]
 
 
+def _connect(url):
+    if url.startswith(MEMORY_URL_SCHEME):
+        return memory_server(url)
+    return couchdb.client.Server(url, session=http.Session(retry_delays=[5, 30]))
+
+
+def _encode_continuation(row, skip=0):
+    position = dict(startkey=row.key)
+    if row.id is not None:
+        position['startkey_docid'] = row.id
+    if skip:
+        position['skip'] = skip
+    return urlsafe_b64encode(json.dumps(position))
+
+
+def _decode_continuation(continuation):
+    try:
+        position = json.loads(urlsafe_b64decode(str(continuation)))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidContinuationTokenException(continuation)
+    if not isinstance(position, dict) or 'startkey' not in position:
+        raise InvalidContinuationTokenException(continuation)
+    skip = position.get('skip', 0)
+    if not isinstance(skip, int) or isinstance(skip, bool) or skip < 0:
+        raise InvalidContinuationTokenException(continuation)
+    return position
+
+
+def _is_within_range(startkey, values):
+    """
+    Returns whether startkey, taken from a continuation token, lies in the key, keys or startkey..endkey
+    range of the view query values, so that a token can not page through rows outside of it.
+    """
+    key = collation_key(startkey)
+    if 'key' in values:
+        return key == collation_key(values['key'])
+    if 'keys' in values:
+        return key in [collation_key(value) for value in values['keys']]
+    descending = values.get('descending') in (True, 'true')
+    first, last = ('endkey', 'startkey') if descending else ('startkey', 'endkey')
+    if first in values and key < collation_key(values[first]):
+        return False
+    return last not in values or key <= collation_key(values[last])
+
+
+def _skip_at(rows, boundary, position):
+    """
+    Returns how many rows with the key and document id of boundary come before it: a document can emit
+    the same key several times, and startkey/startkey_docid can only point at the first of those rows.
+    """
+    same = lambda row: row.key == boundary.key and row.id == boundary.id
+    preceding = 0
+    for row in reversed(rows):
+        if not same(row):
+            return preceding
+        preceding += 1
+    if position is not None and position['startkey'] == boundary.key and position.get('startkey_docid') == boundary.id:
+        return preceding + position.get('skip', 0)
+    return preceding
+
+
 class DataObject(object):
     """
     Superclass for all objects that are essentially wrappers of DB
@@ -127,43 +200,34 @@ class DataObject(object):
         return self._doc.created
 
 class View(object):
-    def __init__(self,database):
-        self.database=database
-
-    def _load_all_rows_in_view(self, **values):
-        full_view_name = self.name + '/' + self.name
-        print '[DEBUG] loading view: %s' % full_view_name
-        start = datetime.now()
-        rows = self.database.view(full_view_name, **values).rows
-        end = datetime.now()
-        delta_t = (end - start)
-        print "[DEBUG] --- took %s.%s seconds (%s rows)" %\
-              (delta_t.seconds, delta_t.microseconds, len(rows))
-        return rows
-
-    def _execute(self,**values):
-        return self._load_all_rows_in_view(**values)
+    def __init__(self, dbm):
+        self.dbm = dbm
 
     def __getattr__(self, name):
-        self.name=name
-        return self._execute
+        def _execute(**values):
+            return self.dbm.load_all_rows_in_view(name, **values)
+
+        return _execute
 
 class DatabaseManager(object):
+    _observers = ()
+
     def __init__(self, server=None, database=None):
         """
         Connect to the CouchDB server. If no database name is given,
-        use the name provided in the settings
+        use the name provided in the settings. A server url starting with
+        memory:// keeps the database in this process instead.
         """
 
         self.url = (server if server is not None else settings.SERVER)
         self.database_name = database or settings.DATABASE
-        self.server = couchdb.client.Server(self.url, session=http.Session(retry_delays=[5, 30]))
+        self.server = _connect(self.url)
         try:
             self.database = self.server[self.database_name]
         except ResourceNotFound:
             self.database = self.server.create(self.database_name)
 
-        self.view= View(self.database)
+        self.view= View(self)
 
 
     def __unicode__(self):
@@ -175,17 +239,86 @@ class DatabaseManager(object):
     def __repr__(self):
         return repr(self.database)
 
+    def add_observer(self, observer):
+        """
+        Registers a callable that is given a QueryEvent for every view query, bulk save,
+        document fetch and delete made through this manager.
+        """
+        with _dbms_lock:
+            self._observers = tuple(self._observers) + (observer,)
+
+    def remove_observer(self, observer):
+        with _dbms_lock:
+            self._observers = tuple(o for o in self._observers if o != observer)
+
+    def _notify(self, operation, name, params, row_count, size, started):
+        event = QueryEvent(operation, name, params, row_count, size, time.time() - started)
+        for observer in self._observers:
+            try:
+                observer(event)
+            except Exception:
+                logger.exception("Query observer %r failed on %r", observer, event)
+
     def load_all_rows_in_view(self, view_name, **values):
         full_view_name = view_name + '/' + view_name
-        print '[DEBUG] loading view: %s' % full_view_name
-        start = datetime.now()
+        if not self._observers:
+            return self.database.view(full_view_name, **values).rows
+        started = time.time()
         rows = self.database.view(full_view_name, **values).rows
-        end = datetime.now()
-        delta_t = (end - start)
-        print "[DEBUG] --- took %s.%s seconds (%s rows)" %\
-              (delta_t.seconds, delta_t.microseconds, len(rows))
+        self._notify(Operations.VIEW, view_name, values, len(rows), json_size(rows), started)
         return rows
 
+    def load_view_page(self, view_name, page_size, continuation=None, **values):
+        """
+        Loads one page of a view and returns (rows, continuation).
+
+        continuation is an opaque token holding the key and document id of the
+        first row of the following page, or None when there are no more rows.
+        Passing it back resumes right there, so fetching page n does not make
+        CouchDB walk the n - 1 pages before it the way skip does. When a document
+        emits the key of that row more than once, the token also holds how many of
+        those rows were already returned, and only those are skipped. A token whose
+        key is outside of the range of values raises InvalidContinuationTokenException.
+        """
+        assert page_size > 0
+        assert 'skip' not in values and 'limit' not in values
+        position = None
+        if continuation is not None:
+            position = _decode_continuation(continuation)
+            if not _is_within_range(position['startkey'], values):
+                raise InvalidContinuationTokenException(continuation)
+            values.update(position)
+        rows = self.load_all_rows_in_view(view_name, limit=page_size + 1, **values)
+        if len(rows) <= page_size:
+            return rows, None
+        page = rows[:page_size]
+        return page, _encode_continuation(rows[page_size], _skip_at(page, rows[page_size], position))
+
+    def iter_view_rows(self, view_name, page_size=1000, **values):
+        """
+        Iterates over the rows of a view, fetching at most page_size + 1 rows per request.
+
+        Pages are chained with startkey/startkey_docid taken from the first row of
+        the next page rather than with skip, so every request costs the same and
+        memory stays bounded by the page size.
+        """
+        assert page_size > 0
+        assert 'skip' not in values and 'limit' not in values
+        if 'keys' in values:
+            for row in self.load_all_rows_in_view(view_name, **values):
+                yield row
+            return
+        if 'key' in values:
+            key = values.pop('key')
+            values['startkey'] = values['endkey'] = key
+        continuation = None
+        while True:
+            rows, continuation = self.load_view_page(view_name, page_size, continuation, **values)
+            for row in rows:
+                yield row
+            if continuation is None:
+                return
+
     def create_view(self, view_name, map, reduce):
         view_document = view_name # views get their own design doc for the time being
         view = ViewDefinition(view_document, view_name, map, reduce)
@@ -229,7 +362,13 @@ class DatabaseManager(object):
         # an exception instance (e.g. `ResourceConflict`) if the update failed.
 
         # Fix up rev, 'cause bulk update seems not to do that
-        results = self.database.update(documents)
+        if not self._observers:
+            results = self.database.update(documents)
+        else:
+            started = time.time()
+            results = self.database.update(documents)
+            self._notify(Operations.BULK_SAVE, None, None, len(documents),
+                         json_size([doc._data for doc in documents]), started)
         for x in range(len(results)):
             if results[x][0]:
                 documents[x]._data['_rev'] = results[x][2]
@@ -240,8 +379,49 @@ class DatabaseManager(object):
         doc.void = True
         self._save_document(doc)
 
+    def void_documents(self, ids, batch_size=VOID_BATCH_SIZE):
+        """
+        Marks the documents with the given ids as void, batch_size of them at a time: each batch is read
+        with one _all_docs request and written back with one _bulk_docs request. Documents that were
+        changed meanwhile are read and voided again. Returns the number of documents voided, leaving out
+        missing ones and those that were void already.
+        """
+        assert is_sequence(ids)
+        assert batch_size > 0
+        ids = list(OrderedDict.fromkeys(ids))
+        voided = 0
+        for start in range(0, len(ids), batch_size):
+            pending = ids[start:start + batch_size]
+            for attempt in range(VOID_ATTEMPTS):
+                documents = [DocumentBase.wrap(row['doc']) for row in self._load_all_docs(pending)
+                             if row.get('doc') is not None and not row['doc'].get('void')]
+                if not documents:
+                    break
+                for document in documents:
+                    document.void = True
+                pending = []
+                for success, id, rev_or_exception in self._save_documents(documents):
+                    if success:
+                        voided += 1
+                    elif isinstance(rev_or_exception, ResourceConflict):
+                        pending.append(id)
+                    else:
+                        raise FailedToSaveDataObject(str(rev_or_exception))
+                if not pending:
+                    break
+            else:
+                raise FailedToSaveDataObject("Documents %s kept changing while being voided" % ", ".join(pending))
+        return voided
+
     def _delete_document(self, document):
+        self._delete(document)
+
+    def _delete(self, document):
+        if not self._observers:
+            return self.database.delete(document)
+        started = time.time()
         self.database.delete(document)
+        self._notify(Operations.DELETE, document.id, None, 1, None, started)
 
     def _load_document(self, id, document_class=DocumentBase):
         """
@@ -252,8 +432,35 @@ class DatabaseManager(object):
         """
         if is_empty(id):
             return None
-        else:
+        if not self._observers:
             return document_class.load(self.database, id=id)
+        started = time.time()
+        document = document_class.load(self.database, id=id)
+        self._notify(Operations.GET, id, None, int(document is not None),
+                     json_size(document._data) if document is not None else 0, started)
+        return document
+
+    def changes(self, since=0, limit=None):
+        """
+        Reads the _changes feed after the sequence number since and returns (results, last_seq).
+        Every result holds the seq, id and changes of a document, and the document itself as doc.
+        """
+        values = dict(since=since, include_docs=True)
+        if limit is not None:
+            values['limit'] = limit
+        started = time.time()
+        data = self.database.changes(**values)
+        if self._observers:
+            self._notify(Operations.CHANGES, None, values, len(data['results']), json_size(data), started)
+        return data['results'], data['last_seq']
+
+    def update_seq(self):
+        """Returns the sequence number of the latest change to the database."""
+        started = time.time()
+        info = self.database.info()
+        if self._observers:
+            self._notify(Operations.INFO, None, None, None, json_size(info), started)
+        return info['update_seq']
 
     def get_many(self, ids, object_class):
         """
@@ -266,14 +473,21 @@ class DatabaseManager(object):
         assert is_sequence(ids)
 
         objs = []
-        rows = self.database.view('_all_docs', keys=ids, include_docs=True)
-        for row in rows:
+        for row in self._load_all_docs(ids):
             if 'error' in row:
                 continue
             obj = object_class.new_from_doc(self, object_class.__document_class__.wrap(row.get('doc')))
             objs.append(obj)
         return objs
 
+    def _load_all_docs(self, ids):
+        if not self._observers:
+            return self.database.view('_all_docs', keys=ids, include_docs=True).rows
+        started = time.time()
+        rows = self.database.view('_all_docs', keys=ids, include_docs=True).rows
+        self._notify(Operations.GET_MANY, None, dict(keys=ids), len(rows), json_size(rows), started)
+        return rows
+
     def get(self, id, object_class, get_or_create=False):
         """
         Return the object from the database with the given
@@ -306,5 +520,4 @@ class DatabaseManager(object):
         if d_obj._doc is None:
             raise NoDocumentError
 
-        id = d_obj._doc.id
-        self.database.delete(d_obj._doc)
+        self._delete(d_obj._doc)
@@ -1,32 +1,108 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
+import copy
+from collections import OrderedDict
+from threading import Lock
 from database import DatabaseManager, DataObject
 from documents import DataDictDocument
-from mangrove.errors.MangroveException import DataObjectNotFound
-from mangrove.utils.types import is_string
+from mangrove.errors.MangroveException import DataObjectNotFound, FailedToSaveDataObject
+from mangrove.utils.cache import LRUCache
+from mangrove.utils.types import is_string, is_sequence
+
+DATADICT_CACHE_SIZE = 1000
+
+_datadict_caches = {}
+_slug_caches = {}
+_caches_lock = Lock()
+
+
+def datadict_cache(dbm):
+    """
+    Returns the cache of data dict type documents for this dbm, keyed by id.
+    Data dict types are practically never edited, so entries are used without checking their revision;
+    saving or deleting a DataDictType in this process drops its entry.
+    """
+    return _cache_of(_datadict_caches, dbm)
+
+
+def slug_cache(dbm):
+    """Returns the cache of data dict type ids for this dbm, keyed by slug."""
+    return _cache_of(_slug_caches, dbm)
+
+
+def _cache_of(caches, dbm):
+    with _caches_lock:
+        if dbm not in caches:
+            caches[dbm] = LRUCache(DATADICT_CACHE_SIZE)
+        return caches[dbm]
+
+
+def _remember(dbm, ddtype):
+    datadict_cache(dbm).put(ddtype.id, copy.deepcopy(ddtype.to_json()))
+    slug_cache(dbm).put(ddtype.slug, ddtype.id)
+
 
 def get_datadict_type(dbm, id):
     assert isinstance(dbm, DatabaseManager)
-    return dbm.get(id, DataDictType)
+    cache = datadict_cache(dbm)
+    json = cache.get(id)
+    if json is None:
+        ddtype = dbm.get(id, DataDictType)
+        cache.put(id, copy.deepcopy(ddtype.to_json()))
+        return ddtype
+    return _from_json(dbm, json)
 
 
 def get_datadict_type_by_slug(dbm, slug):
-    assert isinstance(dbm, DatabaseManager)
     assert is_string(slug)
-
-    rows = dbm.load_all_rows_in_view('by_datadict_type', key=slug, include_docs='true')
-    if not len(rows):
+    ddtype = get_datadict_types_by_slug(dbm, [slug]).get(slug)
+    if ddtype is None:
         raise DataObjectNotFound("DataDictType", "slug", slug)
-    assert len(rows) == 1, "More than one item found for slug %s" % (slug,)
+    return ddtype
+
 
-    #  include_docs = 'true' returns the doc as a dict, which has to be wrapped into a DataDictDocument, and then into a DataDictType
-    _doc = DataDictDocument.wrap(rows[0].doc)
-    return DataDictType.new_from_doc(dbm, _doc)
+def get_datadict_types_by_slug(dbm, slugs):
+    """
+    Returns a dict of the given slugs to their DataDictTypes, leaving out missing ones. The slugs that
+    are not cached yet are read with one multi-key view request.
+    """
+    assert isinstance(dbm, DatabaseManager)
+    assert is_sequence(slugs)
+    cache = slug_cache(dbm)
+    ids = [cache.get(slug) for slug in set(slugs)]
+    ddtypes = dict((ddtype.slug, ddtype) for ddtype in get_datadict_types(dbm, [id for id in ids if id is not None]))
+    missing = [slug for slug in set(slugs) if slug not in ddtypes]
+    if missing:
+        rows = dbm.load_all_rows_in_view('by_datadict_type', keys=missing, include_docs='true')
+        for row in rows:
+            #  include_docs = 'true' returns the doc as a dict, which has to be wrapped into a DataDictDocument, and then into a DataDictType
+            ddtype = DataDictType.new_from_doc(dbm, DataDictDocument.wrap(row.doc))
+            assert ddtype.slug not in ddtypes, "More than one item found for slug %s" % (ddtype.slug,)
+            ddtypes[ddtype.slug] = ddtype
+            _remember(dbm, ddtype)
+    return ddtypes
 
 
 def get_datadict_types(dbm, ids):
+    """
+    Returns the DataDictTypes with the given ids, leaving out missing ones. Only those that are not
+    cached yet are read, with one get_many request.
+    """
     assert isinstance(dbm, DatabaseManager)
-    return dbm.get_many(ids, DataDictType)
+    assert is_sequence(ids)
+    cache = datadict_cache(dbm)
+    documents = dict((id, cache.get(id)) for id in set(ids))
+    missing = [id for id, json in documents.items() if json is None]
+    if missing:
+        for ddtype in dbm.get_many(missing, DataDictType):
+            documents[ddtype.id] = ddtype.to_json()
+            cache.put(ddtype.id, copy.deepcopy(documents[ddtype.id]))
+    return [_from_json(dbm, documents[id]) for id in ids if documents.get(id) is not None]
+
+
+def _from_json(dbm, json):
+    # DataDictTypes can be edited by their callers, so every caller gets its own copy
+    return DataDictType.new_from_doc(dbm, DataDictDocument.wrap(copy.deepcopy(json)))
 
 
 def create_datadict_type(dbm, name, slug, primitive_type, description=None, constraints=None, tags=None):
@@ -37,11 +113,28 @@ def create_datadict_type(dbm, name, slug, primitive_type, description=None, cons
 
 
 def get_or_create_data_dict(dbm, name, slug, primitive_type, description=None, constraints=None, tags=None):
-    try:
-        return get_datadict_type_by_slug(dbm, slug)
-    except DataObjectNotFound:
-        pass
-    return create_datadict_type(dbm, name, slug, primitive_type, description, constraints, tags)
+    return get_or_create_data_dicts(dbm, [dict(name=name, slug=slug, primitive_type=primitive_type,
+                                               description=description, constraints=constraints, tags=tags)])[0]
+
+
+def get_or_create_data_dicts(dbm, data_dicts):
+    """
+    Returns a DataDictType for each dict of get_or_create_data_dict arguments in data_dicts. The existing
+    ones are read with one view request and the missing ones are created with one bulk save.
+    """
+    ddtypes = get_datadict_types_by_slug(dbm, [data_dict['slug'] for data_dict in data_dicts])
+    created = OrderedDict()
+    for data_dict in data_dicts:
+        if data_dict['slug'] not in ddtypes and data_dict['slug'] not in created:
+            created[data_dict['slug']] = DataDictType(dbm, **data_dict)
+    if created:
+        for success, id, rev_or_exception in dbm._save_documents([ddtype._doc for ddtype in created.values()]):
+            if not success:
+                raise FailedToSaveDataObject(str(rev_or_exception))
+        for ddtype in created.values():
+            _remember(dbm, ddtype)
+        ddtypes.update(created)
+    return [ddtypes[data_dict['slug']] for data_dict in data_dicts]
 
 
 class DataDictType(DataObject):
@@ -104,6 +197,17 @@ class DataDictType(DataObject):
     def to_json(self):
         return self._doc.unwrap()
 
+    def save(self):
+        result = DataObject.save(self)
+        datadict_cache(self._dbm).invalidate(self.id)
+        slug_cache(self._dbm).put(self.slug, self.id)
+        return result
+
+    def delete(self):
+        DataObject.delete(self)
+        datadict_cache(self._dbm).invalidate(self.id)
+        slug_cache(self._dbm).invalidate(self.slug)
+
     @classmethod
     def create_from_json(cls, json, dbm):
         doc = DataDictDocument.wrap(json)
@@ -1,6 +1,6 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
-from couchdb.mapping import TextField, Document, DateTimeField, DictField, BooleanField, ListField, FloatField
+from couchdb.mapping import TextField, Document, DateTimeField, DictField, BooleanField, ListField, FloatField, IntegerField
 import datetime
 import calendar
 from uuid import uuid1
@@ -251,3 +251,58 @@ class AggregationTreeDocument(DocumentBase):
 
         if root is None:
             self.root = {}
+
+
+class ShortCodeCounterDocument(DocumentBase):
+    """
+    Holds the next short code number to hand out for an entity type.
+    """
+    entity_type = TextField()
+    next_number = IntegerField()
+
+    def __init__(self, id=None, entity_type=None, next_number=None):
+        DocumentBase.__init__(self, id=id, document_type='ShortCodeCounter')
+        self.entity_type = entity_type
+        self.next_number = next_number
+
+
+class PeriodRollupDocument(DocumentBase):
+    """
+    The aggregates of one form's data records for one period: stats and latest hold, per entity short
+    code and field, what the period's stats and latest views give for the group, and summaries the
+    JSON of its Summary. seq is the last change reflected, and stale is set when the document could
+    not be brought up to date exactly.
+    """
+    period = TextField()
+    period_key = ListField(IntegerField())
+    form_code = TextField()
+    entity_type = ListField(TextField())
+    stats = DictField()
+    latest = DictField()
+    summaries = DictField()
+    seq = IntegerField()
+    stale = BooleanField()
+
+    def __init__(self, id=None, period=None, period_key=None, form_code=None, entity_type=None):
+        DocumentBase.__init__(self, id=id, document_type='PeriodRollup')
+        self.period = period
+        self.period_key = period_key
+        self.form_code = form_code
+        self.entity_type = entity_type
+        self.stats = {}
+        self.latest = {}
+        self.summaries = {}
+        self.seq = 0
+        self.stale = False
+
+
+class RollupCheckpointDocument(DocumentBase):
+    """
+    How far the period rollups have read the _changes feed, and the rollups still to rebuild.
+    """
+    seq = IntegerField()
+    stale = ListField(TextField())
+
+    def __init__(self, id=None, seq=0):
+        DocumentBase.__init__(self, id=id, document_type='RollupCheckpoint')
+        self.seq = seq
@@ -2,16 +2,23 @@
 
 import copy
 from datetime import datetime
+from functools import partial
 from collections import defaultdict
 from documents import EntityDocument, DataRecordDocument, attributes
 from datadict import DataDictType, get_datadict_types
 from mangrove.datastore.entity_type import entity_type_already_defined
-from mangrove.errors.MangroveException import  DataObjectAlreadyExists, EntityTypeDoesNotExistsException, DataObjectNotFound
+from couchdb.http import ResourceConflict
+from mangrove.datastore import summaries
+from mangrove.errors.MangroveException import  DataObjectAlreadyExists, EntityTypeDoesNotExistsException, DataObjectNotFound, FailedToSaveDataObject,\
+    AggregationNotSupportedForTypeException
 from mangrove.utils.types import is_empty
 from mangrove.utils.types import is_not_empty, is_sequence, is_string
+from mangrove.utils.concurrency import run_concurrently
 from mangrove.utils.dates import utcnow, convert_date_time_to_epoch
 from database import DatabaseManager, DataObject
 
+ENTITY_SAVE_ATTEMPTS = 3
+
 def void_entity(dbm, entity_type, short_code):
     if is_string(entity_type):
         entity_type = [entity_type]
@@ -129,8 +136,73 @@ def get_entities_by_value(dbm, label, value, as_of=None):
 
     rows = dbm.load_all_rows_in_view(u'by_label_value', key=[label, value])
     entities = dbm.get_many([row[u'value'] for row in rows], Entity)
+    latest = get_latest_values(dbm, [e.id for e in entities], [label], as_of)
+
+    return [e for e in entities if latest[e.id] == {label: value}]
+
+
+_AGGREGATED_FUNCTIONS = (u'latest', u'sum', u'count', u'average', u'min', u'max')
+
+
+def _aggregate_value(aggregate_fn, aggregated):
+    """
+    Returns the value of aggregate_fn from what aggregates_by_entity_field reduces the rows of a field to,
+    None if the field has no data, or no numbers for a numeric function.
+    """
+    if aggregate_fn == u'count':
+        return aggregated[u'count'] if aggregated is not None else 0
+    if aggregated is None:
+        return None
+    if aggregate_fn == u'latest':
+        return aggregated[u'latest']
+    if not aggregated[u'count']:
+        return None
+    if aggregate_fn == u'average':
+        return float(aggregated[u'sum']) / aggregated[u'count']
+    return aggregated[aggregate_fn]
+
+
+def _aggregate_recorded(field, aggregate_fn, recorded):
+    """Applies the summary aggregate_fn to the {timestamp, value} dicts recorded for field."""
+    if not summaries.is_summary_function(aggregate_fn):
+        raise AggregationNotSupportedForTypeException(field, aggregate_fn)
+    return summaries.summarize(value[u'value'] for value in recorded).get(aggregate_fn) if recorded else None
+
+
+def get_latest_values(dbm, entity_ids, fields, as_of=None):
+    """
+    Returns {entity id: {field: latest value}} of the data recorded for the entities up to as_of, now by
+    default, with None for the fields without data.
+
+    The latest value of every entity and field is read with one multi-key request. Only the pairs whose
+    latest value was recorded after as_of need another request each, made concurrently, for the reduced
+    range of their rows up to as_of.
+    """
+    assert isinstance(dbm, DatabaseManager)
+    assert is_sequence(entity_ids) and is_sequence(fields)
+    as_of = convert_date_time_to_epoch(as_of or utcnow())
+    values = dict((entity_id, dict.fromkeys(fields)) for entity_id in entity_ids)
+    keys = [[entity_id, field] for entity_id in values for field in fields]
+    if not keys:
+        return values
+
+    later = []
+    for row in dbm.load_all_rows_in_view(u'latest_by_entity_field', keys=keys, group=True):
+        if row[u'value'][u'timestamp'] <= as_of:
+            values[row.key[0]][row.key[1]] = row[u'value'][u'latest']
+        else:
+            later.append(row.key)
+    loaded = run_concurrently([partial(_load_aggregated, dbm, entity_id, field, as_of) for entity_id, field in later])
+    for (entity_id, field), aggregated in zip(later, loaded):
+        values[entity_id][field] = _aggregate_value(u'latest', aggregated)
+    return values
 
-    return [e for e in entities if e.values({label: u'latest'}, asof=as_of) == {label: value}]
+
+def _load_aggregated(dbm, entity_id, field, time_since_epoch_of_date):
+    """Returns the latest value and stats of the rows of field up to the time, or None if there are none."""
+    rows = dbm.load_all_rows_in_view(u'aggregates_by_entity_field', startkey=[entity_id, field],
+                                     endkey=[entity_id, field, time_since_epoch_of_date])
+    return rows[0][u'value'] if rows else None
 
 def entities_exists_with_value(dbm, entity_type, label, value):
     """
@@ -288,34 +360,68 @@ class Entity(DataObject):
         # init?
         if event_time is None:
             event_time = utcnow()
-        for (label, value, dd_type) in data:
-            if not isinstance(dd_type, DataDictType) or is_empty(label):
-                raise ValueError(u'Data must be of the form (label, value, DataDictType).')
-        self.update_latest_data(data=data)
+        _check_data(data)
+        self._set_latest_data(data)
         if multiple_records:
-            data_list = []
-            for (label, value, dd_type) in data:
-                data_record = DataRecordDocument(
-                    entity_doc=self._doc,
-                    event_time=event_time,
-                    data=[(label, value, dd_type)],
-                    submission=submission
-                )
-                data_list.append(data_record)
-            return self._dbm._save_documents(data_list)
+            data_list = [DataRecordDocument(entity_doc=self._doc, event_time=event_time, data=[item],
+                                            submission=submission) for item in data]
         else:
-            data_record_doc = DataRecordDocument(
-                entity_doc=self._doc,
-                event_time=event_time,
-                data=data,
-                submission=submission
-            )
-            return self._dbm._save_document(data_record_doc)
+            data_list = [DataRecordDocument(entity_doc=self._doc, event_time=event_time, data=data,
+                                            submission=submission)]
+        # the entity and its data records go in one bulk request; only the entity can conflict
+        # with a concurrent writer, so only the entity is retried.
+        results = self._dbm._save_documents([self._doc] + data_list)
+        try:
+            if not results[0][0]:
+                self._retry_latest_data(data, results[0])
+            failed = [result for result in results[1:] if not result[0]]
+            if failed:
+                raise FailedToSaveDataObject(str(failed[0]))
+        except FailedToSaveDataObject:
+            self._void_saved_records(data_list, results[1:])
+            raise
+        if multiple_records:
+            return results[1:]
+        return results[1][1]
+
+    def _retry_latest_data(self, data, result):
+        for attempt in range(ENTITY_SAVE_ATTEMPTS):
+            if not isinstance(result[2], ResourceConflict):
+                break
+            self._set_document(self._dbm._load_document(self.id, EntityDocument))
+            self._set_latest_data(data)
+            result = self._dbm._save_documents([self._doc])[0]
+            if result[0]:
+                return
+        raise FailedToSaveDataObject(str(result))
+
+    def _void_saved_records(self, data_list, results):
+        """Voids the data records of a failed add_data that did get saved, so that no aggregate counts them."""
+        saved = [record for record, result in zip(data_list, results) if result[0]]
+        for record in saved:
+            record.void = True
+        if saved:
+            self._dbm._save_documents(saved)
 
     def update_latest_data(self, data):
+        self._set_latest_data(data)
+        self.save()
+
+    def _set_latest_data(self, data):
         for (label, value, dd_type) in data:
             self.data[label] = {'value': value, 'type': dd_type._doc.unwrap()}
-        self.save()
+
+    def _new_data_record(self, data, event_time=None, submission=None):
+        """
+        Applies data to the latest values held on this entity, without saving it, and returns
+        an unsaved DataRecordDocument for it. Used to write many data records in one bulk save.
+        """
+        assert is_sequence(data)
+        assert event_time is None or isinstance(event_time, datetime)
+        _check_data(data)
+        self._set_latest_data(data)
+        return DataRecordDocument(entity_doc=self._doc, event_time=event_time or utcnow(), data=data,
+                                  submission=submission)
 
     def invalidate_data(self, uid):
         """
@@ -331,12 +437,12 @@ class Entity(DataObject):
     def invalidate(self):
         """
         Mark the entity as invalid.
-        This will also mark all associated data records as invalid.
+        This will also mark all associated data records as invalid, in
+        bulk, and returns the number of records that were voided.
         """
         self._doc.void = True
         self.save()
-        for id in self._get_data_ids():
-            self.invalidate_data(id)
+        return self._dbm.void_documents(self._get_data_ids())
 
 
 
@@ -364,11 +470,12 @@ class Entity(DataObject):
         else:
             if is_string(tags):
                 tags = [tags]
-            keys = []
-            for tag in tags:
-                rows = self._dbm.load_all_rows_in_view(u'entity_datatypes_by_tag', key=[self.id, tag])
-                keys.append([row[u'value'] for row in rows])
-            ids_with_all_tags = list(set.intersection(*map(set, keys)))
+            ids_by_tag = dict((tag, set()) for tag in tags)
+            rows = self._dbm.load_all_rows_in_view(u'entity_datatypes_by_tag',
+                                                   keys=[[self.id, tag] for tag in ids_by_tag])
+            for row in rows:
+                ids_by_tag[row.key[1]].add(row[u'value'])
+            ids_with_all_tags = list(set.intersection(*ids_by_tag.values()))
             result = get_datadict_types(self._dbm, ids_with_all_tags)
         return result
 
@@ -399,41 +506,56 @@ class Entity(DataObject):
         Eg: aggregation_rules={'arv':'latest', 'num_patients':'sum'}
         will return latest value for arv and sum the number of
         patients.
-        """
-        # todo: I think we need to simplify this method a bit and
-        # expose some of the ViewResults goodness.
-        asof = asof or utcnow()
-        result = {}
-        for field, aggregate_fn in aggregation_rules.items():
-            view_name = self._translate(aggregate_fn)
-            result[field] = self._get_aggregate_value(field, view_name, asof)
+        The functions are latest, sum, count, average, min, max and the
+        median, count_distinct and percentile ('p90') ones of
+        data.reduce_functions. Fields without data give None, or a
+        count of 0. For the current values, the latest value and stats of
+        every field are read with one request over the entity's rows of
+        aggregates_by_entity_field; only the fields with data recorded
+        after asof, all of them for a past asof, are then read with one
+        range per field ending at asof. The fields of the summary
+        functions are read from their recorded values.
+        """
+        time_since_epoch_of_date = convert_date_time_to_epoch(asof or utcnow())
+        aggregated_fields = [field for field, aggregate_fn in aggregation_rules.items()
+                             if aggregate_fn in _AGGREGATED_FUNCTIONS]
+        recorded_fields = [field for field in aggregation_rules if field not in aggregated_fields]
+
+        aggregated, later = {}, aggregated_fields
+        if asof is None and aggregated_fields:
+            rows = self._dbm.load_all_rows_in_view(u'aggregates_by_entity_field', group_level=2,
+                                                   startkey=[self.id], endkey=[self.id, {}])
+            aggregated = dict((row.key[1], row[u'value']) for row in rows if row.key[1] in aggregation_rules)
+            later = [field for field in aggregated_fields
+                     if field in aggregated and aggregated[field][u'timestamp'] > time_since_epoch_of_date]
+
+        loads = [partial(_load_aggregated, self._dbm, self.id, field, time_since_epoch_of_date) for field in later]
+        if recorded_fields:
+            loads.append(partial(self._load_recorded, recorded_fields, time_since_epoch_of_date))
+        loaded = run_concurrently(loads)
+        aggregated.update(zip(later, loaded))
+
+        result = dict((field, _aggregate_value(aggregation_rules[field], aggregated.get(field)))
+                      for field in aggregated_fields)
+        if recorded_fields:
+            recorded = loaded[-1]
+            result.update((field, _aggregate_recorded(field, aggregation_rules[field], recorded[field]))
+                          for field in recorded_fields)
         return result
 
+    def _load_recorded(self, fields, time_since_epoch_of_date):
+        """Returns {field: [{timestamp, value}]} of the values recorded for fields up to the time."""
+        recorded = defaultdict(list)
+        rows = self._dbm.load_all_rows_in_view(u'latest_by_entity_field', reduce=False,
+                                               keys=[[self.id, field] for field in fields])
+        for row in rows:
+            if row[u'value'][u'timestamp'] <= time_since_epoch_of_date:
+                recorded[row.key[1]].append(row[u'value'])
+        return recorded
+
     def latest_values(self):
         return {field_name:values['value'] for field_name,values in self.data.items()}
 
-    def _get_aggregate_value(self, field, aggregate_fn, date):
-        entity_id = self._doc.id
-        time_since_epoch_of_date = convert_date_time_to_epoch(date)
-        rows = self._dbm.load_all_rows_in_view(aggregate_fn, group_level=3, descending=False,
-                                               startkey=[self.type_path, entity_id, field],
-                                               endkey=[self.type_path, entity_id, field, time_since_epoch_of_date])
-
-        # The above will return rows in the format described:
-        # Row key=['clinic', 'e4540e0ae93042f4b583b54b6fa7d77a'],
-        #   value={'beds': {'timestamp_for_view': 1420070400000, 'value': '15'},
-        #           'entity_id': {'value': 'e4540e0ae93042f4b583b54b6fa7d77a'}, 'document_type': {'value': 'Entity'},
-        #           'arv': {'timestamp_for_view': 1420070400000, 'value': '100'}, 'entity_type': {'value': 'clinic'}
-        #           }
-        #  The aggregation map-reduce view will return only one row for an entity-id
-        # From this we return the field we are interested in.
-        # TODO: Hardcoding to 'latest' for now. Generalize to any aggregation function.
-        return rows[0][u'value'][u'latest'] if len(rows) else None
-
-    def _translate(self, aggregate_fn):
-        view_names = {u"latest": u"by_values_latest_by_time"}
-        return view_names[aggregate_fn] if aggregate_fn in view_names else aggregate_fn
-
     def _get_data_ids(self):
         """
         Returns a list of all data documents ids for this entity.
@@ -503,6 +625,30 @@ class DataRecord(DataObject):
         return self._doc.void
 
 
+def _check_data(data):
+    for (label, value, dd_type) in data:
+        if not isinstance(dd_type, DataDictType) or is_empty(label):
+            raise ValueError(u'Data must be of the form (label, value, DataDictType).')
+
+
+def get_by_short_codes(dbm, keys):
+    """
+    Finds the entities for many (entity_type, short_code) pairs with a single view query.
+    Returns a dict keyed by (tuple(entity_type), short_code); pairs with no entity are left out.
+    """
+    if is_empty(keys):
+        return {}
+    rows = dbm.load_all_rows_in_view('by_short_codes', keys=[[list(entity_type), short_code.lower()]
+                                                              for entity_type, short_code in keys],
+                                     reduce=False, include_docs=True)
+    entities = {}
+    for row in rows:
+        entity_type, short_code = row.key
+        entities.setdefault((tuple(entity_type), short_code),
+                            Entity.new_from_doc(dbm, EntityDocument.wrap(row['doc'])))
+    return entities
+
+
 def _check_if_entity_exists(dbm, entity_type, short_code):
     try:
         get_by_short_code_include_voided(dbm, short_code, entity_type)
@@ -538,9 +684,16 @@ def _make_short_code(entity_type, num):
     return   SHORT_CODE_FORMAT % (entity_prefix, num)
 
 
+def iter_all_entities(dbm):
+    """
+    Yields all the non voided entities in the Database, fetching them a page at a time
+    """
+    rows = dbm.iter_view_rows(u'by_short_codes', reduce=False, include_docs=True)
+    for row in rows:
+        yield _from_row_to_entity(dbm, row)
+
 def _get_all_entities(dbm):
-    rows= dbm.view.by_short_codes(reduce=False, include_docs=True)
-    return [_from_row_to_entity(dbm, row) for row in rows]
+    return list(iter_all_entities(dbm))
 
 def _get_all_entities_of_type(dbm, entity_type):
     startkey = [entity_type]
@@ -0,0 +1,98 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from collections import deque
+import math
+from threading import Lock
+from mangrove.utils.json_codecs import encode_json
+
+
+class Operations(object):
+    """Constants for the kinds of database calls reported to observers."""
+    VIEW = "view"
+    BULK_SAVE = "bulk_save"
+    GET = "get"
+    GET_MANY = "get_many"
+    DELETE = "delete"
+    CHANGES = "changes"
+    INFO = "info"
+
+
+class QueryEvent(object):
+    """
+    Describes one round-trip to the database, as passed to the observers registered with
+    DatabaseManager.add_observer.
+
+    name is the view name for view queries and the document id (or None) for document calls.
+    elapsed is the wall time of the call in seconds and size the approximate number of bytes
+    of JSON that were read or written.
+    """
+
+    def __init__(self, operation, name, params, row_count, size, elapsed):
+        self.operation = operation
+        self.name = name
+        self.params = params
+        self.row_count = row_count
+        self.size = size
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return "<QueryEvent %s %s rows=%s bytes=%s elapsed=%.6f>" % (self.operation, self.name, self.row_count,
+                                                                     self.size, self.elapsed)
+
+
+def json_size(data):
+    try:
+        return len(encode_json(data))
+    except TypeError:
+        return None
+
+
+def _percentile(sorted_samples, percent):
+    if not sorted_samples:
+        return None
+    index = int(math.ceil(percent / 100.0 * len(sorted_samples))) - 1
+    return sorted_samples[max(index, 0)]
+
+
+class QueryStatistics(object):
+    """
+    An observer that keeps call counts, rows, bytes and latency percentiles per operation and view.
+
+    Register it with dbm.add_observer(statistics) and read statistics.summary(). Only the latest
+    max_samples timings of each view are kept for the percentiles.
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._lock = Lock()
+        self._stats = {}
+
+    def __call__(self, event):
+        key = (event.operation, event.name if event.operation == Operations.VIEW else None)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = dict(count=0, rows=0, bytes=0, total_time=0.0,
+                                                samples=deque(maxlen=self.max_samples))
+            stats['count'] += 1
+            stats['rows'] += event.row_count or 0
+            stats['bytes'] += event.size or 0
+            stats['total_time'] += event.elapsed
+            stats['samples'].append(event.elapsed)
+
+    def summary(self):
+        """
+        Returns a dict keyed by "operation" or "view:<view name>" with count, rows, bytes,
+        total_time and the p50, p95 and p99 latencies in seconds.
+        """
+        with self._lock:
+            snapshot = [(key, dict(stats), sorted(stats['samples'])) for key, stats in self._stats.items()]
+        result = {}
+        for (operation, name), stats, samples in snapshot:
+            del stats['samples']
+            stats.update(p50=_percentile(samples, 50), p95=_percentile(samples, 95), p99=_percentile(samples, 99))
+            result[operation if name is None else "%s:%s" % (operation, name)] = stats
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
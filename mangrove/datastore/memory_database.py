@@ -0,0 +1,409 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+An in-process stand in for the parts of couchdb.client.Server and couchdb.client.Database that
+DatabaseManager uses, so that mangrove can run without a CouchDB server.
+
+DatabaseManager uses it for server urls starting with memory://. Documents, bulk updates,
+_all_docs, the _changes feed and the views in bootstrap/views are supported; the views run the Python
+equivalents registered in memory_views instead of their JavaScript. Querying a view that has
+no Python equivalent raises ResourceNotFound, like querying a view that CouchDB does not have.
+"""
+from bisect import bisect_left, insort
+import json
+from threading import RLock
+from uuid import uuid4
+from couchdb import json as couch_json
+from couchdb.client import Document, Row
+from couchdb.http import ResourceConflict, ResourceNotFound, ServerError, PreconditionFailed
+from mangrove.datastore import memory_views
+
+MEMORY_URL_SCHEME = "memory://"
+
+_servers = {}
+_servers_lock = RLock()
+
+
+def memory_server(url):
+    """
+    Returns the MemoryServer for url, so that every DatabaseManager given the same url shares its databases.
+    """
+    with _servers_lock:
+        if url not in _servers:
+            _servers[url] = MemoryServer()
+        return _servers[url]
+
+
+class MemoryServer(object):
+    def __init__(self):
+        self._databases = {}
+        self._lock = RLock()
+
+    def __contains__(self, name):
+        return name in self._databases
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                raise ResourceNotFound(('not_found', 'no_db_file'))
+            return self._databases[name]
+
+    def __delitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                raise ResourceNotFound(('not_found', 'missing'))
+            del self._databases[name]
+
+    def create(self, name):
+        with self._lock:
+            if name in self._databases:
+                raise PreconditionFailed(('file_exists', 'The database could not be created, the file already exists.'))
+            self._databases[name] = MemoryDatabase(name)
+            return self._databases[name]
+
+
+class MemoryDatabase(object):
+    def __init__(self, name):
+        self.name = name
+        self.resource = _MemoryResource(self)
+        self._docs = {}
+        self._indexes = {}
+        self._seq = 0
+        self._change_log = {}
+        self._lock = RLock()
+
+    def __contains__(self, id):
+        return id in self._docs
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __getitem__(self, id):
+        doc = self.get(id)
+        if doc is None:
+            raise ResourceNotFound(('not_found', 'missing'))
+        return doc
+
+    def __delitem__(self, id):
+        with self._lock:
+            doc = self[id]
+            self.delete(doc)
+
+    def get(self, id, default=None, **options):
+        with self._lock:
+            doc = self._docs.get(id)
+            return Document(_to_client(doc)) if doc is not None else default
+
+    def save(self, doc, **options):
+        with self._lock:
+            if '_id' not in doc:
+                doc['_id'] = uuid4().hex
+            success, id, rev_or_exception = self._store(doc)
+            if not success:
+                raise rev_or_exception
+            doc['_rev'] = rev_or_exception
+            return id, rev_or_exception
+
+    def update(self, documents, **options):
+        docs = []
+        for doc in documents:
+            if isinstance(doc, dict):
+                docs.append(doc)
+            elif hasattr(doc, 'items'):
+                docs.append(dict(doc.items()))
+            else:
+                raise TypeError('expected dict, got %s' % type(doc))
+        results = []
+        with self._lock:
+            for doc, original in zip(docs, documents):
+                if '_id' not in doc:
+                    doc['_id'] = uuid4().hex
+                result = self._store(doc)
+                if result[0] and isinstance(original, dict):
+                    original.update({'_id': result[1], '_rev': result[2]})
+                results.append(result)
+        return results
+
+    def delete(self, doc):
+        with self._lock:
+            stored = self._docs.get(doc['_id'])
+            if stored is None:
+                raise ResourceNotFound(('not_found', 'missing'))
+            if stored['_rev'] != doc['_rev']:
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+            del self._docs[doc['_id']]
+            self._changed(doc['_id'], _next_revision(stored), deleted=True)
+
+    def info(self):
+        with self._lock:
+            return dict(db_name=self.name, doc_count=len(self._docs), update_seq=self._seq)
+
+    def changes(self, **options):
+        """
+        Returns the _changes feed as a dict of results and last_seq: the latest change of every
+        document changed after since, in sequence order. Only the normal feed is supported.
+        """
+        since = int(options.get('since', 0))
+        with self._lock:
+            entries = sorted((seq, id, rev, deleted) for id, (seq, rev, deleted) in self._change_log.items()
+                             if seq > since)
+            if 'limit' in options:
+                entries = entries[:int(options['limit'])]
+            results = []
+            for seq, id, rev, deleted in entries:
+                result = dict(seq=seq, id=id, changes=[dict(rev=rev)])
+                if deleted:
+                    result['deleted'] = True
+                if _flag(options.get('include_docs')):
+                    result['doc'] = dict(_id=id, _rev=rev, _deleted=True) if deleted else _to_client(self._docs[id])
+                results.append(result)
+            return dict(results=results, last_seq=entries[-1][0] if entries else since)
+
+    def view(self, name, wrapper=None, **options):
+        for name_of_key in ('key', 'keys', 'startkey', 'endkey'):
+            if name_of_key in options:
+                options[name_of_key] = _from_client(options[name_of_key])
+        with self._lock:
+            if name == '_all_docs':
+                rows = self._all_docs(options)
+            else:
+                rows = self._query(name, options)
+        return MemoryViewResults(rows, wrapper)
+
+    def _store(self, doc):
+        id = doc['_id']
+        stored = self._docs.get(id)
+        if doc.get('_deleted') and stored is None:
+            return False, id, ResourceNotFound(('not_found', 'missing'))
+        if (stored['_rev'] if stored is not None else None) != doc.get('_rev'):
+            return False, id, ResourceConflict('Document update conflict.')
+        if doc.get('_deleted'):
+            rev = _next_revision(stored)
+            del self._docs[id]
+            self._changed(id, rev, deleted=True)
+            return True, id, rev
+        try:
+            stored = _from_client(doc)
+        except TypeError, exception:
+            return False, id, ServerError(str(exception))
+        stored['_rev'] = _next_revision(self._docs.get(id))
+        self._docs[id] = stored
+        self._changed(id, stored['_rev'])
+        return True, id, stored['_rev']
+
+    def _changed(self, id, rev, deleted=False):
+        self._seq += 1
+        self._change_log[id] = (self._seq, rev, deleted)
+        for index in self._indexes.values():
+            index.invalidate(id)
+
+    def _all_docs(self, options):
+        include_docs = _flag(options.get('include_docs'))
+        if 'keys' in options:
+            rows = []
+            for id in options['keys']:
+                doc = self._docs.get(id)
+                if doc is None:
+                    rows.append(Row(key=id, error='not_found'))
+                else:
+                    rows.append(self._all_docs_row(doc, include_docs))
+            return rows
+        entries = [(id, id, 0, None) for id in sorted(self._docs)]
+        entries = _select(entries, options, lambda key: key, use_doc_ids=False)
+        return [self._all_docs_row(self._docs[id], include_docs) for sort_key, id, seq, value in entries]
+
+    def _all_docs_row(self, doc, include_docs):
+        row = Row(id=doc['_id'], key=doc['_id'], value={'rev': doc['_rev']})
+        if include_docs:
+            row['doc'] = _to_client(doc)
+        return row
+
+    def _query(self, name, options):
+        design, view_name = name.split('/', 1)
+        design_doc = self._docs.get('_design/%s' % design)
+        if design_doc is None or view_name not in design_doc.get('views', {}):
+            raise ResourceNotFound(('not_found', 'missing_named_view'))
+        map_function, reduce_function = memory_views.python_view(view_name)
+        index = self._indexes.get(name)
+        if index is None or index.map_function is not map_function:
+            index = self._indexes[name] = _ViewIndex(map_function, self._docs)
+        index.refresh(self._docs)
+
+        reduce = _flag(options.get('reduce', True)) and reduce_function is not None
+        if reduce and _flag(options.get('include_docs')):
+            raise ServerError((400, ('query_parse_error', '`include_docs` is invalid for reduce')))
+        if 'keys' in options:
+            if reduce and not (_flag(options.get('group')) or 'group_level' in options):
+                raise ServerError((400, ('query_parse_error', 'Multi-key fetches for reduce views must use `group=true`')))
+            rows = []
+            for key in options['keys']:
+                key_options = dict((k, v) for k, v in options.items() if k not in ('keys', 'skip', 'limit'))
+                key_options['key'] = key
+                rows.extend(self._view_rows(index, reduce_function if reduce else None, key_options))
+            return _skip_and_limit(rows, options)
+        return _skip_and_limit(self._view_rows(index, reduce_function if reduce else None, options), options)
+
+    def _view_rows(self, index, reduce_function, options):
+        entries = _select(index.rows, options, memory_views.collation_key, use_doc_ids=reduce_function is None)
+        if reduce_function is not None:
+            return _reduce(entries, reduce_function, options)
+        include_docs = _flag(options.get('include_docs'))
+        rows = []
+        for sort_key, id, seq, (key, value) in entries:
+            row = Row(id=id, key=_to_client(key), value=_to_client(value))
+            if include_docs:
+                doc = self._docs.get(id)
+                row['doc'] = _to_client(doc)
+            rows.append(row)
+        return rows
+
+
+class MemoryViewResults(object):
+    def __init__(self, rows, wrapper=None):
+        self.rows = [wrapper(row) for row in rows] if wrapper is not None else rows
+        self.total_rows = len(rows)
+        self.offset = 0
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class _MemoryResource(object):
+    def __init__(self, database):
+        self.database = database
+
+    def head(self, id):
+        doc = self.database._docs.get(id)
+        if doc is None:
+            raise ResourceNotFound(('not_found', 'missing'))
+        return 200, {'etag': '"%s"' % doc['_rev']}, None
+
+
+class _ViewIndex(object):
+    """
+    The sorted (collation key, doc id, sequence, (key, value)) entries a view emits, kept up to date
+    incrementally: a write only marks its document as stale, and stale documents are mapped again
+    on the next query.
+    """
+
+    def __init__(self, map_function, docs):
+        self.map_function = map_function
+        self.rows = []
+        self._emitted = {}
+        self._stale = set(docs)
+
+    def invalidate(self, id):
+        self._stale.add(id)
+
+    def refresh(self, docs):
+        for id in self._stale:
+            for entry in self._emitted.pop(id, []):
+                del self.rows[bisect_left(self.rows, entry[:3])]
+            doc = docs.get(id)
+            if doc is None:
+                continue
+            entries = [(memory_views.collation_key(key), id, seq, (key, value))
+                       for seq, (key, value) in enumerate(memory_views.run_map(self.map_function, doc))]
+            for entry in entries:
+                insort(self.rows, entry)
+            self._emitted[id] = entries
+        self._stale = set()
+
+
+class _High(object):
+    """Sorts after every doc id and sequence number."""
+
+    def __cmp__(self, other):
+        return 0 if isinstance(other, _High) else 1
+
+_HIGH = _High()
+
+
+def _select(entries, options, collation_key, use_doc_ids=True):
+    """
+    Returns the (collation key, doc id, sequence, payload) entries between the start and end keys
+    of a query, in the order the query asks for.
+    """
+    descending = _flag(options.get('descending'))
+    if 'key' in options:
+        options = dict(options, startkey=options['key'], endkey=options['key'])
+        options.pop('startkey_docid', None)
+        options.pop('endkey_docid', None)
+    if not use_doc_ids:
+        options = dict((name, value) for name, value in options.items() if not name.endswith('_docid'))
+    low_key, high_key = ('endkey', 'startkey') if descending else ('startkey', 'endkey')
+    low_docid, high_docid = ('endkey_docid', 'startkey_docid') if descending else ('startkey_docid', 'endkey_docid')
+
+    start, end = 0, len(entries)
+    if low_key in options:
+        low = (collation_key(options[low_key]), options[low_docid]) if low_docid in options else\
+              (collation_key(options[low_key]),)
+        start = bisect_left(entries, low)
+    if high_key in options:
+        if high_docid in options:
+            high = (collation_key(options[high_key]), options[high_docid], _HIGH)
+        elif descending or _flag(options.get('inclusive_end', True)):
+            high = (collation_key(options[high_key]), _HIGH)
+        else:
+            high = (collation_key(options[high_key]),)
+        end = max(start, bisect_left(entries, high))
+    selected = entries[start:end]
+    if descending:
+        selected.reverse()
+    return selected
+
+
+def _reduce(entries, reduce_function, options):
+    group_level = options.get('group_level')
+    if group_level is None and _flag(options.get('group')):
+        group_level = 'exact'
+    groups = []
+    for sort_key, id, seq, (key, value) in entries:
+        group_key = _group_key(key, group_level)
+        if groups and groups[-1][0] == group_key:
+            groups[-1][1].append([key, id])
+            groups[-1][2].append(value)
+        else:
+            groups.append((group_key, [[key, id]], [value]))
+    if group_level is None and not groups:
+        return []
+    return [Row(key=_to_client(group_key), value=_to_client(reduce_function(keys, values)))
+            for group_key, keys, values in groups]
+
+
+def _group_key(key, group_level):
+    if group_level is None:
+        return None
+    if group_level == 'exact' or not isinstance(key, list):
+        return key
+    return key[:int(group_level)]
+
+
+def _skip_and_limit(rows, options):
+    skip = int(options.get('skip', 0))
+    if 'limit' in options:
+        return rows[skip:skip + int(options['limit'])]
+    return rows[skip:]
+
+
+def _flag(value):
+    return value is True or value == 'true'
+
+
+def _next_revision(stored):
+    number = int(stored['_rev'].split('-')[0]) + 1 if stored is not None else 1
+    return "%d-%s" % (number, uuid4().hex)
+
+
+def _from_client(value):
+    """Stores a value as the plain JSON CouchDB would have received, with dates as strings."""
+    return json.loads(couch_json.encode(value))
+
+
+def _to_client(value):
+    """Returns a stored value decoded the way the couchdb client decodes responses."""
+    if value is None:
+        return None
+    return couch_json.decode(json.dumps(value))
@@ -0,0 +1,480 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Python equivalents of the CouchDB views in bootstrap/views, used by the in-memory database.
+
+Each map function mirrors its map_<name>.js file and is given the document and an emit
+function. As in CouchDB, a document whose map function fails emits nothing. Reduce functions
+are given all the keys and values of a group at once, so they never rereduce.
+"""
+from couchdb.http import ResourceNotFound
+from mangrove.utils.dates import js_datestring_to_py_datetime, convert_date_time_to_epoch, week_of_year
+
+_views = {}
+
+
+def register_view(name, map_function, reduce_function=None):
+    """
+    Registers the Python equivalent of a view. reduce_function may also be the name of a
+    CouchDB builtin reduce: _count, _sum or _stats.
+    """
+    _views[name] = (map_function, BUILTIN_REDUCES.get(reduce_function, reduce_function))
+
+
+def python_view(name):
+    """
+    Returns the (map, reduce) functions registered for the view; reduce is None for map only views.
+    Raises ResourceNotFound, as CouchDB does for a missing view, when there is none.
+    """
+    try:
+        return _views[name]
+    except KeyError:
+        raise ResourceNotFound(('not_found', 'missing_named_view'))
+
+
+def run_map(map_function, doc):
+    emitted = []
+    try:
+        map_function(doc, lambda key, value=None: emitted.append((key, value)))
+    except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+        return []
+    return emitted
+
+
+def collation_key(value):
+    """
+    Returns a Python sort key that orders JSON values the way CouchDB collates view keys:
+    null, false, true, numbers, strings, arrays and then objects.
+    """
+    if value is None:
+        return 0,
+    if value is False or value is True:
+        return 1, value
+    if isinstance(value, (int, long, float)):
+        return 2, value
+    if isinstance(value, basestring):
+        return 3, value.lower(), value.swapcase()
+    if isinstance(value, (list, tuple)):
+        return 4, tuple(collation_key(item) for item in value)
+    if isinstance(value, dict):
+        return 5, tuple((collation_key(name), collation_key(item)) for name, item in value.items())
+    raise TypeError("%r can not be used in a view key" % (value,))
+
+
+def _count(keys, values):
+    return len(values)
+
+
+def _sum(keys, values):
+    return sum(values)
+
+
+def _stats(keys, values):
+    return dict(sum=sum(values), count=len(values), min=min(values), max=max(values),
+                sumsqr=sum(value * value for value in values))
+
+
+BUILTIN_REDUCES = {'_count': _count, '_sum': _sum, '_stats': _stats}
+
+
+def _latest(keys, values):
+    current = values[0]
+    for value in values:
+        if value['timestamp'] > current['timestamp']:
+            current = value
+    return dict(latest=current['value'], timestamp=current['timestamp'])
+
+
+def _latest_and_stats(keys, values):
+    result = dict(latest=None, timestamp=None, sum=0, count=0, min=None, max=None)
+    for value in values:
+        if result['timestamp'] is None or value['timestamp'] > result['timestamp']:
+            result.update(latest=value['value'], timestamp=value['timestamp'])
+        if _is_number(value['value']):
+            number = value['value']
+            result.update(sum=result['sum'] + number, count=result['count'] + 1,
+                          min=number if result['min'] is None else min(result['min'], number),
+                          max=number if result['max'] is None else max(result['max'], number))
+    return result
+
+
+def _submission_count(keys, values):
+    return dict(count=len(values), success=len([value for value in values if value.get('status')]))
+
+
+def _submission_count_only(keys, values):
+    return dict(count=len(values))
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _date(datestring):
+    try:
+        return js_datestring_to_py_datetime(datestring)
+    except ValueError:
+        return None
+
+
+def _parse_date(datestring):
+    """Date.parse: milliseconds since the epoch."""
+    date = _date(datestring)
+    return convert_date_time_to_epoch(date) if date is not None else None
+
+
+def _json_date(date):
+    """What a JavaScript Date emitted from a view serialises to."""
+    if date is None:
+        return None
+    return date.strftime('%Y-%m-%dT%H:%M:%S') + '.%03dZ' % (date.microsecond / 1000)
+
+
+def _is_live_data_record(doc):
+    return not doc.get('void') and doc.get('document_type') == "DataRecord"
+
+
+def _is_reporter(doc):
+    return doc.get('document_type') == "Entity" and doc['aggregation_paths']['_type'][0] == 'reporter'
+
+
+def _is_submission_log(doc):
+    return doc.get('document_type') == 'SubmissionLog' and doc.get('form_code') is not None
+
+
+def map_aggregates_by_entity_field(doc, emit):
+    if _is_live_data_record(doc):
+        date = _parse_date(doc['event_time'])
+        for field, data in doc['data'].items():
+            emit([doc['entity']['_id'], field, date], dict(timestamp=date, value=data.get('value')))
+
+
+def map_aggregates_by_type_field_entity(doc, emit):
+    if _is_live_data_record(doc):
+        date = _parse_date(doc['event_time'])
+        for field, data in doc['data'].items():
+            emit([doc['entity']['aggregation_paths']['_type'], field, doc['entity']['_id']],
+                 dict(timestamp=date, value=data.get('value')))
+
+
+def map_all_subjects(doc, emit):
+    if doc.get('document_type') == "Entity" and not doc.get('void') and \
+       doc['aggregation_paths']['_type'][0] != 'reporter':
+        emit(doc['aggregation_paths']['_type'], doc)
+
+
+def map_by_aggregation_path(doc, emit):
+    if _is_live_data_record(doc):
+        entity_type = doc['entity']['aggregation_paths']['_type']
+        date = _date(doc['event_time'])
+        dates = [date.year, date.month, date.day, date.hour, date.minute, date.second]
+        for field, data in doc['data'].items():
+            if _is_number(data.get('value')):
+                for path_name, path in doc['entity']['aggregation_paths'].items():
+                    emit([entity_type, path_name, field] + path + dates, data['value'])
+
+
+def map_by_datadict_type(doc, emit):
+    if doc.get('document_type') == 'DataDict':
+        emit(doc.get('slug'), doc['_id'])
+
+
+def map_by_form_code_time(doc, emit):
+    if _is_live_data_record(doc):
+        date = _parse_date(doc['event_time'])
+        for field, data in doc['data'].items():
+            emit([doc['submission'].get('form_code'), date, doc['entity']['_id'], field], data.get('value'))
+
+
+def map_by_form_code_sample(doc, emit):
+    if _is_live_data_record(doc):
+        bucket = 0
+        for character in doc['_id']:
+            bucket = (bucket * 31 + ord(character)) % 1024
+        date = _parse_date(doc['event_time'])
+        for field, data in doc['data'].items():
+            emit([doc['submission'].get('form_code'), bucket, date, doc['entity']['_id'], field], data.get('value'))
+
+
+def map_by_geo(doc, emit):
+    if doc.get('document_type') == 'Entity':
+        geo_path = doc['aggregation_paths']['_geo']
+        for i in range(len(geo_path)):
+            emit(geo_path[:i + 1], 1)
+
+
+def map_by_label_value(doc, emit):
+    if doc.get('document_type') == 'DataRecord' and not doc.get('void'):
+        for label, data in doc['data'].items():
+            emit([label, data.get('value')], doc['entity']['_id'])
+
+
+def map_by_location(doc, emit):
+    if not doc.get('void') and doc.get('document_type') == "Entity":
+        emit([doc['aggregation_paths']['_type'], doc['aggregation_paths']['_geo']], doc['_id'])
+
+
+def map_by_short_codes(doc, emit):
+    if doc.get('document_type') == "Entity" and not doc.get('void'):
+        emit([doc['aggregation_paths']['_type'], doc.get('short_code')], None)
+
+
+def map_by_type(doc, emit):
+    if doc.get('document_type') == 'Entity' and not doc.get('void'):
+        for entity_type in doc['aggregation_paths']['_type']:
+            emit(entity_type, 1)
+
+
+def map_by_type_geo(doc, emit):
+    if doc.get('document_type') == 'Entity':
+        geo_path = doc['aggregation_paths']['_geo']
+        for entity_type in doc['aggregation_paths']['_type']:
+            for j in range(len(geo_path)):
+                emit([entity_type] + geo_path[:j + 1], 1)
+
+
+def _by_values_key(doc, field):
+    entity = doc['entity']
+    return [entity['aggregation_paths']['_type'], entity['_id'], field, doc['submission'].get('form_code'),
+            _parse_date(doc['event_time'])]
+
+
+def map_by_values(doc, emit):
+    if _is_live_data_record(doc):
+        for field, data in doc['data'].items():
+            if _is_number(data.get('value')):
+                emit(_by_values_key(doc, field), data['value'])
+
+
+def map_by_values_latest(doc, emit):
+    if _is_live_data_record(doc):
+        date = _parse_date(doc['event_time'])
+        for field, data in doc['data'].items():
+            emit(_by_values_key(doc, field), dict(timestamp=date, value=data.get('value')))
+
+
+def map_by_values_latest_by_time(doc, emit):
+    if _is_live_data_record(doc):
+        entity = doc['entity']
+        date = _parse_date(doc['event_time'])
+        for field, data in doc['data'].items():
+            emit([entity['aggregation_paths']['_type'], entity['_id'], field, date],
+                 dict(timestamp=date, value=data.get('value')))
+
+
+def map_count_entities_by_type(doc, emit):
+    if doc.get('document_type') == "Entity":
+        emit(doc['aggregation_paths']['_type'], 1)
+
+
+def map_count_non_voided_entities_by_type(doc, emit):
+    if doc.get('document_type') == "Entity" and not doc.get('void'):
+        emit(doc['aggregation_paths']['_type'], 1)
+
+
+def _period_aggregate(period_key, latest):
+    def map_function(doc, emit):
+        if _is_live_data_record(doc):
+            entity_type = doc['entity']['aggregation_paths']['_type']
+            date = _date(doc['event_time'])
+            for field, data in doc['data'].items():
+                key = period_key(date) + [doc['submission'].get('form_code'), entity_type, doc['entity'].get('short_code'),
+                                          field]
+                if latest:
+                    emit(key, dict(timestamp=_json_date(date), value=data.get('value')))
+                elif _is_number(data.get('value')):
+                    emit(key, data['value'])
+
+    return map_function
+
+
+def _daily(date):
+    return [date.year, date.month, date.day]
+
+
+def _weekly(date):
+    return [date.year, week_of_year(date)]
+
+
+def _monthly(date):
+    return [date.year, date.month]
+
+
+def _yearly(date):
+    return [date.year]
+
+
+def map_data_record_by_form_code(doc, emit):
+    if doc.get('document_type') == 'DataRecord':
+        emit([doc['submission'].get('form_code'), doc['entity'].get('short_code')], doc)
+
+
+def map_datasender_by_mobile(doc, emit):
+    if _is_reporter(doc) and not doc.get('void'):
+        data = doc['data']
+        emit([data['mobile_number'].get('value'), data['name'].get('value'), doc.get('short_code')], None)
+
+
+def map_datasenders(doc, emit):
+    if _is_reporter(doc):
+        emit(doc.get('short_code'), None)
+
+
+def map_deleted_submission_log(doc, emit):
+    if _is_submission_log(doc) and doc.get('void'):
+        emit([doc.get('form_code'), _parse_date(doc.get('created'))], doc)
+
+
+def map_entity_aggregation_paths(doc, emit):
+    if doc.get('document_type') == 'Entity':
+        emit([doc['aggregation_paths']['_type'], doc.get('short_code')], doc['aggregation_paths'])
+
+
+def map_entity_by_label_value(doc, emit):
+    if doc.get('document_type') == 'DataRecord' and not doc.get('void'):
+        for label, data in doc['data'].items():
+            emit([doc['entity']['aggregation_paths']['_type'], label, data.get('value')], doc['entity']['_id'])
+
+
+def map_entity_by_short_code(doc, emit):
+    if doc.get('document_type') == 'Entity':
+        emit([doc['aggregation_paths']['_type'], doc.get('short_code')], None)
+
+
+def map_entity_data(doc, emit):
+    if doc.get('document_type') == 'DataRecord' and doc.get('entity') is not None:
+        emit(doc['entity'].get('_id'), 1)
+
+
+def map_entity_datatypes(doc, emit):
+    if doc.get('document_type') == "DataRecord":
+        for data in doc['data'].values():
+            emit(doc['entity']['_id'], data['type']['_id'])
+
+
+def map_entity_datatypes_by_tag(doc, emit):
+    if doc.get('document_type') == "DataRecord":
+        for data in doc['data'].values():
+            for tag in data['type'].get('tags') or []:
+                emit([doc['entity']['_id'], tag], data['type']['_id'])
+
+
+def map_form_by_code(doc, emit):
+    if doc.get('document_type') == 'FormModel' and not doc.get('void'):
+        emit(doc.get('code'), doc)
+
+
+def map_get_entity_attributes(doc, emit):
+    if doc.get('document_type') == "Entity":
+        values = dict((field, data.get('value')) for field, data in (doc.get('data') or {}).items())
+        emit([doc['aggregation_paths']['_type'], doc.get('short_code')], values)
+
+
+def map_id_time_slug_value(doc, emit):
+    if doc.get('document_type') == "DataRecord":
+        for data in doc['data'].values():
+            emit(doc['entity']['_id'], {'event_time': doc.get('event_time'), 'slug': data['type'].get('slug'),
+                                        'value': data.get('value')})
+
+
+def map_latest_by_entity_field(doc, emit):
+    if _is_live_data_record(doc):
+        date = _parse_date(doc['event_time'])
+        for field, data in doc['data'].items():
+            emit([doc['entity']['_id'], field], dict(timestamp=date, value=data.get('value')))
+
+
+def map_questionnaire(doc, emit):
+    if doc.get('document_type') == 'FormModel' and not doc.get('void'):
+        emit(doc.get('form_code'), doc)
+
+
+def map_registration_form_model_by_entity_type(doc, emit):
+    if doc.get('document_type') == 'FormModel' and not doc.get('void') and doc.get('is_registration_model'):
+        emit(doc.get('entity_type'), None)
+
+
+def map_reporters_by_mobile_number(doc, emit):
+    if _is_reporter(doc) and not doc.get('void') and doc['data'].get('mobile_number'):
+        emit(doc['data']['mobile_number'].get('value'), None)
+
+
+def map_submission_data_sender_info(doc, emit):
+    if _is_submission_log(doc):
+        emit([doc.get('form_code'), doc.get('channel'), doc.get('source')])
+
+
+def map_submission_for_activity_period(doc, emit):
+    if _is_submission_log(doc) and not doc.get('void'):
+        emit([doc.get('form_code'), _parse_date(doc.get('event_time'))], doc)
+
+
+def map_submissionlog(doc, emit):
+    if _is_submission_log(doc):
+        emit([doc.get('form_code'), _parse_date(doc.get('created'))], doc)
+
+
+def map_success_submission_log(doc, emit):
+    if _is_submission_log(doc) and doc.get('status') and not doc.get('void'):
+        emit([doc.get('form_code'), _parse_date(doc.get('created'))], doc)
+
+
+def map_undeleted_submission_log(doc, emit):
+    if _is_submission_log(doc) and not doc.get('void'):
+        emit([doc.get('form_code'), _parse_date(doc.get('created'))], doc)
+
+
+def map_web_submissionlog(doc, emit):
+    if _is_submission_log(doc) and doc.get('channel') == 'web':
+        emit([doc.get('form_code'), _parse_date(doc.get('created'))], doc)
+
+
+register_view('aggregates_by_entity_field', map_aggregates_by_entity_field, _latest_and_stats)
+register_view('aggregates_by_type_field_entity', map_aggregates_by_type_field_entity, _latest_and_stats)
+register_view('all_subjects', map_all_subjects)
+register_view('by_aggregation_path', map_by_aggregation_path, _stats)
+register_view('by_datadict_type', map_by_datadict_type)
+register_view('by_form_code_sample', map_by_form_code_sample, _count)
+register_view('by_form_code_time', map_by_form_code_time)
+register_view('by_form_code_time_count', map_by_form_code_time, _count)
+register_view('by_geo', map_by_geo)
+register_view('by_label_value', map_by_label_value)
+register_view('by_location', map_by_location)
+register_view('by_short_codes', map_by_short_codes, _count)
+register_view('by_type', map_by_type)
+register_view('by_type_geo', map_by_type_geo)
+register_view('by_values', map_by_values, _stats)
+register_view('by_values_latest', map_by_values_latest, _latest)
+register_view('by_values_latest_by_time', map_by_values_latest_by_time, _latest)
+register_view('count_entities_by_type', map_count_entities_by_type, _count)
+register_view('count_non_voided_entities_by_type', map_count_non_voided_entities_by_type, _count)
+register_view('daily_aggregate_latest', _period_aggregate(_daily, latest=True), _latest)
+register_view('daily_aggregate_stats', _period_aggregate(_daily, latest=False), _stats)
+register_view('data_record_by_form_code', map_data_record_by_form_code)
+register_view('datasender_by_mobile', map_datasender_by_mobile)
+register_view('datasenders', map_datasenders)
+register_view('deleted_submission_log', map_deleted_submission_log, _count)
+register_view('entity_by_label_value', map_entity_by_label_value)
+register_view('entity_aggregation_paths', map_entity_aggregation_paths)
+register_view('entity_by_short_code', map_entity_by_short_code)
+register_view('entity_data', map_entity_data)
+register_view('entity_datatypes', map_entity_datatypes)
+register_view('entity_datatypes_by_tag', map_entity_datatypes_by_tag)
+register_view('form_by_code', map_form_by_code)
+register_view('get_entity_attributes', map_get_entity_attributes)
+register_view('id_time_slug_value', map_id_time_slug_value)
+register_view('latest_by_entity_field', map_latest_by_entity_field, _latest)
+register_view('monthly_aggregate_latest', _period_aggregate(_monthly, latest=True), _latest)
+register_view('monthly_aggregate_stats', _period_aggregate(_monthly, latest=False), _stats)
+register_view('questionnaire', map_questionnaire)
+register_view('registration_form_model_by_entity_type', map_registration_form_model_by_entity_type)
+register_view('reporters_by_mobile_number', map_reporters_by_mobile_number)
+register_view('submission_data_sender_info', map_submission_data_sender_info, _count)
+register_view('submission_for_activity_period', map_submission_for_activity_period)
+register_view('submissionlog', map_submissionlog, _submission_count)
+register_view('success_submission_log', map_success_submission_log, _submission_count_only)
+register_view('undeleted_submission_log', map_undeleted_submission_log, _submission_count)
+register_view('web_submissionlog', map_web_submissionlog, _submission_count)
+register_view('weekly_aggregate_latest', _period_aggregate(_weekly, latest=True), _latest)
+register_view('weekly_aggregate_stats', _period_aggregate(_weekly, latest=False), _stats)
+register_view('yearly_aggregate_latest', _period_aggregate(_yearly, latest=True), _latest)
+register_view('yearly_aggregate_stats', _period_aggregate(_yearly, latest=False), _stats)
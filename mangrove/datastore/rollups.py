@@ -0,0 +1,327 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Materialized period rollups for aggregate_for_time_period.
+
+A PeriodRollupDocument holds, for one form, entity type and day, week, month or year, what the
+period's *_aggregate_stats and *_aggregate_latest views give per entity and field. RollupUpdater
+keeps them up to date from the _changes feed, so that a dashboard reads a single document
+instead of making CouchDB reduce two views:
+
+    update_rollups(dbm)
+    values = aggregate_from_rollups(dbm, 'CL1', Month(2, 2011), [Sum("patients"), Latest("director")])
+
+aggregate_for_time_period always merges the summaries stored in the rollups of the buckets of its
+period for the median, percentile and count distinct aggregates, instead of rebuilding them from every
+data record of the period, so the first such aggregate asked of a database creates its rollups.
+
+A data record seen for the first time is added to the rollups of its periods. A record that was
+changed or voided makes its rollups get rebuilt from the views. A rebuild is only taken as exact
+when no write reached the database while the views were read; otherwise the rollup is marked
+stale, rebuilt again on the next update, and read from the views meanwhile.
+"""
+from collections import defaultdict
+from threading import Lock
+from couchdb.http import ResourceConflict
+from mangrove.datastore.documents import PeriodRollupDocument, RollupCheckpointDocument
+from mangrove.datastore.summaries import Summary
+from mangrove.datastore.time_period_aggregation import Day, Week, Month, Year, DateRange, aggregate_for_time_period,\
+    _load_aggregate_view, _load_latest_view, _load_summaries_for_forms, _get_aggregates_for_field,\
+    _calculate_grand_total, _latest_aggregation_required, _summary_aggregation_required, _get_summary_aggregation,\
+    _merge, _update, _get_short_code, _get_field_name, _bucket_ranges
+from mangrove.errors.MangroveException import FailedToSaveDataObject
+from mangrove.form_model.form_model import get_form_model_by_code
+from mangrove.utils.dates import js_datestring_to_py_datetime, to_aware_utc, week_of_year
+from mangrove.utils.types import is_number, is_string
+
+CHANGES_BATCH_SIZE = 500
+REBUILD_ATTEMPTS = 3
+CHECKPOINT_ID = "rollup_checkpoint"
+ROLLUP_ID_FORMAT = "rollup/%s/%s/%s/%s"
+
+_updaters = {}
+_updaters_lock = Lock()
+
+
+def update_rollups(dbm):
+    """
+    Brings the period rollups up to date with the _changes feed and returns the number of changes read.
+    """
+    return rollup_updater(dbm).update()
+
+
+def rollup_updater(dbm):
+    with _updaters_lock:
+        updater = _updaters.get(dbm)
+        if updater is None:
+            updater = _updaters[dbm] = RollupUpdater(dbm)
+        return updater
+
+
+def aggregate_from_rollups(dbm, form_code, period, aggregates=None, include_grand_totals=False, catch_up=True):
+    """
+    Returns what aggregate_for_time_period returns, read from the rollup of the period. With catch_up
+    the rollups are first updated with the changes made since the last update. Falls back to
+    aggregate_for_time_period for a DateRange, which has no rollup, when the rollup is missing or stale,
+    and for summary aggregates when the rollup predates summaries.
+    """
+    if isinstance(period, DateRange):
+        return aggregate_for_time_period(dbm, form_code, period, aggregates, include_grand_totals=include_grand_totals)
+    if catch_up:
+        update_rollups(dbm)
+    form_model = get_form_model_by_code(dbm, form_code)
+    rollup = dbm._load_document(rollup_id(period, form_code, form_model.entity_type), PeriodRollupDocument)
+    summary_required = _summary_aggregation_required(aggregates)
+    if rollup is None or rollup.stale or summary_required and rollup.latest and not rollup.summaries:
+        return aggregate_for_time_period(dbm, form_code, period, aggregates, include_grand_totals=include_grand_totals)
+
+    statsdict = _results(aggregates, rollup.stats)
+    if include_grand_totals is True:
+        _calculate_grand_total(statsdict)
+    if _latest_aggregation_required(aggregates):
+        statsdict = _merge(statsdict, _results(aggregates, rollup.latest))
+    if summary_required:
+        summaries = dict(((short_code, field_name), Summary.from_json(summary))
+                         for short_code, fields in rollup.summaries.items() for field_name, summary in fields.items())
+        _update(statsdict, _get_summary_aggregation(aggregates, summaries, include_grand_totals))
+    return statsdict
+
+
+def load_summaries(dbm, entity_types, period):
+    """
+    Returns what _load_summaries_for_forms returns, merged from the summaries stored in the rollups of
+    the buckets of the period. The rollups are first updated, or created from the whole _changes feed
+    when none are kept yet, and the buckets whose rollup is stale or predates summaries are read from
+    the views.
+    """
+    update_rollups(dbm)
+    stale = set(dbm._load_document(CHECKPOINT_ID, RollupCheckpointDocument).stale)
+    ranges = _bucket_ranges(entity_types, period)
+    ids = [rollup_id(bucket, form_code, entity_types[form_code]) for bucket, form_code, startkey, endkey in ranges]
+    values = dict((form_code, {}) for form_code in entity_types)
+    for (bucket, form_code, startkey, endkey), id, row in zip(ranges, ids, dbm._load_all_docs(ids)):
+        doc = row.get('doc')
+        if doc is None and id not in stale:
+            continue
+        rollup = PeriodRollupDocument.wrap(doc) if doc is not None else None
+        if rollup is None or rollup.stale or rollup.latest and not rollup.summaries:
+            summaries = _load_summaries_for_forms(dbm, {form_code: entity_types[form_code]}, bucket)[form_code]
+        else:
+            summaries = dict(((short_code, field_name), Summary.from_json(summary))
+                             for short_code, fields in rollup.summaries.items()
+                             for field_name, summary in fields.items())
+        cells = values[form_code]
+        for key, summary in summaries.items():
+            cells[key] = cells[key].merge(summary) if key in cells else summary
+    return values
+
+
+def rollup_id(period, form_code, entity_type):
+    return ROLLUP_ID_FORMAT % (period.name, "-".join(str(part) for part in period.startkey_start), form_code,
+                               ".".join(entity_type))
+
+
+def periods_of(event_time):
+    """Returns the Day, Week, Month and Year that the period views put a data record with this event time in."""
+    return [Day(event_time.day, event_time.month, event_time.year), Week(week_of_year(event_time), event_time.year),
+            Month(event_time.month, event_time.year), Year(event_time.year)]
+
+
+class RollupUpdater(object):
+    """
+    Applies the _changes feed to the period rollups, batch_size changes at a time.
+
+    The feed position and the rollups that still need a rebuild are kept in a checkpoint document.
+    Applying the same changes twice is harmless: a rollup skips new records up to its own seq, and
+    rebuilds are exact, so a process that stops between saving rollups and the checkpoint just
+    reads those changes again.
+    """
+
+    def __init__(self, dbm, batch_size=CHANGES_BATCH_SIZE):
+        assert batch_size > 0
+        self.dbm = dbm
+        self.batch_size = batch_size
+        self._lock = Lock()
+
+    def update(self):
+        with self._lock:
+            checkpoint = self.dbm._load_document(CHECKPOINT_ID, RollupCheckpointDocument)
+            if checkpoint is None:
+                checkpoint = RollupCheckpointDocument(id=CHECKPOINT_ID)
+            changes_read = 0
+            while True:
+                results, last_seq = self.dbm.changes(since=checkpoint.seq, limit=self.batch_size)
+                rebuild = dict.fromkeys(checkpoint.stale)
+                rebuild.update(self._apply(results))
+                checkpoint.stale = sorted(self._rebuild(rebuild))
+                checkpoint.seq = last_seq
+                changes_read += len(results)
+                if rebuild or any(not _is_rollup(result['id']) for result in results):
+                    self._save_checkpoint(checkpoint)
+                if len(results) < self.batch_size:
+                    return changes_read
+
+    def _apply(self, results):
+        """
+        Adds the new data records among results to their rollups. Returns the rollups to rebuild, as a dict
+        of their ids to the (period, form code, entity type) they are for.
+        """
+        changes_by_rollup = defaultdict(list)
+        periods = {}
+        for result in results:
+            record = result.get('doc')
+            if record is None or record.get('document_type') != "DataRecord":
+                continue
+            event_time = _event_time(record)
+            form_code = record.get('submission', {}).get('form_code')
+            if event_time is None or form_code is None:
+                continue
+            entity_type = record['entity']['aggregation_paths']['_type']
+            for period in periods_of(event_time):
+                id = rollup_id(period, form_code, entity_type)
+                periods[id] = (period, form_code, entity_type)
+                changes_by_rollup[id].append((result['seq'], record))
+
+        rebuild = {}
+        rollups = []
+        for id, changes in changes_by_rollup.items():
+            rollup = self.dbm._load_document(id, PeriodRollupDocument)
+            if rollup is None or rollup.stale or not all(_is_new(record) for seq, record in changes):
+                rebuild[id] = periods[id]
+                continue
+            for seq, record in changes:
+                if seq > rollup.seq:
+                    _add_record(rollup, record)
+                    rollup.seq = seq
+            rollups.append(rollup)
+        for id in self._save_rollups(rollups):
+            rebuild[id] = periods[id]
+        return rebuild
+
+    def _rebuild(self, rebuild):
+        """
+        Rebuilds the rollups from the views and returns the ids of those that are still stale. rebuild maps
+        the ids to the (period, form code, entity type) needed to create a missing rollup, or to None.
+        """
+        stale = set()
+        rollups = []
+        for id, created_for in rebuild.items():
+            rollup = self.dbm._load_document(id, PeriodRollupDocument)
+            if rollup is None:
+                if created_for is None:
+                    continue
+                period, form_code, entity_type = created_for
+                rollup = PeriodRollupDocument(id=id, period=period.name, period_key=period.startkey_start,
+                                              form_code=form_code, entity_type=entity_type)
+            period = _period(rollup.period, rollup.period_key)
+            for attempt in range(REBUILD_ATTEMPTS):
+                seq = self.dbm.update_seq()
+                stats = _load_aggregate_view(self.dbm, rollup.form_code, rollup.entity_type, period)
+                latest = _load_latest_view(self.dbm, rollup.form_code, rollup.entity_type, period)
+                summaries = _load_summaries_for_forms(self.dbm, {rollup.form_code: rollup.entity_type},
+                                                      period)[rollup.form_code]
+                rollup.stale = self.dbm.update_seq() != seq
+                if not rollup.stale:
+                    break
+            rollup.stats, rollup.latest, rollup.seq = _cells(stats), _cells(latest), seq
+            rollup.summaries = _summary_cells(summaries)
+            if rollup.stale:
+                stale.add(id)
+            rollups.append(rollup)
+        return stale | self._save_rollups(rollups)
+
+    def _save_rollups(self, rollups):
+        """Saves the rollups and returns the ids of those that another process changed meanwhile."""
+        if not rollups:
+            return set()
+        conflicts = set()
+        for success, id, rev_or_exception in self.dbm._save_documents(rollups):
+            if success:
+                continue
+            if not isinstance(rev_or_exception, ResourceConflict):
+                raise FailedToSaveDataObject(str(rev_or_exception))
+            conflicts.add(id)
+        return conflicts
+
+    def _save_checkpoint(self, checkpoint):
+        success, id, rev_or_exception = self.dbm._save_documents([checkpoint])[0]
+        if not success and not isinstance(rev_or_exception, ResourceConflict):
+            raise FailedToSaveDataObject(str(rev_or_exception))
+
+
+def _is_rollup(id):
+    return id == CHECKPOINT_ID or id.startswith(ROLLUP_ID_FORMAT.split("%")[0])
+
+
+def _results(aggregates, cells):
+    results = defaultdict(dict)
+    for short_code, fields in cells.items():
+        for field_name, value in fields.items():
+            result = _get_aggregates_for_field(field_name, aggregates, value)
+            if result is not None:
+                results[short_code][field_name] = result
+    return results
+
+
+def _cells(rows):
+    cells = defaultdict(dict)
+    for row in rows:
+        cells[_get_short_code(row)][_get_field_name(row)] = row.value
+    return dict(cells)
+
+
+def _summary_cells(summaries):
+    cells = defaultdict(dict)
+    for (short_code, field_name), summary in summaries.items():
+        cells[short_code][field_name] = summary.to_json()
+    return dict(cells)
+
+
+def _is_new(record):
+    return not record.get('void') and record['_rev'].startswith("1-")
+
+
+def _add_record(rollup, record):
+    short_code = record['entity'].get('short_code')
+    timestamp = _event_time(record)
+    for field_name, data in record.get('data', {}).items():
+        value = data.get('value')
+        latest = rollup.latest.setdefault(short_code, {})
+        current = latest.get(field_name)
+        if current is None or timestamp > _timestamp(current['timestamp']):
+            latest[field_name] = dict(latest=value, timestamp=timestamp)
+        summaries = rollup.summaries.setdefault(short_code, {})
+        summary = Summary.from_json(summaries[field_name]) if field_name in summaries else Summary()
+        summary.add(value)
+        summaries[field_name] = summary.to_json()
+        if is_number(value) and not isinstance(value, bool):
+            stats = rollup.stats.setdefault(short_code, {})
+            current = stats.get(field_name)
+            if current is None:
+                stats[field_name] = dict(sum=value, count=1, min=value, max=value, sumsqr=value * value)
+            else:
+                current.update(sum=current['sum'] + value, count=current['count'] + 1,
+                               min=min(current['min'], value), max=max(current['max'], value),
+                               sumsqr=current['sumsqr'] + value * value)
+
+
+def _event_time(record):
+    return _timestamp(record.get('event_time'))
+
+
+def _timestamp(value):
+    if is_string(value):
+        try:
+            value = js_datestring_to_py_datetime(value)
+        except ValueError:
+            return None
+    return to_aware_utc(value) if value is not None else None
+
+
+def _period(name, key):
+    if name == "day":
+        return Day(key[2], key[1], key[0])
+    if name == "week":
+        return Week(key[1], key[0])
+    if name == "month":
+        return Month(key[1], key[0])
+    return Year(key[0])
@@ -0,0 +1,94 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from threading import Event, Lock
+from couchdb.http import ResourceConflict
+from mangrove.datastore.documents import ShortCodeCounterDocument
+from mangrove.datastore.queries import get_entity_count_for_type
+from mangrove.errors.MangroveException import ShortCodeAllocationException, FailedToSaveDataObject
+
+SHORT_CODE_BLOCK_SIZE = 20
+RESERVE_ATTEMPTS = 10
+COUNTER_ID_FORMAT = "short_code_counter/%s"
+
+_allocators = {}
+_allocators_lock = Lock()
+
+
+def next_short_code_number(dbm, entity_type):
+    """
+    Returns a number that no other caller, in this or any other process, gets for the entity type.
+    """
+    return short_code_allocator(dbm).next_number(entity_type)
+
+
+def short_code_allocator(dbm):
+    with _allocators_lock:
+        allocator = _allocators.get(dbm)
+        if allocator is None:
+            allocator = _allocators[dbm] = ShortCodeAllocator(dbm)
+        return allocator
+
+
+class ShortCodeAllocator(object):
+    """
+    Hands out short code numbers per entity type from blocks reserved in a counter document.
+
+    Reserving a block bumps the counter by block_size with an optimistic, revision checked save,
+    so concurrent processes never get the same numbers and only touch the database once every
+    block_size codes. Numbers left in a block when the process stops are never handed out. A new
+    counter starts after the number of entities of the type, the way codes used to be numbered.
+    """
+
+    def __init__(self, dbm, block_size=SHORT_CODE_BLOCK_SIZE):
+        assert block_size > 0
+        self.dbm = dbm
+        self.block_size = block_size
+        self._blocks = {}
+        self._reserving = {}
+        self._lock = Lock()
+
+    def next_number(self, entity_type):
+        """
+        Hands out the next number of the current block. The lock is only held to take a number: a new block
+        is reserved without it by one thread per entity type, while the other threads that need one wait.
+        """
+        entity_type = entity_type.lower()
+        while True:
+            with self._lock:
+                block = self._blocks.get(entity_type)
+                if block is not None and block[0] < block[1]:
+                    number = block[0]
+                    block[0] += 1
+                    return number
+                reserving = self._reserving.get(entity_type)
+                if reserving is None:
+                    reserving = self._reserving[entity_type] = Event()
+                    break
+            reserving.wait()
+
+        try:
+            block = self._reserve_block(entity_type)
+            with self._lock:
+                number = block[0]
+                block[0] += 1
+                self._blocks[entity_type] = block
+                return number
+        finally:
+            with self._lock:
+                del self._reserving[entity_type]
+            reserving.set()
+
+    def _reserve_block(self, entity_type):
+        counter_id = COUNTER_ID_FORMAT % entity_type
+        for attempt in range(RESERVE_ATTEMPTS):
+            counter = self.dbm._load_document(counter_id, ShortCodeCounterDocument)
+            if counter is None:
+                counter = ShortCodeCounterDocument(id=counter_id, entity_type=entity_type,
+                                                   next_number=get_entity_count_for_type(self.dbm, entity_type) + 1)
+            start = counter.next_number
+            counter.next_number = start + self.block_size
+            success, id, rev_or_exception = self.dbm._save_documents([counter])[0]
+            if success:
+                return [start, start + self.block_size]
+            if not isinstance(rev_or_exception, ResourceConflict):
+                raise FailedToSaveDataObject(str(rev_or_exception))
+        raise ShortCodeAllocationException(entity_type)
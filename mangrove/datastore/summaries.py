@@ -0,0 +1,79 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Mergeable summaries of the values of a field, behind the median, percentile and count distinct aggregates.
+
+A Summary built per entity can be merged into one per location, and one stored per period merged
+into one per year, without reading the data records again.
+"""
+import re
+from mangrove.utils.sketches import HyperLogLog, TDigest
+from mangrove.utils.types import is_number
+
+MEDIAN = "median"
+COUNT_DISTINCT = "count_distinct"
+_PERCENTILE = re.compile(r"^p(\d+(\.\d+)?)$")
+
+
+def percentile(percent):
+    """Returns the name of the aggregate for the percent percentile, such as p90."""
+    assert 0 <= percent <= 100
+    return "p%s" % percent
+
+
+def is_summary_function(name):
+    return name in (MEDIAN, COUNT_DISTINCT) or _percent(name) is not None
+
+
+def _percent(name):
+    match = _PERCENTILE.match(name) if isinstance(name, basestring) else None
+    if match is None or float(match.group(1)) > 100:
+        return None
+    return float(match.group(1))
+
+
+class Summary(object):
+    """A t-digest of the numeric values of a field and a HyperLogLog of all of them."""
+
+    def __init__(self, digest=None, distinct=None):
+        self.digest = TDigest() if digest is None else digest
+        self.distinct = HyperLogLog() if distinct is None else distinct
+
+    def add(self, value):
+        if value is None:
+            return
+        if is_number(value) and not isinstance(value, bool):
+            self.digest.add(value)
+        self.distinct.add(value)
+
+    def merge(self, other):
+        self.digest.merge(other.digest)
+        self.distinct.merge(other.distinct)
+        return self
+
+    def get(self, name):
+        """Returns the value of the aggregate name, or None if it is not a summary aggregate."""
+        if name == COUNT_DISTINCT:
+            return self.distinct.count()
+        if name == MEDIAN:
+            return self.digest.quantile(0.5)
+        percent = _percent(name)
+        return self.digest.quantile(percent / 100) if percent is not None else None
+
+    def __getitem__(self, name):
+        if not is_summary_function(name):
+            raise KeyError(name)
+        return self.get(name)
+
+    def to_json(self):
+        return dict(digest=self.digest.to_json(), distinct=self.distinct.to_json())
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(TDigest.from_json(data['digest']), HyperLogLog.from_json(data['distinct']))
+
+
+def summarize(values):
+    summary = Summary()
+    for value in values:
+        summary.add(value)
+    return summary
@@ -0,0 +1,63 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from couchdb.client import Row
+from mock import Mock
+from mangrove.datastore import data
+from mangrove.datastore.data import _load_all_fields_aggregated, _iter_all_fields_aggregated, ENTITY_GROUP_LEVEL,\
+    EntityAggregration, LocationFilter
+from mangrove.datastore.database import DatabaseManager
+
+ENTITY_TYPE = ["Health_Facility", "Clinic"]
+
+
+def _rows(*key_values):
+    return [Row(key=[ENTITY_TYPE, entity_id, field], value=dict(value)) for entity_id, field, value in key_values]
+
+
+class TestAggregatedValues(unittest.TestCase):
+    def setUp(self):
+        self.views = {
+            'by_values': _rows(("1", "beds", dict(sum=30, count=2, min=10, max=20)),
+                               ("2", "beds", dict(sum=5, count=1, min=5, max=5))),
+            'by_values_latest': _rows(("1", "beds", dict(latest=20, timestamp=2)),
+                                      ("1", "director", dict(latest="Dr. A", timestamp=2)),
+                                      ("2", "beds", dict(latest=5, timestamp=1))),
+            }
+        self.dbm = Mock(spec=DatabaseManager)
+        self.dbm.load_all_rows_in_view.side_effect = lambda view_name, **values: _rows_copy(self.views[view_name])
+        self.dbm.iter_view_rows.side_effect = lambda view_name, **values: iter(_rows_copy(self.views[view_name]))
+
+    def _expected(self):
+        return [([ENTITY_TYPE, "1", "beds"], dict(latest=20, timestamp=2, sum=30, count=2, min=10, max=20, average=15)),
+                ([ENTITY_TYPE, "1", "director"], dict(latest="Dr. A", timestamp=2)),
+                ([ENTITY_TYPE, "2", "beds"], dict(latest=5, timestamp=1, sum=5, count=1, min=5, max=5, average=5))]
+
+    def test_should_join_stats_to_latest_values_by_key(self):
+        values = _load_all_fields_aggregated(self.dbm, ENTITY_TYPE, ENTITY_GROUP_LEVEL)
+
+        self.assertEqual(self._expected(), values)
+
+    def test_should_merge_streamed_views_in_lock_step(self):
+        values = list(_iter_all_fields_aggregated(self.dbm, ENTITY_TYPE, ENTITY_GROUP_LEVEL))
+
+        self.assertEqual(self._expected(), values)
+        self.assertFalse(self.dbm.load_all_rows_in_view.called)
+
+    def test_should_read_the_entities_of_the_filtered_location_with_one_multi_key_request(self):
+        self.views['by_location'] = [Row(key=[ENTITY_TYPE, ["India", "MH"]], value="2")]
+        self.views['aggregates_by_type_field_entity'] = [
+            Row(key=[ENTITY_TYPE, "beds", "2"], value=dict(latest=5, timestamp=1, sum=5, count=1, min=5, max=5))]
+
+        values = data.aggregate(self.dbm, ENTITY_TYPE, aggregates={"beds": data.reduce_functions.SUM},
+                                aggregate_on=EntityAggregration(), filter=LocationFilter(["India", "MH"]))
+
+        self.assertEqual({"2": {"beds": 5}}, values)
+        self.assertEqual(["by_location", "aggregates_by_type_field_entity"],
+                         [call[0][0] for call in self.dbm.load_all_rows_in_view.call_args_list])
+        self.assertEqual(dict(group=True, keys=[[ENTITY_TYPE, "beds", "2"]]),
+                         self.dbm.load_all_rows_in_view.call_args_list[1][1])
+        self.assertFalse(self.dbm.iter_view_rows.called)
+
+
+def _rows_copy(rows):
+    return [Row(key=row.key, value=dict(row.value) if isinstance(row.value, dict) else row.value) for row in rows]
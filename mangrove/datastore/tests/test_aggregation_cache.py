@@ -0,0 +1,96 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from mock import Mock
+from mangrove.datastore.aggregation_cache import enable_aggregation_cache, disable_aggregation_cache,\
+    cached_aggregation
+from mangrove.datastore.database import DatabaseManager
+
+
+class Sum(object):
+    def __init__(self, field_name):
+        self.field_name = field_name
+
+
+class TestAggregationCache(unittest.TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.seq = 1
+        self.changes = []
+        self.dbm.update_seq.side_effect = lambda: self.seq
+        self.dbm.changes.side_effect = lambda since, limit: (
+            [change for change in self.changes if change['seq'] > since], self.seq)
+        self.calls = []
+
+        @cached_aggregation
+        def aggregate(dbm, form_code, aggregates=None, entity_type=None):
+            self.calls.append(form_code)
+            return {"1": {"patients": len(self.calls)}}
+
+        self.aggregate = aggregate
+
+    def tearDown(self):
+        disable_aggregation_cache(self.dbm)
+
+    def _save(self, doc):
+        self.seq += 1
+        self.changes.append(dict(seq=self.seq, id=str(self.seq), doc=doc))
+
+    def _data_record(self, form_code, entity_type=("clinic",)):
+        return dict(document_type="DataRecord", submission=dict(form_code=form_code),
+                    entity=dict(aggregation_paths=dict(_type=list(entity_type))))
+
+    def test_should_compute_without_a_cache(self):
+        self.aggregate(self.dbm, "CL1")
+        self.aggregate(self.dbm, "CL1")
+
+        self.assertEqual(["CL1", "CL1"], self.calls)
+
+    def test_should_cache_calls_with_the_same_normalized_arguments(self):
+        enable_aggregation_cache(self.dbm)
+
+        values = self.aggregate(self.dbm, "CL1", [Sum("patients")])
+        values["1"]["patients"] = 100
+
+        self.assertEqual({"1": {"patients": 1}}, self.aggregate(self.dbm, form_code="CL1", aggregates=[Sum("patients")]))
+        self.assertEqual(["CL1"], self.calls)
+        self.aggregate(self.dbm, "CL1", [Sum("beds")])
+        self.assertEqual(["CL1", "CL1"], self.calls)
+
+    def test_should_invalidate_results_of_the_changed_form_only(self):
+        enable_aggregation_cache(self.dbm)
+        self.aggregate(self.dbm, "CL1")
+        self.aggregate(self.dbm, "CL2")
+
+        self._save(self._data_record("CL1"))
+
+        self.assertEqual({"1": {"patients": 3}}, self.aggregate(self.dbm, "CL1"))
+        self.aggregate(self.dbm, "CL2")
+        self.assertEqual(["CL1", "CL2", "CL1"], self.calls)
+        self.assertFalse(self.dbm.changes.call_count > 1)
+
+    def test_should_invalidate_results_of_the_changed_entity_type(self):
+        enable_aggregation_cache(self.dbm)
+        self.aggregate(self.dbm, None, entity_type=["clinic"])
+
+        self._save(dict(document_type="Entity", aggregation_paths=dict(_type=["clinic"])))
+        self.aggregate(self.dbm, None, entity_type=["clinic"])
+
+        self.assertEqual([None, None], self.calls)
+
+    def test_should_serve_stale_results_while_revalidating(self):
+        cache = enable_aggregation_cache(self.dbm, stale_while_revalidate=True)
+        self.aggregate(self.dbm, "CL1")
+        self._save(self._data_record("CL1"))
+
+        self.assertEqual({"1": {"patients": 1}}, self.aggregate(self.dbm, "CL1"))
+        cache.wait_for_refreshes()
+        self.assertEqual({"1": {"patients": 2}}, self.aggregate(self.dbm, "CL1"))
+        self.assertEqual(["CL1", "CL1"], self.calls)
+
+    def test_should_keep_at_most_max_size_results(self):
+        cache = enable_aggregation_cache(self.dbm, max_size=2)
+        for form_code in ["CL1", "CL2", "CL3", "CL1"]:
+            self.aggregate(self.dbm, form_code)
+
+        self.assertEqual(["CL1", "CL2", "CL3", "CL1"], self.calls)
+        self.assertEqual(2, cache.stats()['size'])
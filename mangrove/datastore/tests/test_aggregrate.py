@@ -0,0 +1,131 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from couchdb.client import Row
+from mock import Mock
+from mangrove.datastore import aggregrate
+from mangrove.datastore.aggregrate import Sum, Min, Max, Latest, Count, Average
+from mangrove.datastore.data import EntityAggregration
+from mangrove.datastore.database import DatabaseManager
+from mangrove.errors.MangroveException import AggregationNotSupportedForTypeException
+
+ROWS = [
+    (1000, "e1", "beds", 10), (1000, "e1", "director", "Dr. A"), (1000, "e2", "beds", 7),
+    (1000, "e2", "meds", 2.5), (2000, "e1", "beds", 30), (2000, "e2", "beds", 3),
+    (2000, "e2", "meds", 4), (2000, "e1", "director", "Dr. B"), (3000, "e3", "patients", 8),
+    (3000, "e3", "beds", 1), (3000, "e1", "patients", None),
+]
+
+
+@unittest.skipIf(aggregrate.numpy is None, "numpy is not installed")
+class TestColumnarAggregation(unittest.TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.dbm.iter_view_rows.side_effect = lambda view_name, **values: iter(
+            [Row(key=["CL1", timestamp, entity_id, field], value=value) for timestamp, entity_id, field, value in ROWS])
+
+    def _compare(self, aggregates, aggregate_on, include_grand_totals):
+        columnar = aggregrate._reduce_columns(aggregates, aggregrate._load_columns(self.dbm, "CL1", None, None),
+                                              isinstance(aggregate_on, EntityAggregration),
+                                              include_grand_totals or aggregate_on is None)
+        expected = aggregrate._reduce(aggregates, aggregrate._map(self.dbm, None, None, "CL1", None, None,
+                                                                  aggregate_on, include_grand_totals))
+        self.assertEqual(expected, columnar)
+        return columnar
+
+    def test_should_match_python_reduce_per_entity(self):
+        for aggregate in [Sum, Min, Max, Latest, Count, Average]:
+            self._compare([aggregate("beds"), aggregate("meds"), Latest("patients"), Latest("director")],
+                          EntityAggregration(), False)
+
+    def test_should_match_python_grand_totals(self):
+        values = self._compare([Sum("beds")], None, False)
+
+        self.assertEqual(dict(beds=51, meds=6.5, director=None, patients=None), values['GrandTotals'])
+
+    def test_should_keep_integer_results_as_python_numbers(self):
+        values = self._compare([Sum("beds"), Average("meds")], EntityAggregration(), True)
+
+        self.assertIs(int, type(values["e1"]["beds"]))
+        self.assertIs(float, type(values["e2"]["meds"]))
+
+    def test_should_keep_types_of_mixed_columns_like_python_reduce(self):
+        values = self._compare([Max("meds")], EntityAggregration(), False)
+
+        self.assertIs(int, type(values["e2"]["meds"]))
+
+    def test_should_not_overflow_int64_sums(self):
+        self.assertIsNone(aggregrate._numeric_array([2 ** 62, 2 ** 62]))
+        self.assertIsNone(aggregrate._numeric_array([2 ** 64]))
+        self.assertIsNotNone(aggregrate._numeric_array([2 ** 40, 2 ** 40]))
+
+
+class TestApproximateAggregation(unittest.TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.sample = [Row(key=["CL1", 3, 2000, "e1", "beds"], value=30), Row(key=["CL1", 3, 1000, "e1", "beds"], value=10),
+                       Row(key=["CL1", 7, 1500, "e2", "beds"], value=4), Row(key=["CL1", 7, 1500, "e2", "director"],
+                                                                            value="Dr. A")]
+        self.dbm.iter_view_rows.return_value = iter(self.sample)
+
+    def _form(self):
+        form = Mock()
+        form.form_code = "CL1"
+        return form
+
+    def test_should_scale_sums_and_counts_of_a_sample(self):
+        self.dbm.load_all_rows_in_view.return_value = [Row(key=None, value=40000)]
+
+        values = aggregrate._aggregate_form_code(self.dbm, self._form(), [Sum("beds"), Average("beds")],
+                                                 EntityAggregration(), None, None, True, approximate=True,
+                                                 error=0.05)
+
+        self.dbm.iter_view_rows.assert_called_once_with("by_form_code_sample", reduce=False, startkey=["CL1", 0],
+                                                        endkey=["CL1", 10, {}])
+        scale = 1024 / 11.0
+        self.assertEqual(40 * scale, values["e1"]["beds"])
+        self.assertEqual(4 * scale, values["e2"]["beds"])
+        self.assertEqual(44 * scale, values["GrandTotals"]["beds"])
+
+    def test_should_size_the_sample_from_the_rows_of_the_window(self):
+        self.dbm.load_all_rows_in_view.side_effect = [[Row(key=None, value=400000)], [Row(key=None, value=40000)]]
+
+        values = aggregrate._aggregate_form_code(self.dbm, self._form(), [Sum("beds")], EntityAggregration(),
+                                                 "01-01-1970 00:00:02", "01-01-1970 00:30:00", False,
+                                                 approximate=True, error=0.05)
+
+        self.assertEqual(("by_form_code_time_count",), self.dbm.load_all_rows_in_view.call_args[0])
+        self.assertEqual(dict(startkey=["CL1", 2000], endkey=["CL1", 1800000]),
+                         self.dbm.load_all_rows_in_view.call_args[1])
+        self.assertEqual(["CL1", 10, {}], self.dbm.iter_view_rows.call_args[1]['endkey'])
+        self.assertAlmostEqual(30 * 1024 / 11.0, values["e1"]["beds"])
+        self.assertEqual(["e1"], values.keys())
+
+    def test_should_read_small_forms_whole(self):
+        self.dbm.load_all_rows_in_view.return_value = [Row(key=None, value=4)]
+        self.dbm.iter_view_rows.return_value = iter([Row(key=["CL1", 1000, "e1", "beds"], value=10),
+                                                     Row(key=["CL1", 1500, "e2", "beds"], value=4)])
+
+        values = aggregrate._aggregate_form_code(self.dbm, self._form(), [Sum("beds")], EntityAggregration(),
+                                                 None, None, False, approximate=True)
+
+        self.assertEqual(dict(e1=dict(beds=10), e2=dict(beds=4)), values)
+        self.dbm.iter_view_rows.assert_called_once_with("by_form_code_time", startkey=["CL1"],
+                                                        endkey=["CL1", {}])
+
+    def test_should_read_windows_smaller_than_the_sample_whole(self):
+        self.dbm.load_all_rows_in_view.side_effect = [[Row(key=None, value=400000)], [Row(key=None, value=1000)]]
+        self.dbm.iter_view_rows.return_value = iter([Row(key=["CL1", 1000, "e1", "beds"], value=10)])
+
+        values = aggregrate._aggregate_form_code(self.dbm, self._form(), [Sum("beds")], EntityAggregration(),
+                                                 "01-01-1970 00:00:01", None, False, approximate=True)
+
+        self.assertEqual(dict(e1=dict(beds=10)), values)
+        self.dbm.iter_view_rows.assert_called_once_with("by_form_code_time", startkey=["CL1", 1000],
+                                                        endkey=["CL1", {}])
+
+    def test_should_not_estimate_aggregates_that_do_not_scale_from_a_sample(self):
+        for aggregate in [Latest("director"), Min("beds"), Max("beds")]:
+            self.assertRaises(AggregationNotSupportedForTypeException, aggregrate._aggregate_form_code, self.dbm,
+                              self._form(), [Sum("beds"), aggregate], EntityAggregration(), None, None, False,
+                              approximate=True)
+        self.assertFalse(self.dbm.iter_view_rows.called)
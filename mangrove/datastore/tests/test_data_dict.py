@@ -1,5 +1,6 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
-from mangrove.datastore.datadict import create_datadict_type, get_datadict_type_by_slug, get_datadict_type
+from mangrove.datastore.datadict import create_datadict_type, get_datadict_type_by_slug, get_datadict_type,\
+    get_or_create_data_dicts
 from mangrove.errors.MangroveException import  DataObjectNotFound
 from mangrove.utils.test_utils.mangrove_test_case import MangroveTestCase
 
@@ -34,3 +35,13 @@ class TestDataDict(MangroveTestCase):
     def test_should_raise_exception_if_datadict_not_found(self):
         with self.assertRaises(DataObjectNotFound):
             get_datadict_type(self.manager, "ID not in db")
+
+    def test_should_get_or_create_data_dicts(self):
+        name_type = create_datadict_type(self.manager, name='First name', slug='first_name', primitive_type='string')
+
+        types = get_or_create_data_dicts(self.manager, [dict(name='First name', slug='first_name', primitive_type='string'),
+                                                        dict(name='Age', slug='age', primitive_type='number')])
+
+        self.assertEqual(name_type.id, types[0].id)
+        self.assertEqual(types[1].id, get_datadict_type_by_slug(self.manager, 'age').id)
+        self.assertEqual('number', get_datadict_type(self.manager, types[1].id).primitive_type)
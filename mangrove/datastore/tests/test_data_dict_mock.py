@@ -3,7 +3,8 @@ from datetime import datetime
 import unittest
 from mock import Mock, patch
 from mangrove.datastore.database import DatabaseManager
-from mangrove.datastore.datadict import DataDictType, create_datadict_type, get_datadict_type_by_slug
+from mangrove.datastore.datadict import DataDictType, create_datadict_type, get_datadict_type_by_slug,\
+    get_datadict_types, get_or_create_data_dicts
 from mangrove.errors.MangroveException import DataObjectNotFound
 
 
@@ -109,3 +110,55 @@ class TestDataDict(unittest.TestCase):
 
         self.assertIsInstance(actual, DataDictType)
         self.assertEqual(expected.id, actual.id)
+
+    def test_should_read_only_uncached_ddtypes(self):
+        name = DataDictType(self.dbm, "name", "name", primitive_type="string", id="1")
+        age = DataDictType(self.dbm, "age", "age", primitive_type="number", id="2")
+        self.dbm.get_many.side_effect = lambda ids, object_class: [ddtype for ddtype in [name, age] if
+                                                                   ddtype.id in ids]
+
+        self.assertEqual(["1"], [ddtype.id for ddtype in get_datadict_types(self.dbm, ["1", "missing"])])
+        types = get_datadict_types(self.dbm, ["2", "1", "2"])
+
+        self.assertEqual(["2", "1", "2"], [ddtype.id for ddtype in types])
+        self.assertEqual([["2"]], [sorted(call[0][0]) for call in self.dbm.get_many.call_args_list[1:]])
+        types[1].description = "changed"
+        self.assertEqual(None, get_datadict_types(self.dbm, ["1"])[0].description)
+        self.assertEqual(2, self.dbm.get_many.call_count)
+
+    def test_should_read_ddtype_again_after_saving_it(self):
+        name = DataDictType(self.dbm, "name", "name", primitive_type="string", id="1")
+        self.dbm.get_many.return_value = [name]
+        get_datadict_types(self.dbm, ["1"])
+
+        name.save()
+        get_datadict_types(self.dbm, ["1"])
+
+        self.assertEqual(2, self.dbm.get_many.call_count)
+
+    def test_should_get_or_create_data_dicts_with_one_read_and_one_save(self):
+        name = DataDictType(self.dbm, "Name", "name", primitive_type="string")
+        db_row = Mock()
+        db_row.doc = name._doc._data
+        self.dbm.load_all_rows_in_view.return_value = [db_row]
+        self.dbm._save_documents.side_effect = lambda documents: [(True, document.id, "1-a") for document in documents]
+
+        types = get_or_create_data_dicts(self.dbm, [dict(name="Name", slug="name", primitive_type="string"),
+                                                    dict(name="Age", slug="age", primitive_type="number"),
+                                                    dict(name="Age", slug="age", primitive_type="number")])
+
+        self.assertEqual(["name", "age", "age"], [ddtype.slug for ddtype in types])
+        self.assertEqual(name.id, types[0].id)
+        self.assertEqual(["age", "name"], sorted(self.dbm.load_all_rows_in_view.call_args[1]['keys']))
+        self.assertEqual([["age"]], [[document.slug for document in call[0][0]] for call in
+                                     self.dbm._save_documents.call_args_list])
+
+    def test_should_get_cached_data_dicts_by_slug_without_reading_the_view(self):
+        self.dbm._save_documents.side_effect = lambda documents: [(True, document.id, "1-a") for document in documents]
+        self.dbm.load_all_rows_in_view.return_value = []
+        age = get_or_create_data_dicts(self.dbm, [dict(name="Age", slug="age", primitive_type="number")])[0]
+        self.dbm.get_many.return_value = [age]
+
+        self.assertEqual(age.id, get_datadict_type_by_slug(self.dbm, "age").id)
+        self.assertEqual(1, self.dbm.load_all_rows_in_view.call_count)
+        self.assertFalse(self.dbm.get_many.called)
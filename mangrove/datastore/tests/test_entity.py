@@ -337,10 +337,11 @@ class TestEntity(MangroveTestCase):
             id = e.add_data(d)
             self.assertFalse(self.manager._load_document(id).void)
             data_ids.append(id)
-        e.invalidate()
+        self.assertEqual(2, e.invalidate())
         self.assertTrue(e._doc.void)
         for id in data_ids:
             self.assertTrue(self.manager._load_document(id).void)
+        self.assertEqual(0, self.manager.void_documents(data_ids))
 
     def test_should_return_data_types(self):
         med_type = DataDictType(self.manager,
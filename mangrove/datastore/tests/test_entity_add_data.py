@@ -0,0 +1,83 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from couchdb.http import ResourceConflict, ServerError
+from mock import Mock
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.datadict import DataDictType
+from mangrove.datastore.documents import EntityDocument
+from mangrove.datastore.entity import Entity
+from mangrove.errors.MangroveException import FailedToSaveDataObject
+
+
+class TestEntityAddData(unittest.TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.entity = Entity(self.dbm, entity_type='clinic', location=['India', 'MH', 'Pune'], short_code='cli1')
+        self.ddtype = DataDictType(self.dbm, name='beds', slug='beds', primitive_type='number')
+
+    def test_should_save_entity_and_data_record_in_one_request(self):
+        self.dbm._save_documents.return_value = [(True, self.entity.id, 'rev'), (True, 'record_1', 'rev')]
+
+        record_id = self.entity.add_data(data=[('beds', 10, self.ddtype)])
+
+        self.assertEqual('record_1', record_id)
+        self.assertEqual(1, self.dbm._save_documents.call_count)
+        documents = self.dbm._save_documents.call_args[0][0]
+        self.assertEqual(self.entity._doc, documents[0])
+        self.assertEqual(10, documents[1].data['beds']['value'])
+        self.assertEqual(10, self.entity.data['beds']['value'])
+
+    def test_should_return_results_of_all_data_records_when_saving_multiple_records(self):
+        self.dbm._save_documents.return_value = [(True, self.entity.id, 'rev'), (True, 'r1', 'rev'), (True, 'r2', 'rev')]
+
+        results = self.entity.add_data(data=[('beds', 10, self.ddtype), ('meds', 20, self.ddtype)],
+                                       multiple_records=True)
+
+        self.assertEqual([(True, 'r1', 'rev'), (True, 'r2', 'rev')], results)
+
+    def test_should_retry_only_entity_on_conflict(self):
+        stored = EntityDocument.wrap(dict(self.entity._doc.unwrap(), _rev='2-abc'))
+        self.dbm._load_document.return_value = stored
+        self.dbm._save_documents.side_effect = [[(False, self.entity.id, ResourceConflict()), (True, 'record_1', 'rev')],
+                                                [(True, self.entity.id, 'rev')]]
+
+        record_id = self.entity.add_data(data=[('beds', 10, self.ddtype)])
+
+        self.assertEqual('record_1', record_id)
+        retried = self.dbm._save_documents.call_args[0][0]
+        self.assertEqual([stored], retried)
+        self.assertEqual(10, stored.data['beds']['value'])
+
+    def test_should_fail_when_data_record_is_not_saved(self):
+        self.dbm._save_documents.return_value = [(True, self.entity.id, 'rev'), (False, 'record_1', ServerError())]
+
+        with self.assertRaises(FailedToSaveDataObject):
+            self.entity.add_data(data=[('beds', 10, self.ddtype)])
+        self.assertEqual(1, self.dbm._save_documents.call_count)
+
+    def test_should_void_saved_records_when_any_record_is_not_saved(self):
+        self.dbm._save_documents.side_effect = [[(True, self.entity.id, 'rev'), (True, 'r1', 'rev'),
+                                                 (False, 'r2', ServerError())], [(True, 'r1', 'rev')]]
+
+        with self.assertRaises(FailedToSaveDataObject):
+            self.entity.add_data(data=[('beds', 10, self.ddtype), ('meds', 20, self.ddtype)], multiple_records=True)
+        voided = self.dbm._save_documents.call_args[0][0]
+        self.assertEqual([10], [record.data['beds']['value'] for record in voided])
+        self.assertTrue(all(record.void for record in voided))
+
+    def test_should_void_saved_record_when_entity_is_not_saved(self):
+        self.dbm._save_documents.side_effect = [[(False, self.entity.id, ServerError()), (True, 'record_1', 'rev')],
+                                                [(True, 'record_1', 'rev')]]
+
+        with self.assertRaises(FailedToSaveDataObject):
+            self.entity.add_data(data=[('beds', 10, self.ddtype)])
+        voided = self.dbm._save_documents.call_args[0][0]
+        self.assertEqual(1, len(voided))
+        self.assertTrue(voided[0].void)
+
+    def test_should_give_up_after_repeated_conflicts(self):
+        self.dbm._load_document.side_effect = lambda id, cls: EntityDocument.wrap(self.entity._doc.unwrap())
+        self.dbm._save_documents.side_effect = lambda documents: [(False, doc.id, ResourceConflict()) for doc in documents]
+
+        with self.assertRaises(FailedToSaveDataObject):
+            self.entity.add_data(data=[('beds', 10, self.ddtype)])
@@ -0,0 +1,102 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from couchdb.client import Row
+from mock import Mock, patch
+from mangrove.datastore.database import DatabaseManager, View
+from mangrove.datastore.instrumentation import QueryStatistics, QueryEvent, Operations
+
+
+class DatabaseManagerStub(DatabaseManager):
+    def __init__(self, rows):
+        self.database = Mock()
+        self.database.view.return_value.rows = rows
+        self.view = View(self)
+
+
+class TestDatabaseObservers(unittest.TestCase):
+    def setUp(self):
+        self.rows = [Row(key=1, id='a', value=2), Row(key=2, id='b', value=3)]
+        self.dbm = DatabaseManagerStub(self.rows)
+        self.events = []
+
+    def test_should_report_view_queries_to_observers(self):
+        self.dbm.add_observer(self.events.append)
+
+        rows = self.dbm.load_all_rows_in_view('by_values', key=1)
+
+        self.assertEqual(self.rows, rows)
+        self.assertEqual(1, len(self.events))
+        event = self.events[0]
+        self.assertEqual(Operations.VIEW, event.operation)
+        self.assertEqual('by_values', event.name)
+        self.assertEqual(dict(key=1), event.params)
+        self.assertEqual(2, event.row_count)
+        self.assertTrue(event.size > 0)
+        self.assertTrue(event.elapsed >= 0)
+
+    def test_should_report_queries_made_through_view_attribute(self):
+        self.dbm.add_observer(self.events.append)
+
+        self.dbm.view.by_time(startkey=1)
+
+        self.dbm.database.view.assert_called_once_with('by_time/by_time', startkey=1)
+        self.assertEqual('by_time', self.events[0].name)
+
+    def test_should_not_report_after_observer_is_removed(self):
+        self.dbm.add_observer(self.events.append)
+        self.dbm.remove_observer(self.events.append)
+
+        self.dbm.load_all_rows_in_view('by_values')
+
+        self.assertEqual([], self.events)
+
+    def test_should_not_fail_queries_when_an_observer_fails(self):
+        self.dbm.add_observer(Mock(side_effect=ValueError("observer failed")))
+        self.dbm.add_observer(self.events.append)
+
+        with patch('mangrove.datastore.database.logger') as logger:
+            rows = self.dbm.load_all_rows_in_view('by_values')
+
+        self.assertEqual(self.rows, rows)
+        self.assertEqual(1, len(self.events))
+        self.assertTrue(logger.exception.called)
+
+    def test_should_not_share_observers_between_managers(self):
+        self.dbm.add_observer(self.events.append)
+
+        self.assertEqual((), DatabaseManager._observers)
+        self.assertEqual((), DatabaseManagerStub([])._observers)
+
+
+class TestQueryStatistics(unittest.TestCase):
+    def test_should_summarise_calls_per_view(self):
+        statistics = QueryStatistics()
+        for elapsed in range(1, 101):
+            statistics(QueryEvent(Operations.VIEW, 'by_values', {}, 2, 10, elapsed / 100.0))
+        statistics(QueryEvent(Operations.BULK_SAVE, None, None, 5, 100, 0.5))
+
+        summary = statistics.summary()
+
+        by_values = summary['view:by_values']
+        self.assertEqual(100, by_values['count'])
+        self.assertEqual(200, by_values['rows'])
+        self.assertEqual(1000, by_values['bytes'])
+        self.assertEqual(0.5, by_values['p50'])
+        self.assertEqual(0.95, by_values['p95'])
+        self.assertEqual(0.99, by_values['p99'])
+        self.assertEqual(1, summary['bulk_save']['count'])
+
+    def test_should_keep_only_latest_samples(self):
+        statistics = QueryStatistics(max_samples=2)
+        for elapsed in [10, 1, 2]:
+            statistics(QueryEvent(Operations.VIEW, 'by_values', {}, 0, 0, elapsed))
+
+        self.assertEqual(2, statistics.summary()['view:by_values']['p99'])
+        self.assertEqual(3, statistics.summary()['view:by_values']['count'])
+
+    def test_should_reset(self):
+        statistics = QueryStatistics()
+        statistics(QueryEvent(Operations.GET, 'id', None, 1, 1, 0.1))
+        statistics.reset()
+
+        self.assertEqual({}, statistics.summary())
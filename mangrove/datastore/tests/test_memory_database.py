@@ -0,0 +1,134 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from datetime import datetime
+from couchdb.http import ResourceConflict, ResourceNotFound, ServerError
+from pytz import UTC
+from mangrove.bootstrap.views import view_js
+from mangrove.datastore import memory_views
+from mangrove.datastore.memory_database import MemoryServer, memory_server
+
+
+def _map_numbers(doc, emit):
+    if 'number' in doc:
+        emit([doc['group'], doc['number']], doc['number'])
+
+
+class TestMemoryDatabase(unittest.TestCase):
+    def setUp(self):
+        self.db = MemoryServer().create('test')
+        self.db.save({'_id': '_design/numbers', 'views': {'numbers': {'map': '', 'reduce': ''}}})
+        memory_views.register_view('numbers', _map_numbers, '_sum')
+
+    def tearDown(self):
+        memory_views._views.pop('numbers', None)
+
+    def _save_numbers(self, *numbers):
+        self.db.update([{'_id': 'n%d' % number, 'group': 'odd' if number % 2 else 'even', 'number': number}
+                        for number in numbers])
+
+    def test_should_save_and_get_document(self):
+        id, rev = self.db.save({'_id': 'a', 'value': 1})
+
+        doc = self.db['a']
+        self.assertEqual(('a', rev, 1), (doc.id, doc.rev, doc['value']))
+
+    def test_should_reject_update_with_stale_revision(self):
+        doc = {'_id': 'a', 'value': 1}
+        self.db.save(doc)
+        stale = dict(doc)
+        self.db.save(doc)
+
+        self.assertRaises(ResourceConflict, self.db.save, stale)
+        success, id, exception = self.db.update([stale])[0]
+        self.assertFalse(success)
+        self.assertIsInstance(exception, ResourceConflict)
+
+    def test_should_round_trip_dates_like_couchdb(self):
+        created = datetime(2011, 2, 1, 10, 30, tzinfo=UTC)
+        self.db.save({'_id': 'a', 'created': created})
+
+        self.assertEqual(created, self.db['a']['created'])
+
+    def test_should_delete_document(self):
+        self.db.save({'_id': 'a'})
+
+        del self.db['a']
+
+        self.assertNotIn('a', self.db)
+        self.assertRaises(ResourceNotFound, self.db.__getitem__, 'a')
+
+    def test_should_not_delete_missing_document(self):
+        success, id, exception = self.db.update([dict(_id='missing', _deleted=True)])[0]
+
+        self.assertFalse(success)
+        self.assertIsInstance(exception, ResourceNotFound)
+
+    def test_should_return_missing_keys_from_all_docs_as_errors(self):
+        self.db.save({'_id': 'a', 'value': 1})
+
+        rows = self.db.view('_all_docs', keys=['a', 'b'], include_docs=True).rows
+
+        self.assertEqual(1, rows[0].doc['value'])
+        self.assertEqual('not_found', rows[1]['error'])
+
+    def test_should_select_key_range_in_collation_order(self):
+        self._save_numbers(1, 2, 3, 4, 5)
+
+        rows = self.db.view('numbers/numbers', reduce=False, startkey=['odd'], endkey=['odd', {}]).rows
+
+        self.assertEqual([1, 3, 5], [row.value for row in rows])
+
+    def test_should_select_descending_range_with_limit(self):
+        self._save_numbers(1, 2, 3, 4, 5)
+
+        rows = self.db.view('numbers/numbers', reduce=False, descending=True, startkey=['odd', {}],
+                            endkey=['odd'], limit=2).rows
+
+        self.assertEqual([5, 3], [row.value for row in rows])
+
+    def test_should_reduce_by_group_level(self):
+        self._save_numbers(1, 2, 3, 4, 5)
+
+        rows = self.db.view('numbers/numbers', group_level=1).rows
+
+        self.assertEqual([(['even'], 6), (['odd'], 9)], [(row.key, row.value) for row in rows])
+        self.assertEqual(15, self.db.view('numbers/numbers').rows[0].value)
+
+    def test_should_reindex_changed_documents(self):
+        self._save_numbers(1, 2)
+        self.assertEqual(3, self.db.view('numbers/numbers').rows[0].value)
+
+        doc = self.db['n2']
+        doc['number'] = 10
+        self.db.save(doc)
+
+        self.assertEqual(11, self.db.view('numbers/numbers').rows[0].value)
+
+    def test_should_refuse_include_docs_on_reduce(self):
+        self.assertRaises(ServerError, self.db.view, 'numbers/numbers', include_docs=True)
+
+    def test_should_raise_not_found_for_view_missing_from_design_document(self):
+        self.assertRaises(ResourceNotFound, self.db.view, 'unknown/unknown')
+
+    def test_should_raise_not_found_for_view_without_python_equivalent(self):
+        self.db.save({'_id': '_design/unported', 'views': {'unported': {'map': ''}}})
+
+        self.assertRaises(ResourceNotFound, self.db.view, 'unported/unported')
+
+    def test_should_share_databases_of_a_server_url(self):
+        memory_server('memory://shared').create('shared_db')
+
+        self.assertIn('shared_db', memory_server('memory://shared'))
+        del memory_server('memory://shared')['shared_db']
+
+
+class TestMemoryViews(unittest.TestCase):
+    def test_every_bootstrap_view_has_a_python_equivalent(self):
+        for view_name in view_js:
+            memory_views.python_view(view_name)
+
+    def test_should_collate_like_couchdb(self):
+        keys = [{}, ['a'], 'b', 'a', 2, 1, True, False, None]
+
+        self.assertEqual([None, False, True, 1, 2, 'a', 'b', ['a'], {}],
+                         sorted(keys, key=memory_views.collation_key))
@@ -1,17 +1,21 @@
 import datetime
 import unittest
-from mangrove.datastore.aggregrate import aggregate_by_form_code_python, Sum, Min, Max, Latest, aggregation_factory
-from mangrove.datastore.data import  LocationAggregration, LocationFilter, EntityAggregration, TypeAggregration, aggregate_for_form
+from mangrove.datastore.aggregrate import aggregate_by_form_code_python, aggregate_by_form_codes_python, Sum, Min, Max, Latest, Count, Average, aggregation_factory
+from mangrove.datastore.data import  LocationAggregration, LocationFilter, EntityAggregration, TypeAggregration, aggregate_for_form,\
+    aggregate_for_forms
 from mangrove.datastore.database import get_db_manager, _delete_db_and_remove_db_manager
 from pytz import UTC
-from mangrove.datastore.entity import Entity, get_entities_by_value, create_entity, entities_exists_with_value
+from mangrove.datastore.entity import Entity, get_entities_by_value, create_entity, entities_exists_with_value,\
+    get_latest_values
 from mangrove.datastore import data
+from mangrove.datastore.documents import attributes
 from mangrove.datastore.datadict import DataDictType
 from mangrove.datastore.entity_type import define_type
 from mangrove.datastore.tests.test_data import TestData
 from mangrove.form_model.field import TextField, IntegerField, SelectField
 from mangrove.form_model.form_model import FormModel
 from mangrove.utils.test_utils.mangrove_test_case import MangroveTestCase
+from mangrove.errors.MangroveException import AggregationNotSupportedForTypeException
 
 
 class TestQueryApi(MangroveTestCase):
@@ -81,6 +85,28 @@ class TestQueryApi(MangroveTestCase):
         self.assertEqual(data_fetched["meds"], 5)
         self.assertEqual(data_fetched["doctors"], 2)
 
+        # other aggregation functions, one request for all the fields
+        events = []
+        self.manager.add_observer(events.append)
+        self.addCleanup(self.manager.remove_observer, events.append)
+        data_fetched = e.values({"beds": "sum", "meds": "average", "doctors": "count", "director": "latest",
+                                 "patients": "max"})
+        self.assertEqual({"beds": 45, "meds": 12.5, "doctors": 3, "director": None, "patients": None}, data_fetched)
+        self.assertEqual(1, len(events))
+
+        # for a past asof, one range per field ending at asof
+        data_fetched = e.values({"beds": "sum", "meds": "average", "doctors": "count", "director": "latest",
+                                 "patients": "max"}, asof=datetime.datetime(2011, 02, 15, tzinfo=UTC))
+        self.assertEqual({"beds": 25, "meds": 20.0, "doctors": 2, "director": None, "patients": None}, data_fetched)
+        self.assertEqual({"beds": 10, "meds": 5, "doctors": 3},
+                         e.values({"beds": "min", "meds": "min", "doctors": "count"}))
+        self.assertEqual({"beds": 15, "meds": 2}, e.values({"beds": "median", "meds": "count_distinct"}))
+        self.assertRaises(AggregationNotSupportedForTypeException, e.values, {"beds": "mode"})
+
+        # data recorded after now is left out
+        e.add_data(data=[("beds", 100, dd_types['beds'])], event_time=datetime.datetime(2100, 01, 01, tzinfo=UTC))
+        self.assertEqual({"beds": 45, "meds": 5}, e.values({"beds": "sum", "meds": "latest"}))
+
     def test_should_fetch_count_per_entity(self):
         dd_types = self.create_datadict_types()
         ENTITY_TYPE = ["Health_Facility", "Clinic"]
@@ -274,6 +300,25 @@ class TestQueryApi(MangroveTestCase):
         self.assertEqual(values[id2_pune], {"director": "Dr. AA", "beds": 200, "patients": 70})
         self.assertEqual(values[id3_pune], {"director": "Dr. AAA", "beds": 200, "patients": 100})
 
+    def test_should_aggregate_all_records_of_an_entity_moved_to_the_filtered_location(self):
+        dd_types = self.create_datadict_types()
+        ENTITY_TYPE = ["Health_Facility", "Clinic"]
+        e = Entity(self.manager, entity_type=ENTITY_TYPE, location=['India', 'MH', 'Mumbai'])
+        moved = e.save()
+        e.add_data(data=[("beds", 100, dd_types['beds']), ("patients", 10, dd_types['patients'])],
+                   event_time=datetime.datetime(2011, 02, 01, tzinfo=UTC))
+        e.set_aggregation_path(attributes.GEO_PATH, ['India', 'MH', 'Pune'])
+        e.save()
+        e.add_data(data=[("beds", 300, dd_types['beds']), ("patients", 30, dd_types['patients'])],
+                   event_time=datetime.datetime(2011, 03, 01, tzinfo=UTC))
+
+        aggregates = {"beds": data.reduce_functions.LATEST, "patients": data.reduce_functions.SUM}
+        values = data.aggregate(self.manager, entity_type=ENTITY_TYPE, aggregate_on=EntityAggregration(),
+                                aggregates=aggregates, filter=LocationFilter(['India', 'MH', 'Pune']))
+        self.assertEqual({moved: {"beds": 300, "patients": 40}}, values)
+        self.assertEqual({}, data.aggregate(self.manager, entity_type=ENTITY_TYPE, aggregate_on=EntityAggregration(),
+                                            aggregates=aggregates, filter=LocationFilter(['India', 'MH', 'Mumbai'])))
+
     def test_should_fetch_aggregate_grouped_by_hierarchy_path_for_location(self):
         dd_types = self.create_datadict_types()
         ENTITY_TYPE = ["Health_Facility", "Clinic"]
@@ -361,6 +406,11 @@ class TestQueryApi(MangroveTestCase):
         self.assertEqual(len(values), 1)
         self.assertEqual(values[("India", "MH")], {"patients": 200})
 
+        values = data.aggregate(self.manager, entity_type=ENTITY_TYPE, aggregates={"*": data.reduce_functions.MAX},
+                                aggregate_on=LocationAggregration(level=2), filter=LocationFilter(['India', 'MH']))
+
+        self.assertEqual({("India", "MH"): {"patients": 50, "meds": 20, "beds": 500}}, values)
+
 
     def test_should_fetch_aggregate_grouped_by_hierarchy_path_for_any(self):
         dd_types = self.create_datadict_types()
@@ -566,6 +616,51 @@ class TestQueryApi(MangroveTestCase):
         self.assertTrue(f.id in entity_ids)
         # TODO: more tests for different types?
 
+    def test_get_latest_values_for_many_entities_as_of(self):
+        med_type = DataDictType(self.manager, name='Medicines', slug='meds', primitive_type='number')
+        med_type.save()
+        jan = datetime.datetime(2011, 01, 01, tzinfo=UTC)
+        march = datetime.datetime(2011, 03, 01, tzinfo=UTC)
+        e = Entity(self.manager, entity_type='foo')
+        e.save()
+        e.add_data([('meds', 20, med_type)], event_time=jan)
+        e.add_data([('meds', 25, med_type)], event_time=march)
+        f = Entity(self.manager, entity_type='foo')
+        f.save()
+        f.add_data([('meds', 10, med_type), ('beds', 3, med_type)], event_time=jan)
+        events = []
+        self.manager.add_observer(events.append)
+        self.addCleanup(self.manager.remove_observer, events.append)
+
+        values = get_latest_values(self.manager, [e.id, f.id], ['meds', 'beds'])
+
+        self.assertEqual({e.id: {'meds': 25, 'beds': None}, f.id: {'meds': 10, 'beds': 3}}, values)
+        self.assertEqual(1, len(events))
+        self.assertEqual({'meds': 20}, get_latest_values(self.manager, [e.id], ['meds'],
+                                                         as_of=datetime.datetime(2011, 02, 01, tzinfo=UTC))[e.id])
+        self.assertEqual(3, len(events))
+
+    def test_should_not_read_the_rows_after_as_of_for_latest_values(self):
+        med_type = DataDictType(self.manager, name='Medicines', slug='meds', primitive_type='number')
+        med_type.save()
+        e = Entity(self.manager, entity_type='foo')
+        e.save()
+        for month, meds in [(1, 20), (3, 25), (4, 30), (5, 35)]:
+            e.add_data([('meds', meds, med_type)], event_time=datetime.datetime(2011, month, 1, tzinfo=UTC))
+        events = []
+        self.manager.add_observer(events.append)
+        self.addCleanup(self.manager.remove_observer, events.append)
+
+        values = get_latest_values(self.manager, [e.id], ['meds'], as_of=datetime.datetime(2011, 02, 01, tzinfo=UTC))
+
+        self.assertEqual({e.id: {'meds': 20}}, values)
+        self.assertEqual(2, len(events))
+        later = events[1]
+        self.assertEqual('aggregates_by_entity_field', later.name)
+        self.assertNotIn('reduce', later.params)
+        self.assertEqual(1, later.row_count)
+        self.assertEqual([e.id, 'meds', 1296518400000], later.params['endkey'])
+
     def test_check_entity_exists_with_value(self):
         med_type = DataDictType(self.manager,
                                 name='Medicines',
@@ -735,6 +830,49 @@ class TestQueryApi(MangroveTestCase):
         self.assertEqual(values[test_data.entity2.id], {"patients": 50, 'meds': 50, 'beds': 150, 'director': "Dr. B1"})
 
 
+    def test_should_aggregate_many_forms_in_one_call(self):
+        TestData(self.manager)
+        aggregates = {"director": data.reduce_functions.LATEST, "patients": data.reduce_functions.SUM}
+        python_aggregates = [Sum("patients"), Latest("director")]
+
+        values = aggregate_for_forms(self.manager, ['CL1', 'CL2'], aggregates=aggregates,
+                                     aggregate_on=EntityAggregration())
+        python_values = aggregate_by_form_codes_python(self.manager, ['CL1', 'CL2'], aggregates=python_aggregates,
+                                                       aggregate_on=EntityAggregration(), include_grand_totals=True)
+
+        for form_code in ['CL1', 'CL2']:
+            self.assertEqual(aggregate_for_form(self.manager, form_code, aggregates=aggregates,
+                                                aggregate_on=EntityAggregration()), values[form_code])
+            self.assertEqual(aggregate_by_form_code_python(self.manager, form_code, aggregates=python_aggregates,
+                                                           aggregate_on=EntityAggregration(),
+                                                           include_grand_totals=True), python_values[form_code])
+
+    def test_approximate_aggregation_should_be_exact_for_small_forms(self):
+        test_data = TestData(self.manager)
+        aggregates = [Sum("patients"), Count('meds'), Average('beds')]
+
+        for starttime, endtime in [(None, None), ("01-02-2011 00:00:00", "01-03-2011 00:00:00")]:
+            values = aggregate_by_form_code_python(self.manager, 'CL1', aggregates=aggregates,
+                                                   aggregate_on=EntityAggregration(), include_grand_totals=True,
+                                                   starttime=starttime, endtime=endtime, approximate=True)
+
+            self.assertEqual(aggregate_by_form_code_python(self.manager, 'CL1', aggregates=aggregates,
+                                                           aggregate_on=EntityAggregration(),
+                                                           include_grand_totals=True, starttime=starttime,
+                                                           endtime=endtime), values)
+            self.assertIn(test_data.entity1.id, values)
+
+    def test_should_not_build_summaries_from_every_data_record(self):
+        test_data = TestData(self.manager)
+
+        for aggregate_on in [EntityAggregration(), LocationAggregration(level=2)]:
+            for function in ["median", "count_distinct", "p90"]:
+                self.assertRaises(AggregationNotSupportedForTypeException, data.aggregate, self.manager,
+                                  test_data.ENTITY_TYPE, aggregates={"patients": function},
+                                  aggregate_on=aggregate_on)
+        self.assertRaises(AggregationNotSupportedForTypeException, aggregate_for_form, self.manager, 'CL2',
+                          aggregate_on=EntityAggregration(), aggregates={"patients": "median"})
+
     def test_aggregation_factory(self):
         test_object = aggregation_factory("sum", "patients")
         self.assertEquals(6, test_object.reduce([1, 2, 3]))
@@ -0,0 +1,121 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import datetime
+from mock import Mock
+from pytz import UTC
+from mangrove.datastore.documents import RollupCheckpointDocument, PeriodRollupDocument
+from mangrove.datastore.rollups import update_rollups, aggregate_from_rollups, rollup_id, load_summaries, CHECKPOINT_ID
+from mangrove.datastore.tests.test_data import TestData
+from mangrove.datastore.time_period_aggregation import aggregate_for_time_period, Sum, Min, Max, Latest, Month, Year,\
+    Median, Percentile, CountDistinct, DateRange, _load_summaries_for_forms
+from mangrove.utils.test_utils.mangrove_test_case import MangroveTestCase
+
+
+class TestPeriodRollups(MangroveTestCase):
+    def setUp(self):
+        MangroveTestCase.setUp(self)
+        self.test_data = TestData(self.manager)
+        self.aggregates = [Sum("patients"), Min("meds"), Max("beds"), Latest("director")]
+
+    def _assert_rollup_matches_views(self, period):
+        expected = aggregate_for_time_period(self.manager, 'CL1', period, self.aggregates, include_grand_totals=True)
+        values = aggregate_from_rollups(self.manager, 'CL1', period, self.aggregates, include_grand_totals=True)
+        self.assertEqual(expected, values)
+        return values
+
+    def _rollup(self, period):
+        return self.manager._load_document(rollup_id(period, 'CL1', self.test_data.ENTITY_TYPE), PeriodRollupDocument)
+
+    def _assert_same_summaries(self, expected, values):
+        self.assertEqual(sorted(expected.keys()), sorted(values.keys()))
+        for key, summary in expected.items():
+            self.assertEqual((summary.get("median"), summary.get("count_distinct")),
+                             (values[key].get("median"), values[key].get("count_distinct")))
+
+    def test_should_read_the_same_values_as_the_views(self):
+        update_rollups(self.manager)
+
+        values = self._assert_rollup_matches_views(Month(2, 2010))
+        self.assertEqual({"patients": 10, 'meds': 20, 'beds': 300, 'director': "Dr. A"},
+                         values[self.test_data.entity1.short_code])
+        self._assert_rollup_matches_views(Year(2011))
+        self.assertFalse(self._rollup(Month(2, 2010)).stale)
+
+    def test_should_add_new_records_to_the_rollups(self):
+        update_rollups(self.manager)
+        self.test_data.entity1.add_data(data=[("patients", 5, self.test_data.dd_types['patients']),
+                                              ("director", "Dr. Z", self.test_data.dd_types['director'])],
+                                        event_time=datetime.datetime(2010, 2, 10, tzinfo=UTC),
+                                        submission=dict(submission_id='9', form_code='CL1'))
+
+        values = self._assert_rollup_matches_views(Month(2, 2010))
+        self.assertEqual(15, values[self.test_data.entity1.short_code]['patients'])
+        self.assertEqual("Dr. Z", values[self.test_data.entity1.short_code]['director'])
+
+    def test_should_keep_summaries_in_the_rollups(self):
+        self.aggregates = [Median("patients"), Percentile("beds", 90), CountDistinct("director")]
+        update_rollups(self.manager)
+        self._assert_rollup_matches_views(Year(2010))
+        self.test_data.entity2.add_data(data=[("patients", 80, self.test_data.dd_types['patients']),
+                                              ("director", "Dr. Z", self.test_data.dd_types['director'])],
+                                        event_time=datetime.datetime(2010, 2, 10, tzinfo=UTC),
+                                        submission=dict(submission_id='9', form_code='CL1'))
+
+        values = self._assert_rollup_matches_views(Year(2010))
+        self.assertEqual(50, values[self.test_data.entity2.short_code]['patients'])
+        self.assertEqual(3, values[self.test_data.entity2.short_code]['director'])
+        self.assertTrue(self._rollup(Year(2010)).summaries)
+
+    def test_should_rebuild_the_rollups_of_voided_records(self):
+        record_id = self.test_data.entity1.add_data(data=[("patients", 5, self.test_data.dd_types['patients'])],
+                                                    event_time=datetime.datetime(2010, 2, 10, tzinfo=UTC),
+                                                    submission=dict(submission_id='9', form_code='CL1'))
+        update_rollups(self.manager)
+        self.test_data.entity1.invalidate_data(record_id)
+
+        values = self._assert_rollup_matches_views(Month(2, 2010))
+        self.assertEqual(10, values[self.test_data.entity1.short_code]['patients'])
+
+    def test_should_advance_the_checkpoint(self):
+        changes_read = update_rollups(self.manager)
+
+        checkpoint = self.manager._load_document(CHECKPOINT_ID, RollupCheckpointDocument)
+        self.assertTrue(changes_read > 0)
+        self.assertTrue(0 < checkpoint.seq <= self.manager.update_seq())
+        self.assertEqual([], checkpoint.stale)
+
+    def test_should_not_write_when_only_rollups_changed(self):
+        update_rollups(self.manager)
+        update_rollups(self.manager)
+        seq = self.manager.update_seq()
+
+        update_rollups(self.manager)
+        self.assertEqual(seq, self.manager.update_seq())
+
+    def test_should_merge_the_summaries_stored_in_the_rollups(self):
+        update_rollups(self.manager)
+        entity_types = {'CL1': self.test_data.ENTITY_TYPE}
+        period = DateRange(datetime.date(2010, 1, 15), datetime.date(2011, 12, 31))
+        expected = _load_summaries_for_forms(self.manager, entity_types, period)['CL1']
+        self.manager.iter_view_rows = Mock(side_effect=AssertionError("the data records were read"))
+
+        self._assert_same_summaries(expected, load_summaries(self.manager, entity_types, period)['CL1'])
+        values = aggregate_for_time_period(self.manager, 'CL1', Year(2010), [Median("patients")])
+        self.assertEqual(15, values[self.test_data.entity1.short_code]['patients'])
+
+    def test_should_read_the_views_for_stale_rollups(self):
+        update_rollups(self.manager)
+        rollup = self._rollup(Month(2, 2010))
+        rollup.stale, rollup.summaries = True, {}
+        self.manager._save_documents([rollup])
+        entity_types = {'CL1': self.test_data.ENTITY_TYPE}
+
+        self._assert_same_summaries(_load_summaries_for_forms(self.manager, entity_types, Month(2, 2010))['CL1'],
+                                    load_summaries(self.manager, entity_types, Month(2, 2010))['CL1'])
+
+    def test_should_create_the_rollups_to_read_summaries_from(self):
+        entity_types = {'CL1': self.test_data.ENTITY_TYPE}
+        expected = _load_summaries_for_forms(self.manager, entity_types, Year(2010))['CL1']
+
+        self._assert_same_summaries(expected, load_summaries(self.manager, entity_types, Year(2010))['CL1'])
+        self.assertIsNotNone(self.manager._load_document(CHECKPOINT_ID, RollupCheckpointDocument))
+        self.assertIsNotNone(self._rollup(Year(2010)))
@@ -0,0 +1,105 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from threading import Event, Thread
+import unittest
+from couchdb.http import ResourceConflict
+from mock import Mock, patch
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.documents import ShortCodeCounterDocument
+from mangrove.datastore.short_codes import ShortCodeAllocator, RESERVE_ATTEMPTS
+from mangrove.errors.MangroveException import ShortCodeAllocationException
+
+
+class TestShortCodeAllocator(unittest.TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.counters = {}
+        self.dbm._load_document.side_effect = self._load_counter
+        self.dbm._save_documents.side_effect = self._save_counter
+        self.patcher = patch('mangrove.datastore.short_codes.get_entity_count_for_type')
+        self.get_entity_count = self.patcher.start()
+        self.get_entity_count.return_value = 4
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def _load_counter(self, id, document_class):
+        counter = self.counters.get(id)
+        return ShortCodeCounterDocument.wrap(dict(counter)) if counter is not None else None
+
+    def _save_counter(self, documents):
+        counter = documents[0]
+        stored = self.counters.get(counter.id)
+        if stored is not None and stored['_rev'] != counter.rev:
+            return [(False, counter.id, ResourceConflict())]
+        revision = str(int(stored['_rev']) + 1) if stored is not None else '1'
+        self.counters[counter.id] = dict(counter.unwrap(), _rev=revision)
+        return [(True, counter.id, revision)]
+
+    def test_should_start_after_existing_entity_count(self):
+        allocator = ShortCodeAllocator(self.dbm, block_size=3)
+
+        self.assertEqual([5, 6, 7, 8], [allocator.next_number('Clinic') for i in range(4)])
+        self.get_entity_count.assert_called_once_with(self.dbm, 'clinic')
+        self.assertEqual(2, self.dbm._save_documents.call_count)
+
+    def test_should_not_hand_out_same_numbers_to_different_allocators(self):
+        first, second = ShortCodeAllocator(self.dbm, block_size=2), ShortCodeAllocator(self.dbm, block_size=2)
+
+        numbers = [first.next_number('clinic'), second.next_number('clinic'), first.next_number('clinic'),
+                   second.next_number('clinic'), first.next_number('clinic')]
+
+        self.assertEqual([5, 7, 6, 8, 9], numbers)
+
+    def test_should_keep_counters_per_entity_type(self):
+        allocator = ShortCodeAllocator(self.dbm)
+
+        self.assertEqual(5, allocator.next_number('clinic'))
+        self.assertEqual(5, allocator.next_number('school'))
+
+    def test_should_retry_when_counter_changed_concurrently(self):
+        allocator = ShortCodeAllocator(self.dbm, block_size=2)
+        save_counter = self._save_counter
+
+        def concurrent_reservation(documents):
+            self.dbm._save_documents.side_effect = save_counter
+            ShortCodeAllocator(self.dbm, block_size=2).next_number('clinic')
+            return save_counter(documents)
+
+        self.dbm._save_documents.side_effect = concurrent_reservation
+
+        self.assertEqual(7, allocator.next_number('clinic'))
+
+    def test_should_give_up_after_repeated_conflicts(self):
+        self.dbm._save_documents.side_effect = lambda documents: [(False, documents[0].id, ResourceConflict())]
+
+        with self.assertRaises(ShortCodeAllocationException):
+            ShortCodeAllocator(self.dbm).next_number('clinic')
+        self.assertEqual(RESERVE_ATTEMPTS, self.dbm._save_documents.call_count)
+
+    def test_should_not_hold_lock_while_reserving_a_block(self):
+        allocator = ShortCodeAllocator(self.dbm)
+        allocator.next_number('school')
+        reserving, release = Event(), Event()
+        save_counter = self._save_counter
+
+        def slow_reservation(documents):
+            reserving.set()
+            release.wait(5)
+            return save_counter(documents)
+
+        self.dbm._save_documents.side_effect = slow_reservation
+        numbers = []
+        thread = Thread(target=lambda: numbers.append(allocator.next_number('clinic')))
+        thread.start()
+        reserving.wait(5)
+
+        other_type = Thread(target=lambda: numbers.append(allocator.next_number('school')))
+        other_type.start()
+        other_type.join(1)
+        finished_while_reserving = not other_type.is_alive()
+        release.set()
+        thread.join(5)
+        other_type.join(5)
+
+        self.assertTrue(finished_while_reserving)
+        self.assertEqual([6, 5], numbers)
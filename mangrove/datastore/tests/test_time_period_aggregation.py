@@ -0,0 +1,105 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from datetime import date, datetime
+from couchdb.client import Row
+from mock import Mock
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.memory_views import collation_key
+from mangrove.datastore.time_period_aggregation import DateRange, _load_aggregate_view, _load_latest_view,\
+    _group_by_path, _combine_stats, _buckets_of, _load_view_for_forms, _stats_view, Month
+
+
+def _keys(buckets):
+    return [(first.name, first.startkey_start, last.startkey_start) for first, last in buckets]
+
+
+def _view_stub(rows_by_bucket):
+    """Answers view reads with the rows of rows_by_bucket, a dict of bucket key to rows, within the read range."""
+    def load_all_rows_in_view(view_name, startkey, endkey, **values):
+        bucket = [part for part in startkey if not isinstance(part, basestring) and not isinstance(part, list)]
+        return [row for row in rows_by_bucket.get(tuple(bucket), [])
+                if collation_key(startkey) <= collation_key(row.key) <= collation_key(endkey)]
+    return load_all_rows_in_view
+
+
+class TestDateRange(unittest.TestCase):
+    def test_should_use_days_within_a_month(self):
+        self.assertEqual([("day", [2011, 2, 3], [2011, 2, 20])],
+                         _keys(DateRange(date(2011, 2, 3), date(2011, 2, 20)).buckets()))
+
+    def test_should_use_whole_months(self):
+        self.assertEqual([("day", [2011, 1, 15], [2011, 1, 31]), ("month", [2011, 2], [2011, 3]),
+                          ("day", [2011, 4, 1], [2011, 4, 10])],
+                         _keys(DateRange(date(2011, 1, 15), date(2011, 4, 10)).buckets()))
+
+    def test_should_use_whole_years(self):
+        self.assertEqual([("month", [2009, 11], [2009, 12]), ("year", [2010], [2011]),
+                          ("month", [2012, 1], [2012, 1]), ("day", [2012, 2, 1], [2012, 2, 1])],
+                         _keys(DateRange(datetime(2009, 11, 1, 10), date(2012, 2, 1)).buckets()))
+
+    def test_should_use_a_single_month(self):
+        self.assertEqual([("month", [2011, 2], [2011, 2])],
+                         _keys(DateRange(date(2011, 2, 1), date(2011, 2, 28)).buckets()))
+
+    def test_should_list_every_bucket_of_the_range(self):
+        buckets = _buckets_of(DateRange(date(2010, 12, 30), date(2012, 3, 2)))
+
+        self.assertEqual([[2010, 12, 30], [2010, 12, 31], [2011], [2012, 1], [2012, 2], [2012, 3, 1], [2012, 3, 2]],
+                         [bucket.startkey_start for bucket in buckets])
+
+    def test_should_combine_buckets_of_the_form(self):
+        dbm = Mock(spec=DatabaseManager)
+        dbm.load_all_rows_in_view.side_effect = _view_stub({
+            (2011, 1, 31): [Row(key=[2011, 1, 31, "CL1", ["clinic"], "1", "beds"],
+                                value=dict(sum=5, count=1, min=5, max=5, sumsqr=25))],
+            (2011, 2): [Row(key=[2011, 2, "CL1", ["clinic"], "1", "beds"],
+                            value=dict(sum=7, count=2, min=3, max=4, sumsqr=25)),
+                        Row(key=[2011, 2, "CL2", ["clinic"], "1", "beds"],
+                            value=dict(sum=9, count=1, min=9, max=9, sumsqr=81))],
+        })
+
+        rows = _load_aggregate_view(dbm, "CL1", ["clinic"], DateRange(date(2011, 1, 31), date(2011, 2, 28)))
+
+        self.assertEqual([["CL1", ["clinic"], "1", "beds"]], [row.key for row in rows])
+        self.assertEqual(dict(sum=12, count=3, min=3, max=5, sumsqr=50), rows[0].value)
+        self.assertEqual([[2011, 1, 31, "CL1", ["clinic"]], [2011, 2, "CL1", ["clinic"]]],
+                         sorted(call[1]['startkey'] for call in dbm.load_all_rows_in_view.call_args_list))
+
+    def test_should_read_only_the_keys_of_each_form(self):
+        dbm = Mock(spec=DatabaseManager)
+        dbm.load_all_rows_in_view.return_value = []
+
+        _load_view_for_forms(dbm, {"ZZ": ["clinic"], "AA": ["school"]}, Month(2, 2011), _stats_view, _combine_stats)
+
+        self.assertEqual([([2011, 2, "AA", ["school"]], [2011, 2, "AA", ["school"], {}]),
+                          ([2011, 2, "ZZ", ["clinic"]], [2011, 2, "ZZ", ["clinic"], {}])],
+                         sorted((call[1]['startkey'], call[1]['endkey'])
+                                for call in dbm.load_all_rows_in_view.call_args_list))
+
+    def test_should_keep_the_latest_value_of_all_buckets(self):
+        dbm = Mock(spec=DatabaseManager)
+        dbm.load_all_rows_in_view.side_effect = _view_stub({
+            (2011, 1, 31): [Row(key=[2011, 1, 31, "CL1", ["clinic"], "1", "director"],
+                                value=dict(latest="Dr. B", timestamp=2))],
+            (2011, 2): [Row(key=[2011, 2, "CL1", ["clinic"], "1", "director"], value=dict(latest="Dr. A", timestamp=1))],
+        })
+
+        rows = _load_latest_view(dbm, "CL1", ["clinic"], DateRange(date(2011, 1, 31), date(2011, 2, 28)))
+
+        self.assertEqual("Dr. B", rows[0].value['latest'])
+
+
+class TestGroupByPath(unittest.TestCase):
+    def test_should_combine_entities_into_every_prefix_of_their_paths(self):
+        stats = lambda value: dict(sum=value, count=1, min=value, max=value, sumsqr=value * value)
+        rows = [Row(key=["CL1", "clinic", "1", "beds"], value=stats(10)),
+                Row(key=["CL1", "clinic", "2", "beds"], value=stats(5)),
+                Row(key=["CL1", "clinic", "3", "beds"], value=stats(1))]
+        paths = {"1": ["India", "MH", "Pune"], "2": ["India", "MH", "Mumbai"], "3": ["India", "Kerala"]}
+
+        grouped = _group_by_path(rows, paths, 2, _combine_stats)
+
+        sums = dict((tuple(row.key), row.value['sum']) for row in grouped)
+        self.assertEqual({((), "beds"): 16, (("India",), "beds"): 16, (("India", "MH"), "beds"): 15,
+                          (("India", "Kerala"), "beds"): 1}, sums)
+        self.assertEqual(6, len(_group_by_path(rows, paths, 0, _combine_stats)))
@@ -0,0 +1,94 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from base64 import urlsafe_b64encode
+import unittest
+from couchdb.client import Row
+from mock import Mock
+from mangrove.datastore.database import DatabaseManager
+from mangrove.errors.MangroveException import InvalidContinuationTokenException
+
+
+class DatabaseStub(object):
+    def __init__(self, rows):
+        self._rows = rows
+        self.requests = []
+
+    def view(self, name, **options):
+        self.requests.append(options)
+        rows = [row for row in self._rows if self._after_start(row, options) and row.key <= options.get('endkey', row.key)]
+        result = Mock()
+        skip = options.get('skip', 0)
+        result.rows = rows[skip:skip + options['limit']]
+        return result
+
+    def _after_start(self, row, options):
+        if 'startkey' not in options:
+            return True
+        return (row.key, row.id) >= (options['startkey'], options.get('startkey_docid', row.id))
+
+
+class DatabaseManagerStub(DatabaseManager):
+    def __init__(self, rows):
+        self.database = DatabaseStub(rows)
+
+
+class TestViewPaging(unittest.TestCase):
+    def setUp(self):
+        keys_and_ids = [(1, 'a'), (1, 'b'), (1, 'c'), (2, 'd'), (3, 'e')]
+        self.rows = [Row(key=key, id=id, value=None) for key, id in keys_and_ids]
+        self.dbm = DatabaseManagerStub(self.rows)
+
+    def test_should_iterate_over_all_rows_a_page_at_a_time(self):
+        rows = list(self.dbm.iter_view_rows('by_values', page_size=2))
+
+        self.assertEqual(self.rows, rows)
+        self.assertEqual(3, len(self.dbm.database.requests))
+        self.assertTrue(all(request['limit'] == 3 for request in self.dbm.database.requests))
+        self.assertFalse(any('skip' in request for request in self.dbm.database.requests))
+
+    def test_should_continue_from_key_and_doc_id_of_next_row(self):
+        list(self.dbm.iter_view_rows('by_values', page_size=2))
+
+        self.assertEqual(1, self.dbm.database.requests[1]['startkey'])
+        self.assertEqual('c', self.dbm.database.requests[1]['startkey_docid'])
+
+    def test_should_page_through_rows_for_a_single_key(self):
+        rows = list(self.dbm.iter_view_rows('by_values', page_size=1, key=1))
+
+        self.assertEqual(['a', 'b', 'c'], [row.id for row in rows])
+        self.assertEqual(1, self.dbm.database.requests[0]['endkey'])
+
+    def test_should_resume_page_from_continuation(self):
+        first_page, continuation = self.dbm.load_view_page('by_values', 3)
+        second_page, last_continuation = self.dbm.load_view_page('by_values', 3, continuation)
+
+        self.assertEqual(['a', 'b', 'c'], [row.id for row in first_page])
+        self.assertEqual(['d', 'e'], [row.id for row in second_page])
+        self.assertIsNone(last_continuation)
+        self.assertEqual(2, self.dbm.database.requests[1]['startkey'])
+        self.assertEqual('d', self.dbm.database.requests[1]['startkey_docid'])
+
+    def test_should_reject_invalid_continuation(self):
+        self.assertRaises(InvalidContinuationTokenException, self.dbm.load_view_page, 'by_values', 3, 'not a token')
+        self.assertRaises(InvalidContinuationTokenException, self.dbm.load_view_page, 'by_values', 3, u'\u00e9t\u00e9')
+
+    def test_should_page_through_a_key_emitted_many_times_by_one_document(self):
+        rows = [Row(key=1, id='a', value=value) for value in range(5)] + [Row(key=2, id='b', value=5)]
+        self.dbm = DatabaseManagerStub(rows)
+
+        self.assertEqual(range(6), [row.value for row in self.dbm.iter_view_rows('by_values', page_size=2)])
+        self.assertEqual([None, 2, 4], [request.get('skip') for request in self.dbm.database.requests])
+
+    def test_should_reject_continuation_with_invalid_skip(self):
+        continuation = urlsafe_b64encode('{"startkey": 1, "skip": -1}')
+        self.assertRaises(InvalidContinuationTokenException, self.dbm.load_view_page, 'by_values', 3, continuation)
+
+    def test_should_reject_continuation_outside_of_the_range(self):
+        foreign = urlsafe_b64encode('{"startkey": 3, "startkey_docid": "e"}')
+        self.assertRaises(InvalidContinuationTokenException, self.dbm.load_view_page, 'by_values', 3, foreign,
+                          startkey=1, endkey=2)
+        self.assertRaises(InvalidContinuationTokenException, self.dbm.load_view_page, 'by_values', 3, foreign,
+                          descending=True, startkey=2, endkey=1)
+        self.assertRaises(InvalidContinuationTokenException, self.dbm.load_view_page, 'by_values', 3, foreign,
+                          key=1)
+        self.assertEqual(['e'], [row.id for row in self.dbm.load_view_page('by_values', 3, foreign, startkey=2,
+                                                                            endkey=3)[0]])
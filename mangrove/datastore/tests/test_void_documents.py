@@ -0,0 +1,48 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import unittest
+from couchdb.client import Row
+from couchdb.http import ResourceConflict, ServerError
+from mock import Mock
+from mangrove.datastore.database import DatabaseManager
+from mangrove.errors.MangroveException import FailedToSaveDataObject
+
+
+class TestVoidDocuments(unittest.TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.docs = dict(r1=dict(_id="r1", _rev="1-a", document_type="DataRecord"),
+                         r2=dict(_id="r2", _rev="1-a", document_type="DataRecord"),
+                         r3=dict(_id="r3", _rev="1-a", document_type="DataRecord", void=True))
+        self.dbm._load_all_docs.side_effect = lambda ids: [
+            Row(id=id, key=id, doc=dict(self.docs[id])) if id in self.docs else Row(key=id, error="not_found")
+            for id in ids]
+        self.saved = []
+        self.dbm._save_documents.side_effect = lambda documents: [(True, document.id, "2-b") for document in
+                                                                  self._saved(documents)]
+
+    def _saved(self, documents):
+        self.saved.append([(document.id, document.void) for document in documents])
+        return documents
+
+    def test_should_void_documents_in_batches(self):
+        voided = DatabaseManager.void_documents(self.dbm, ["r1", "r2", "r3", "missing", "r1"], batch_size=2)
+
+        self.assertEqual(2, voided)
+        self.assertEqual([[("r1", True), ("r2", True)]], self.saved)
+        self.assertEqual([["r1", "r2"], ["r3", "missing"]],
+                         [call[0][0] for call in self.dbm._load_all_docs.call_args_list])
+
+    def test_should_read_and_void_conflicting_documents_again(self):
+        results = [[(True, "r1", "2-b"), (False, "r2", ResourceConflict())], [(True, "r2", "3-c")]]
+        self.dbm._save_documents.side_effect = lambda documents: results.pop(0)
+
+        self.assertEqual(2, DatabaseManager.void_documents(self.dbm, ["r1", "r2"]))
+        self.assertEqual(["r2"], self.dbm._load_all_docs.call_args[0][0])
+
+    def test_should_fail_on_other_errors_and_repeated_conflicts(self):
+        self.dbm._save_documents.side_effect = lambda documents: [(False, "r1", ServerError())]
+        self.assertRaises(FailedToSaveDataObject, DatabaseManager.void_documents, self.dbm, ["r1"])
+
+        self.dbm._save_documents.side_effect = lambda documents: [(False, "r1", ResourceConflict())]
+        self.assertRaises(FailedToSaveDataObject, DatabaseManager.void_documents, self.dbm, ["r1"])
+        self.assertEqual(4, self.dbm._load_all_docs.call_count)
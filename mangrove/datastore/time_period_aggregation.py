@@ -1,7 +1,14 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 from _collections import defaultdict
-from mangrove.form_model.form_model import get_form_model_by_code
-from mangrove.utils.types import is_empty
+from datetime import date, datetime, timedelta
+from functools import partial
+from couchdb.client import Row
+from mangrove.datastore.aggregation_cache import cached_aggregation
+from mangrove.datastore.data import LocationAggregration, TypeAggregration, _translate_aggregation_type
+from mangrove.datastore.summaries import Summary, percentile, is_summary_function, MEDIAN, COUNT_DISTINCT
+from mangrove.form_model.form_model import get_form_model_by_code, get_form_models_by_code
+from mangrove.utils.concurrency import run_concurrently
+from mangrove.utils.types import is_empty, is_sequence
 
 """
     Example usage of predefined aggregate:
@@ -45,10 +52,32 @@ from mangrove.utils.types import is_empty
     Returns one row per entity, with the aggregated values for each field.
     {"<entity_id>": {"patients": 10, 'meds': 20, 'beds': 300 , 'director': "Dr. A"}}
 
+    3. Aggregate over any range of days, both ends included.
+
+    values = aggregate_for_time_period(
+        self.manager,
+        form_code='CL1',
+        aggregates=[Sum("patients"), Min('meds'), Max('beds'),Latest("director")],
+        period=DateRange(date(2010, 2, 15), date(2010, 3, 31))
+        )
+
+    Returns one row per entity, with the aggregated values for each field,
+    combined from the day, month and year buckets that cover the range.
+
     2. Aggregate on a location level = 2
 
-    #TODO
-    Returns {("India", "MH"): {"patients": 2}}
+    values = aggregate_for_time_period(
+        self.manager,
+        form_code='CL1',
+        aggregates=[Sum("patients"), Latest("director")],
+        period=Month(2, 2010),
+        aggregate_on=LocationAggregration(level=2)
+        )
+
+    Returns a subtotal for every location down to level 2, from one read of
+    the period's views and of the aggregation paths of the entities.
+    {("India",): {"patients": 60, ...}, ("India", "MH"): {"patients": 10, ...}, ...}
+    With include_grand_totals the total of all entities is under "GrandTotals".
 
     3. All entities, selected fields, filtered by location,
 
@@ -63,7 +92,8 @@ from mangrove.utils.types import is_empty
 
     5. Aggregate on any hierarchy,
 
-    #TODO
+    Same as 2, with aggregate_on=TypeAggregration(type='governance', level=3).
+    A level of 0 gives subtotals at every level of the paths.
 
     6. Fetch aggregation for all the fields for all entities of a
     given type, use '*' instead of field name,
@@ -71,9 +101,12 @@ from mangrove.utils.types import is_empty
     #TODO
 """
 
+@cached_aggregation
 def aggregate_for_time_period(dbm, form_code, period, aggregates=None, aggregate_on=None, filter=None,
                               include_grand_totals=False):
     form_model = get_form_model_by_code(dbm, form_code)
+    if isinstance(aggregate_on, LocationAggregration) or isinstance(aggregate_on, TypeAggregration):
+        return _aggregate_by_path(dbm, form_model, period, aggregates, aggregate_on, include_grand_totals)
     statsdict = _get_stats_aggregation(aggregates, dbm, form_model, period)
 
     if include_grand_totals is True:
@@ -81,11 +114,117 @@ def aggregate_for_time_period(dbm, form_code, period, aggregates=None, aggregate
 
     if _latest_aggregation_required(aggregates):
         latestdict = _get_latest_aggregation(aggregates, dbm, form_model, period)
-        return _merge(statsdict, latestdict)
+        statsdict = _merge(statsdict, latestdict)
+
+    if _summary_aggregation_required(aggregates):
+        summaries = _get_summaries_for_forms(dbm, {form_code: form_model.entity_type}, period)[form_code]
+        _update(statsdict, _get_summary_aggregation(aggregates, summaries, include_grand_totals))
 
     return statsdict
 
 
+@cached_aggregation
+def aggregate_for_forms_for_time_period(dbm, form_codes, period, aggregates=None, include_grand_totals=False):
+    """
+    Returns {form code: what aggregate_for_time_period returns for it}. The form models are read with one
+    multi-key request, and each view is read once per bucket of the period and form, only for the keys of
+    that form, all the reads running concurrently.
+    """
+    assert is_sequence(form_codes)
+    forms = get_form_models_by_code(dbm, form_codes)
+    if not forms:
+        return {}
+    entity_types = dict((form_code, form.entity_type) for form_code, form in forms.items())
+    loads = [partial(_load_view_for_forms, dbm, entity_types, period, _stats_view, _combine_stats)]
+    latest_required = _latest_aggregation_required(aggregates)
+    if latest_required:
+        loads.append(partial(_load_view_for_forms, dbm, entity_types, period, _latest_view, _combine_latest))
+    summary_required = _summary_aggregation_required(aggregates)
+    if summary_required:
+        loads.append(partial(_get_summaries_for_forms, dbm, entity_types, period))
+    loaded = run_concurrently(loads)
+
+    results = {}
+    for form_code in forms:
+        statsdict = _aggregate_rows(aggregates, loaded[0][form_code])
+        if include_grand_totals is True:
+            _calculate_grand_total(statsdict)
+        if latest_required:
+            statsdict = _merge(statsdict, _aggregate_rows(aggregates, loaded[1][form_code]))
+        if summary_required:
+            _update(statsdict, _get_summary_aggregation(aggregates, loaded[-1][form_code], include_grand_totals))
+        results[form_code] = statsdict
+    return results
+
+
+def _aggregate_by_path(dbm, form_model, period, aggregates, aggregate_on, include_grand_totals):
+    """
+    Returns the results of the period per prefix of the aggregation path of the entities, the
+    per entity rows of each view being combined into every prefix they fall under in one pass.
+    """
+    form_code, entity_type = form_model.form_code, form_model.entity_type
+    loads = [partial(_load_aggregation_paths, dbm, entity_type, aggregate_on),
+             partial(_load_aggregate_view, dbm, form_code, entity_type, period)]
+    latest_required = _latest_aggregation_required(aggregates)
+    if latest_required:
+        loads.append(partial(_load_latest_view, dbm, form_code, entity_type, period))
+    summary_required = _summary_aggregation_required(aggregates)
+    if summary_required:
+        loads.append(partial(_get_summaries_for_forms, dbm, {form_code: entity_type}, period))
+    loaded = run_concurrently(loads)
+
+    paths, level = loaded[0], aggregate_on.level
+    results = _aggregate_rows(aggregates, _group_by_path(loaded[1], paths, level, _combine_stats))
+    if latest_required:
+        _update(results, _aggregate_rows(aggregates, _group_by_path(loaded[2], paths, level, _combine_latest)))
+    if summary_required:
+        summaries = _group_summaries_by_path(loaded[-1][form_code], paths, level)
+        _update(results, _get_summary_aggregation(aggregates, summaries, False))
+    totals = results.pop((), None)
+    if include_grand_totals is True and totals is not None:
+        results[GRAND_TOTALS] = totals
+    return results
+
+
+def _load_aggregation_paths(dbm, entity_type, aggregate_on):
+    """Returns {short code: path} of the entities of entity_type, for the hierarchy aggregate_on groups by."""
+    aggregation_type = _translate_aggregation_type(aggregate_on)
+    rows = dbm.load_all_rows_in_view("entity_aggregation_paths", startkey=[entity_type],
+                                     endkey=[entity_type, {}])
+    return dict((row.key[1], row.value.get(aggregation_type)) for row in rows
+                if row.value.get(aggregation_type) is not None)
+
+
+def _path_prefixes(path, level):
+    """Returns the prefixes of path down to level parts, or all of them for level 0, the empty one included."""
+    depth = len(path) if level == 0 else min(level, len(path))
+    return [tuple(path[:length]) for length in range(depth + 1)]
+
+
+def _group_by_path(rows, paths, level, combine):
+    cells = {}
+    for row in rows:
+        path = paths.get(_get_short_code(row))
+        if path is None:
+            continue
+        field_name = _get_field_name(row)
+        for prefix in _path_prefixes(path, level):
+            key = (prefix, field_name)
+            cells[key] = combine(cells[key], row.value) if key in cells else row.value
+    return [Row(key=[prefix, field_name], value=value) for (prefix, field_name), value in cells.items()]
+
+
+def _group_summaries_by_path(summaries, paths, level):
+    grouped = {}
+    for (short_code, field_name), summary in summaries.items():
+        path = paths.get(short_code)
+        if path is None:
+            continue
+        for prefix in _path_prefixes(path, level):
+            grouped.setdefault((prefix, field_name), Summary()).merge(summary)
+    return grouped
+
+
 class Aggregate(object):
     def __init__(self, field_name, aggregate_name):
         self.field_name = field_name
@@ -119,11 +258,30 @@ class Latest(Aggregate):
         super(Latest, self).__init__(field_name, "latest")
 
 
+class Median(Aggregate):
+    def __init__(self, field_name):
+        super(Median, self).__init__(field_name, MEDIAN)
+
+
+class Percentile(Aggregate):
+    def __init__(self, field_name, percent):
+        super(Percentile, self).__init__(field_name, percentile(percent))
+
+
+class CountDistinct(Aggregate):
+    def __init__(self, field_name):
+        super(CountDistinct, self).__init__(field_name, COUNT_DISTINCT)
+
+
 class Month(object):
     def __init__(self, month, year):
         self.month = month
         self.year = year
 
+    @property
+    def name(self):
+        return "month"
+
     @property
     def stats_view(self):
         return "monthly_aggregate_stats"
@@ -145,6 +303,10 @@ class Year(object):
     def __init__(self, year):
         self.year = year
 
+    @property
+    def name(self):
+        return "year"
+
     @property
     def stats_view(self):
         return "yearly_aggregate_stats"
@@ -167,6 +329,10 @@ class Week(object):
         self.week = week
         self.year = year
 
+    @property
+    def name(self):
+        return "week"
+
     @property
     def period(self):
         return self.week
@@ -189,6 +355,10 @@ class Day(object):
         self.month= month
         self.year = year
 
+    @property
+    def name(self):
+        return "day"
+
     @property
     def period(self):
         return self.day
@@ -206,21 +376,188 @@ class Day(object):
         return [self.year,self.month,self.day]
 
 
-def _get_aggregates_for_field(field_name, aggregates, row):
+class DateRange(object):
+    """
+    Any range of days, start and end included. Its results are combined from the buckets the daily,
+    monthly and yearly views already reduce, taking whole years and months where the range covers
+    them. Each view needed, stats, latest or both, is read once per bucket, concurrently, and only
+    for the keys of the form: at most 30 days and 11 months at either end plus the whole years
+    between. A query costs in proportion to the number of buckets and to the data of the form in
+    them, rather than to the number of data records in the range.
+    """
+    def __init__(self, start, end):
+        self.start = _as_date(start)
+        self.end = _as_date(end)
+        assert self.start <= self.end
+
+    @property
+    def name(self):
+        return "range"
+
+    def buckets(self):
+        """
+        Returns (first, last) pairs of Day, Month or Year periods, each naming a run of consecutive
+        buckets of one view; together they cover the range exactly once.
+        """
+        first_month = self.start if self.start.day == 1 else _next_month(self.start)
+        after_end = self.end + timedelta(days=1)
+        months_end = date(after_end.year, after_end.month, 1)
+        if first_month >= months_end:
+            return [_days(self.start, self.end)]
+
+        buckets = []
+        if self.start < first_month:
+            buckets.append(_days(self.start, first_month - timedelta(days=1)))
+        first_year = first_month.year if first_month.month == 1 else first_month.year + 1
+        last_year = months_end.year - 1
+        if first_year <= last_year:
+            if first_month < date(first_year, 1, 1):
+                buckets.append(_months(first_month, date(first_year - 1, 12, 1)))
+            buckets.append((Year(first_year), Year(last_year)))
+            if date(last_year + 1, 1, 1) < months_end:
+                buckets.append(_months(date(last_year + 1, 1, 1), _previous_month(months_end)))
+        else:
+            buckets.append(_months(first_month, _previous_month(months_end)))
+        if months_end <= self.end:
+            buckets.append(_days(months_end, self.end))
+        return buckets
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _next_month(day):
+    return date(day.year + 1, 1, 1) if day.month == 12 else date(day.year, day.month + 1, 1)
+
+
+def _previous_month(day):
+    return date(day.year - 1, 12, 1) if day.month == 1 else date(day.year, day.month - 1, 1)
+
+
+def _days(first, last):
+    return Day(first.day, first.month, first.year), Day(last.day, last.month, last.year)
+
+
+def _months(first, last):
+    return Month(first.month, first.year), Month(last.month, last.year)
+
+
+def _get_aggregates_for_field(field_name, aggregates, value):
     for aggregate in aggregates:
         if aggregate.field_name == field_name:
-            return aggregate.get(row.value)
+            return aggregate.get(value)
     return None
 
 
-def _load_aggregate_view(dbm, form_model, period):
-    startkey = period.startkey_start + [form_model.form_code, form_model.entity_type]
+def _load_aggregate_view(dbm, form_code, entity_type, period):
+    if isinstance(period, DateRange):
+        return _load_view_for_forms(dbm, {form_code: entity_type}, period, _stats_view, _combine_stats)[form_code]
+    startkey = period.startkey_start + [form_code, entity_type]
     rows = dbm.load_all_rows_in_view(period.stats_view, group=True,
                                      startkey=startkey,
                                      endkey=startkey + [{}])
     return rows
 
 
+def _load_view_for_forms(dbm, entity_types, period, view_of, combine):
+    """
+    Reads view_of(bucket) for each bucket of the period and form of entity_types, a dict of form code to
+    entity type, and returns {form code: rows keyed [form_code, entity_type, short_code, field]}. Each read
+    covers the keys of one form and its entity type in one bucket, and the reads run concurrently.
+    """
+    ranges = _bucket_ranges(entity_types, period)
+    loaded = run_concurrently([partial(dbm.load_all_rows_in_view, view_of(bucket), group=True, startkey=startkey,
+                                       endkey=endkey) for bucket, form_code, startkey, endkey in ranges])
+    values = dict((form_code, {}) for form_code in entity_types)
+    for (bucket, form_code, startkey, endkey), rows in zip(ranges, loaded):
+        cells = values[form_code]
+        for row in rows:
+            key = (_get_short_code(row), _get_field_name(row))
+            cells[key] = combine(cells[key], row.value) if key in cells else row.value
+    return dict((form_code, [Row(key=[form_code, entity_types[form_code], short_code, field_name], value=value)
+                             for (short_code, field_name), value in cells.items()])
+                for form_code, cells in values.items())
+
+
+def _get_summaries_for_forms(dbm, entity_types, period):
+    """
+    Returns what _load_summaries_for_forms returns, merged from the summaries stored in the period
+    rollups, which are created on the first call for a database.
+    """
+    from mangrove.datastore.rollups import load_summaries  # rollups imports this module
+
+    return load_summaries(dbm, entity_types, period)
+
+
+def _load_summaries_for_forms(dbm, entity_types, period):
+    """
+    Returns {form code: {(short code, field): Summary}} for the forms of entity_types, built from the
+    unreduced rows of the latest views of the buckets of the period, so in time proportional to the
+    number of data records in the period. Only the rollups use it, to rebuild the summaries of a period.
+    """
+    values = dict((form_code, {}) for form_code in entity_types)
+    for bucket, form_code, startkey, endkey in _bucket_ranges(entity_types, period):
+        for row in dbm.iter_view_rows(bucket.latest_view, reduce=False, startkey=startkey, endkey=endkey):
+            key = (_get_short_code(row), _get_field_name(row))
+            if key not in values[form_code]:
+                values[form_code][key] = Summary()
+            values[form_code][key].add(row.value.get('value'))
+    return values
+
+
+def _bucket_ranges(entity_types, period):
+    """
+    Returns (bucket, form code, startkey, endkey) for each bucket of the period and form of entity_types,
+    the range of the keys of the form and its entity type in the bucket.
+    """
+    ranges = []
+    for bucket in _buckets_of(period):
+        for form_code, entity_type in sorted(entity_types.items()):
+            startkey = bucket.startkey_start + [form_code, entity_type]
+            ranges.append((bucket, form_code, startkey, startkey + [{}]))
+    return ranges
+
+
+def _buckets_of(period):
+    if not isinstance(period, DateRange):
+        return [period]
+    return [bucket for first, last in period.buckets() for bucket in _each_bucket(first, last)]
+
+
+def _each_bucket(first, last):
+    """Returns the Day, Month or Year buckets from first to last, both included."""
+    if isinstance(first, Year):
+        return [Year(year) for year in range(first.year, last.year + 1)]
+    if isinstance(first, Month):
+        month, end, buckets = date(first.year, first.month, 1), date(last.year, last.month, 1), []
+        while month <= end:
+            buckets.append(Month(month.month, month.year))
+            month = _next_month(month)
+        return buckets
+    start, end = date(first.year, first.month, first.day), date(last.year, last.month, last.day)
+    days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+    return [Day(day.day, day.month, day.year) for day in days]
+
+
+def _stats_view(period):
+    return period.stats_view
+
+
+def _latest_view(period):
+    return period.latest_view
+
+
+def _combine_stats(stats, other):
+    return dict(sum=stats['sum'] + other['sum'], count=stats['count'] + other['count'],
+                min=min(stats['min'], other['min']), max=max(stats['max'], other['max']),
+                sumsqr=stats['sumsqr'] + other['sumsqr'])
+
+
+def _combine_latest(latest, other):
+    return other if other['timestamp'] > latest['timestamp'] else latest
+
+
 def _get_short_code(row):
     short_code = row.key[-2]
     return short_code
@@ -232,19 +569,14 @@ def _get_field_name(row):
 
 
 def _get_stats_aggregation(aggregates, dbm, form_model, period):
-    rows = _load_aggregate_view(dbm, form_model, period)
-    results = defaultdict(dict)
-    for row in rows:
-        field_name = _get_field_name(row)
-        result = _get_aggregates_for_field(field_name, aggregates, row)
-
-        if result is not None:
-            results[_get_short_code(row)][field_name] = result
-    return results
+    rows = _load_aggregate_view(dbm, form_model.form_code, form_model.entity_type, period)
+    return _aggregate_rows(aggregates, rows)
 
 
-def _load_latest_view(dbm, form_model, period):
-    startkey = period.startkey_start+[form_model.form_code, form_model.entity_type]
+def _load_latest_view(dbm, form_code, entity_type, period):
+    if isinstance(period, DateRange):
+        return _load_view_for_forms(dbm, {form_code: entity_type}, period, _latest_view, _combine_latest)[form_code]
+    startkey = period.startkey_start+[form_code, entity_type]
     rows = dbm.load_all_rows_in_view(period.latest_view, group=True,
                                      startkey=startkey,
                                      endkey=startkey + [{}])
@@ -252,11 +584,15 @@ def _load_latest_view(dbm, form_model, period):
 
 
 def _get_latest_aggregation(aggregates, dbm, form_model, period):
-    rows = _load_latest_view(dbm, form_model, period)
+    rows = _load_latest_view(dbm, form_model.form_code, form_model.entity_type, period)
+    return _aggregate_rows(aggregates, rows)
+
+
+def _aggregate_rows(aggregates, rows):
     results = defaultdict(dict)
     for row in rows:
         field_name = _get_field_name(row)
-        result = _get_aggregates_for_field(field_name, aggregates, row)
+        result = _get_aggregates_for_field(field_name, aggregates, row.value)
         if result is not None:
             results[_get_short_code(row)][field_name] = result
     return results
@@ -267,6 +603,34 @@ def _latest_aggregation_required(aggregates):
     return not is_empty(result)
 
 
+def _summary_aggregation_required(aggregates):
+    return any(is_summary_function(aggregate.aggregate_name) for aggregate in aggregates)
+
+
+def _get_summary_aggregation(aggregates, summaries, include_grand_totals):
+    summary_aggregates = [aggregate for aggregate in aggregates if is_summary_function(aggregate.aggregate_name)]
+    results = defaultdict(dict)
+    totals = {}
+    for (short_code, field_name), summary in summaries.items():
+        result = _get_aggregates_for_field(field_name, summary_aggregates, summary)
+        if result is not None:
+            results[short_code][field_name] = result
+        if include_grand_totals is True and _get_aggregate_for(field_name, summary_aggregates) is not None:
+            totals.setdefault(field_name, Summary()).merge(summary)
+    for field_name, summary in totals.items():
+        result = _get_aggregates_for_field(field_name, summary_aggregates, summary)
+        if result is not None:
+            results[GRAND_TOTALS][field_name] = result
+    return results
+
+
+def _get_aggregate_for(field_name, aggregates):
+    for aggregate in aggregates:
+        if aggregate.field_name == field_name:
+            return aggregate
+    return None
+
+
 GRAND_TOTALS = "GrandTotals"
 
 def _calculate_grand_total(statsdict):
@@ -285,6 +649,11 @@ def _merge_grand_total(resultdict, statsdict):
         resultdict[GRAND_TOTALS] = grand_total
 
 
+def _update(resultdict, otherdict):
+    for key, values in otherdict.items():
+        resultdict.setdefault(key, {}).update(values)
+
+
 def _merge(statsdict, latestdict):
     resultdict = defaultdict(dict)
     for key in latestdict:
@@ -290,3 +290,11 @@ class DeleteRequestParserInvalidFormatException(MangroveException):
 class DeleteRequestParserWrongNumberOfAnswersException(MangroveException):
     def __init__(self, message):
         MangroveException.__init__(self, u"Could not parse, Wrong number of answers submitted.", (message, ))
+
+class InvalidContinuationTokenException(MangroveException):
+    def __init__(self, token):
+        MangroveException.__init__(self, u"Invalid continuation token: %s" % token, (token, ))
+
+class ShortCodeAllocationException(MangroveException):
+    def __init__(self, entity_type):
+        MangroveException.__init__(self, u"Could not reserve short codes for %s" % entity_type, (entity_type, ))
@@ -1,5 +1,6 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
+import copy
 from datetime import datetime
 from babel.dates import format_date
 from mangrove.data_cleaner import TelephoneNumber
@@ -205,6 +206,14 @@ class Field(object):
     def set_value(self, value):
         self.value = value
 
+    def _copy(self):
+        """Returns a copy whose attributes, value and errors can be changed without changing this field."""
+        copied = copy.copy(self)
+        copied._dict = dict((key, copy.copy(value) if isinstance(value, (list, dict)) else value)
+                            for key, value in self._dict.items())
+        copied.errors = list(self.errors)
+        return copied
+
     def get_constraint_text(self):
         return ""
 
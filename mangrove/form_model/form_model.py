@@ -1,5 +1,7 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 from collections import OrderedDict
+import copy
+from threading import Lock
 from mangrove.form_model.location import Location
 from mangrove.form_model.validator_factory import validator_factory
 from mangrove.datastore import entity
@@ -9,6 +11,7 @@ from mangrove.errors.MangroveException import FormModelDoesNotExistsException, Q
     EntityQuestionAlreadyExistsException, MangroveException, DataObjectAlreadyExists, QuestionAlreadyExistsException
 from mangrove.form_model.field import TextField, create_question_from
 from mangrove.form_model.validators import MandatoryValidator
+from mangrove.utils.cache import LRUCache
 from mangrove.utils.types import is_sequence, is_string, is_empty, is_not_empty
 from mangrove.form_model import field
 
@@ -35,17 +38,113 @@ MOBILE_NUMBER_FIELD_CODE = "m"
 REPORTER = "reporter"
 GLOBAL_REGISTRATION_FORM_ENTITY_TYPE = "registration"
 
+FORM_MODEL_CACHE_SIZE = 500
+CHANGES_BATCH_SIZE = 500
+_EVERY_FORM = object()
+
+_form_model_caches = {}
+_form_model_caches_lock = Lock()
+
+
+def form_model_cache(dbm):
+    """Returns the FormModelCache of this dbm."""
+    with _form_model_caches_lock:
+        if dbm not in _form_model_caches:
+            _form_model_caches[dbm] = FormModelCache(dbm)
+        return _form_model_caches[dbm]
+
+
+class FormModelCache(LRUCache):
+    """
+    The parsed form models of a dbm, keyed by form code. Before every lookup the cache reads the _changes
+    feed since the previous one, which costs one small request when nothing changed, and drops the form
+    models that were saved or deleted meanwhile, by this process or by another one.
+    """
+
+    def __init__(self, dbm, max_size=FORM_MODEL_CACHE_SIZE):
+        LRUCache.__init__(self, max_size)
+        self.dbm = dbm
+        self.seq = None
+        self._invalidated_at = {}
+        self._catch_up_lock = Lock()
+
+    def catch_up(self):
+        """Drops the form models changed since the last call and returns the current seq."""
+        with self._catch_up_lock:
+            seq = self.dbm.update_seq()
+            if self.seq is None:
+                self.clear()
+                self.seq = seq
+            while self.seq != seq:
+                results, last_seq = self.dbm.changes(since=self.seq, limit=CHANGES_BATCH_SIZE)
+                for result in results:
+                    self._invalidate_change(result.get('doc'), last_seq)
+                self.seq = last_seq
+                if len(results) < CHANGES_BATCH_SIZE:
+                    break
+            return self.seq
+
+    def put_if_current(self, code, form_model, seq):
+        """Caches form_model, read after catch_up returned seq, unless its form changed since."""
+        with self._catch_up_lock:
+            invalidated_at = [self._invalidated_at[key] for key in (code, _EVERY_FORM) if key in self._invalidated_at]
+            if all(at <= seq for at in invalidated_at):
+                self.put(code, form_model)
+
+    def _invalidate_change(self, doc, seq):
+        if doc is None or doc.get('_deleted'):
+            self.clear()
+            self._invalidated_at[_EVERY_FORM] = seq
+            return
+        if doc.get('document_type') != 'FormModel':
+            return
+        # a form whose code was edited is still cached under its former code
+        codes = set([doc.get('form_code')]) | set(code for code, form_model in self.items()
+                                                  if form_model.id == doc.get('_id'))
+        for code in codes:
+            self.invalidate(code)
+            self._invalidated_at[code] = seq
 
 
 def get_form_model_by_code(dbm, code):
     assert isinstance(dbm, DatabaseManager)
     assert is_string(code)
-    rows = dbm.load_all_rows_in_view('questionnaire', key=code)
-    if not len(rows):
-        raise FormModelDoesNotExistsException(code)
-
-    doc = FormModelDocument.wrap(rows[0]['value'])
-    return FormModel.new_from_doc(dbm, doc)
+    cache = form_model_cache(dbm)
+    seq = cache.catch_up()
+    form_model = cache.get(code)
+    if form_model is None:
+        rows = dbm.load_all_rows_in_view('questionnaire', key=code)
+        if not len(rows):
+            raise FormModelDoesNotExistsException(code)
+        form_model = FormModel.new_from_doc(dbm, FormModelDocument.wrap(rows[0]['value']))
+        cache.put_if_current(code, form_model, seq)
+
+    # FormModels are mutated by their callers (bind, field edits), so every caller gets its own copy
+    return form_model._copy()
+
+
+def get_form_models_by_code(dbm, codes):
+    """
+    Returns {form code: FormModel} for codes with one multi-key view request, and refreshes the form model
+    cache with what it read. Raises FormModelDoesNotExistsException for the first code without a form.
+    """
+    assert isinstance(dbm, DatabaseManager)
+    assert is_sequence(codes)
+    cache = form_model_cache(dbm)
+    seq = cache.catch_up()
+    codes = list(OrderedDict.fromkeys(codes))
+    documents = {}
+    if codes:
+        for row in dbm.load_all_rows_in_view('questionnaire', keys=codes):
+            documents.setdefault(row['key'], row['value'])
+    form_models = OrderedDict()
+    for code in codes:
+        if code not in documents:
+            raise FormModelDoesNotExistsException(code)
+        form_model = FormModel.new_from_doc(dbm, FormModelDocument.wrap(documents[code]))
+        cache.put_if_current(code, form_model, seq)
+        form_models[code] = form_model._copy()
+    return form_models
 
 def list_form_models_by_code(dbm, codes):
     assert isinstance(dbm, DatabaseManager)
@@ -195,7 +294,29 @@ class FormModel(DataObject):
         for key, value in self._snapshots.items():
             json_snapshots[key] = [each._to_json() for each in value]
         self._doc.snapshots = json_snapshots
-        return DataObject.save(self)
+        result = DataObject.save(self)
+        self._invalidate_cached_form_models()
+        return result
+
+    def delete(self):
+        DataObject.delete(self)
+        self._invalidate_cached_form_models()
+
+    def _invalidate_cached_form_models(self):
+        form_model_cache(self._dbm).invalidate(self.form_code)
+
+    def _copy(self):
+        """
+        Returns a copy of this FormModel whose document, fields and field values can be changed without
+        changing this one. Field types, constraints and validators, which are not edited in place, are shared.
+        """
+        form_model = copy.copy(self)
+        form_model._doc = FormModelDocument.wrap(dict((key, copy.copy(value)) for key, value in self._doc.unwrap().items()))
+        form_model._form_fields = [f._copy() for f in self._form_fields]
+        form_model._snapshots = dict((key, list(fields)) for key, fields in self._snapshots.items())
+        form_model.errors = list(self.errors)
+        form_model.validators = list(self.validators)
+        return form_model
 
 
     def get_field_by_name(self, name):
@@ -524,10 +645,7 @@ class GlobalRegistrationFormSubmission(FormSubmission):
 
     def void_existing_data_records(self, dbm, form_code=None):
         data_records = dbm.view.data_record_by_form_code(key = [REGISTRATION_FORM_CODE, self.short_code])
-        for data_record in data_records:
-            data_record_doc = data_record.value
-            data_record_doc['void'] = True
-            dbm.database.save(data_record_doc)
+        return dbm.void_documents([data_record.id for data_record in data_records])
 
 class EntityRegistrationFormSubmission(FormSubmission):
     def __init__(self, form_model, answers, errors, location_tree=None):
@@ -543,10 +661,7 @@ class EntityRegistrationFormSubmission(FormSubmission):
 
     def void_existing_data_records(self, dbm,form_code):
         data_records = dbm.view.data_record_by_form_code(key = [form_code, self.short_code])
-        for data_record in data_records:
-            data_record_doc = data_record.value
-            data_record_doc['void'] = True
-            dbm.database.save(data_record_doc)
+        return dbm.void_documents([data_record.id for data_record in data_records])
 
 
 class FormSubmissionFactory(object):
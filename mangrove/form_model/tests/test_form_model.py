@@ -1,12 +1,12 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
-from mangrove.form_model.form_model import get_form_model_by_entity_type, list_form_models_by_code
+from mangrove.form_model.form_model import get_form_model_by_entity_type, list_form_models_by_code, get_form_models_by_code
 from mangrove.contrib.registration_validators import MobileNumberValidationsForReporterRegistrationValidator
 from mangrove.form_model.form_model import get_form_model_by_code
 from mangrove.form_model.validators import MandatoryValidator
 
 from mangrove.datastore.documents import FormModelDocument
 from mangrove.form_model.field import  TextField, IntegerField, SelectField, DateField
-from mangrove.errors.MangroveException import QuestionCodeAlreadyExistsException, EntityQuestionAlreadyExistsException, DataObjectAlreadyExists, QuestionAlreadyExistsException
+from mangrove.errors.MangroveException import FormModelDoesNotExistsException, QuestionCodeAlreadyExistsException, EntityQuestionAlreadyExistsException, DataObjectAlreadyExists, QuestionAlreadyExistsException
 from mangrove.form_model.form_model import FormModel
 from mangrove.form_model.validation import NumericRangeConstraint, TextLengthConstraint, RegexConstraint
 from mangrove.utils.form_model_builder import FormModelBuilder, create_default_ddtype
@@ -330,6 +330,17 @@ class FormModelTest(MangroveTestCase):
         self.assertEqual('form_code1', forms[0].form_code)
         self.assertEqual('form_code2', forms[1].form_code)
 
+    def test_should_get_form_models_by_code_in_one_request(self):
+        fields = [TextField('name', 'eid', 'label', self.default_ddtype, entity_question_flag=True)]
+        FormModel(self.manager, 'test_form', 'label', 'form_code1', fields=fields, entity_type=['Clinic']).save()
+
+        forms = get_form_models_by_code(self.manager, ['form_code1', '1', 'form_code1'])
+
+        self.assertEqual(['form_code1', '1'], forms.keys())
+        self.assertEqual('form_code1', forms['form_code1'].form_code)
+        self.assertRaises(FormModelDoesNotExistsException, get_form_models_by_code, self.manager,
+                          ['form_code1', 'missing'])
+
     def test_should_get_string_rep_of_form_model(self):
         submission = {"ID": "id", "Q1": "12345", "Q2": "25", "Q3": "a"}
         stringified_dict = self.form_model.stringify(values=self.form_model.validate_submission(submission)[0])
@@ -6,7 +6,7 @@ from mangrove.datastore.documents import FormModelDocument
 from mangrove.datastore.database import DatabaseManager
 from mangrove.datastore.datadict import DataDictType
 from mangrove.form_model.field import TextField, IntegerField, SelectField, DateField, GeoCodeField
-from mangrove.form_model.form_model import FormModel, get_form_model_by_entity_type
+from mangrove.form_model.form_model import FormModel, get_form_model_by_entity_type, get_form_model_by_code, form_model_cache
 from mangrove.form_model.validation import NumericRangeConstraint, TextLengthConstraint
 
 
@@ -219,6 +219,86 @@ class TestFormModel(unittest.TestCase):
         self.assertEqual(1, form_model_mock.new_from_doc.call_count)
         form_model_document_mock.wrap.assert_called_once_with(document)
 
+class TestFormModelCache(unittest.TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        ddtype = DataDictType(self.dbm, name='Name', slug='name', primitive_type='string')
+        question = TextField(name="entity_question", code="ID", label="What is associated entity",
+            entity_question_flag=True, ddtype=ddtype)
+        form_model = FormModel(self.dbm, entity_type=["clinic"], name="aids", label="Aids form_model",
+            form_code="cli001", type='survey', fields=[question])
+        form_model._doc.json_fields = [question._to_json()]
+        self.form_json = form_model._doc.unwrap()
+        self.form_json['_rev'] = '1-abc'
+        self.dbm.load_all_rows_in_view.return_value = [{'value': self.form_json}]
+        self.dbm.update_seq.return_value = 1
+
+    def test_should_not_query_view_again_while_entry_is_fresh(self):
+        get_form_model_by_code(self.dbm, 'cli001')
+        form_model = get_form_model_by_code(self.dbm, 'cli001')
+
+        self.assertEqual('cli001', form_model.form_code)
+        self.assertEqual(1, self.dbm.load_all_rows_in_view.call_count)
+        self.assertEqual(1, form_model_cache(self.dbm).hits)
+
+    def test_should_reload_form_model_changed_by_another_process(self):
+        get_form_model_by_code(self.dbm, 'cli001')
+        changed = dict(self.form_json, _rev='2-def', name='changed')
+        self.dbm.update_seq.return_value = 2
+        self.dbm.changes.return_value = ([dict(seq=2, id=changed['_id'], doc=changed)], 2)
+        self.dbm.load_all_rows_in_view.return_value = [{'value': changed}]
+
+        form_model = get_form_model_by_code(self.dbm, 'cli001')
+
+        self.assertEqual('changed', form_model.name)
+        self.dbm.changes.assert_called_once_with(since=1, limit=500)
+        self.assertEqual(2, self.dbm.load_all_rows_in_view.call_count)
+
+    def test_should_keep_form_models_when_other_documents_change(self):
+        get_form_model_by_code(self.dbm, 'cli001')
+        self.dbm.update_seq.return_value = 2
+        self.dbm.changes.return_value = ([dict(seq=2, id='record', doc=dict(_id='record',
+                                                                           document_type='DataRecord'))], 2)
+
+        get_form_model_by_code(self.dbm, 'cli001')
+        get_form_model_by_code(self.dbm, 'cli001')
+
+        self.assertEqual(1, self.dbm.load_all_rows_in_view.call_count)
+        self.assertEqual(1, self.dbm.changes.call_count)
+
+    def test_should_not_cache_form_model_changed_while_it_was_read(self):
+        cache = form_model_cache(self.dbm)
+        seq = cache.catch_up()
+        self.dbm.update_seq.return_value = 2
+        self.dbm.changes.return_value = ([dict(seq=2, id=self.form_json['_id'], doc=self.form_json)], 2)
+        cache.catch_up()
+
+        cache.put_if_current('cli001', Mock(), seq)
+
+        self.assertFalse('cli001' in cache)
+
+    def test_should_give_each_caller_its_own_form_model(self):
+        first = get_form_model_by_code(self.dbm, 'cli001')
+        first.fields[0].set_value('cli1')
+        first.fields[0].set_name('changed')
+        first.name = 'changed'
+        first.delete_all_fields()
+        second = get_form_model_by_code(self.dbm, 'cli001')
+
+        self.assertIsNot(first, second)
+        self.assertEqual(1, len(second.fields))
+        self.assertNotEqual('cli1', second.fields[0].value)
+        self.assertEqual('entity_question', second.fields[0].name)
+        self.assertEqual('aids', second.name)
+
+    def test_should_invalidate_cached_form_model_on_save(self):
+        form_model = get_form_model_by_code(self.dbm, 'cli001')
+        self.dbm.load_all_rows_in_view.return_value = []
+        form_model.save()
+
+        self.assertFalse('cli001' in form_model_cache(self.dbm))
+
+
 class DatabaseManagerStub(DatabaseManager):
 
     def __init__(self):
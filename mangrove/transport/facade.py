@@ -1,7 +1,7 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 from mangrove.form_model.form_model import LOCATION_TYPE_FIELD_NAME, GEO_CODE_FIELD_NAME
 from mangrove.form_model.form_model import GLOBAL_REGISTRATION_FORM_ENTITY_TYPE
-from mangrove.datastore.queries import get_entity_count_for_type
+from mangrove.datastore.short_codes import next_short_code_number
 from mangrove.errors.MangroveException import GeoCodeFormatException, MangroveException
 from mangrove.form_model.form_model import ENTITY_TYPE_FIELD_CODE
 from mangrove.form_model.location import Location
@@ -141,6 +141,5 @@ def _set_short_code(dbm, form_model, values):
 
 
 def _generate_short_code(dbm, entity_type):
-    current_count = get_entity_count_for_type(dbm, entity_type.lower())
     entity_type_prefix = entity_type[:3] + "%s"
-    return  entity_type_prefix % (current_count + 1)
\ No newline at end of file
+    return  entity_type_prefix % next_short_code_number(dbm, entity_type)
\ No newline at end of file
@@ -5,6 +5,11 @@ from mangrove.form_model.form_model import FormSubmissionFactory, ENTITY_TYPE_FI
 from mangrove.transport.facade import Response
 from mangrove.utils.types import is_empty
 from mangrove.transport.facade import create_response_from_form_submission
+from mangrove.transport.reporter import invalidate_reporter_cache, is_reporter_type
+
+def _invalidate_reporters_if_needed(dbm, entity_type):
+    if is_reporter_type(entity_type):
+        invalidate_reporter_cache(dbm)
 
 class SubmissionHandler(object):
 
@@ -15,6 +20,7 @@ class SubmissionHandler(object):
         form_submission = FormSubmissionFactory().get_form_submission(form_model, cleaned_data, errors, location_tree=location_tree)
         if form_submission.is_valid:
             form_submission.save(self.dbm)
+            _invalidate_reporters_if_needed(self.dbm, form_submission.entity_type)
         return create_response_from_form_submission(reporters=reporter_names, submission_id=submission_uuid,
         form_submission=form_submission)
 
@@ -29,6 +35,7 @@ class EditRegistrationHandler(object):
                 form_submission.void_existing_data_records(self.dbm)
                 form_submission.update_location_and_geo_code(self.dbm)
             form_submission.update(self.dbm)
+            _invalidate_reporters_if_needed(self.dbm, form_submission.entity_type)
         return create_response_from_form_submission(reporters=reporter_names, submission_id=submission_uuid,
             form_submission=form_submission)
 
@@ -55,6 +62,7 @@ class DeleteHandler(object):
         entity_type = cleaned_data[ENTITY_TYPE_FIELD_CODE]
         if is_empty(errors):
             void_entity(self.dbm, entity_type, short_code)
+            _invalidate_reporters_if_needed(self.dbm, entity_type)
         return Response(reporter_names, submission_uuid, is_empty(errors), errors, None, short_code, cleaned_data,
             False, entity_type, form_model.form_code)
 
@@ -17,7 +17,7 @@ from mangrove.form_model.validation import NumericRangeConstraint, TextLengthCon
 from mangrove.transport.player.player import SMSPlayer
 from mangrove.transport.facade import TransportInfo, Request
 from mangrove.datastore.datadict import DataDictType
-from mangrove.transport.submissions import get_submissions, get_submissions_for_activity_period, submission_count
+from mangrove.transport.submissions import get_submissions, get_submissions_for_activity_period, submission_count, get_submissions_page
 from mangrove.utils.test_utils.submission_builder import SubmissionBuilder
 from mangrove.utils.test_utils.mangrove_test_case import MangroveTestCase
 from mangrove.transport.submissions import Submission
@@ -181,6 +181,17 @@ class TestShouldSaveSMSSubmission(MangroveTestCase):
         self.assertEquals({'Q1': 'ans12', 'Q2': 'ans22'}, submissions[1].values)
         self.assertEquals({'Q1': 'ans1', 'Q2': 'ans2'}, submissions[2].values)
 
+    def test_should_page_through_submissions_with_continuation(self):
+        self._prepare_submissions()
+
+        first_page, continuation = get_submissions_page(self.manager, FORM_CODE, 0, self._tomorrow(), page_size=2)
+        second_page, last_continuation = get_submissions_page(self.manager, FORM_CODE, 0, self._tomorrow(),
+            page_size=2, continuation=continuation)
+        self.assertEquals([{'Q3': 'ans12', 'Q4': 'ans22'}, {'Q1': 'ans12', 'Q2': 'ans22'}],
+            [submission.values for submission in first_page])
+        self.assertEquals([{'Q1': 'ans1', 'Q2': 'ans2'}], [submission.values for submission in second_page])
+        self.assertIsNone(last_continuation)
+
     def test_get_all_success_submissions_for_form(self):
         self._prepare_submissions()
 
@@ -233,7 +244,7 @@ class TestShouldSaveSMSSubmission(MangroveTestCase):
         response = self.send_sms(text)
         self.assertTrue(response.success)
         self.assertIsNotNone(response.datarecord_id)
-        expected_short_code = "dog3"
+        expected_short_code = "dog2"
         self.assertEqual(response.short_code, expected_short_code)
         b = get_by_short_code(self.manager, expected_short_code, ["dog"])
         self.assertEqual(b.short_code, expected_short_code)
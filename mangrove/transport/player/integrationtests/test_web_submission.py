@@ -169,7 +169,7 @@ class TestWEBSubmission(MangroveTestCase):
         response = self.send_request_to_web_player(text)
         self.assertTrue(response.success)
         self.assertIsNotNone(response.datarecord_id)
-        expected_short_code = "dog3"
+        expected_short_code = "dog2"
         self.assertEqual(response.short_code, expected_short_code)
         b = get_by_short_code(self.manager, expected_short_code, ["dog"])
         self.assertEqual(b.short_code, expected_short_code)
@@ -1,15 +1,19 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from collections import OrderedDict
 from copy import copy
-from mangrove.form_model.form_model import get_form_model_by_code
-from mangrove.errors.MangroveException import MangroveException, InactiveFormModelException, FormModelDoesNotExistsException
+from mangrove.datastore.entity import get_by_short_codes
+from mangrove.form_model.form_model import get_form_model_by_code, DataFormSubmission
+from mangrove.errors.MangroveException import MangroveException, InactiveFormModelException, FormModelDoesNotExistsException, DataObjectNotFound
 from mangrove.form_model.form_model import NAME_FIELD
 from mangrove.transport import reporter
 from mangrove.transport.player.parser import WebParser, SMSParserFactory, XFormParser
 from mangrove.transport.submissions import  Submission
-from mangrove.transport.facade import  ActivityReportWorkFlow, RegistrationWorkFlow, GeneralWorkFlow
-from mangrove.transport.player.handler import handler_factory
+from mangrove.transport.facade import  ActivityReportWorkFlow, RegistrationWorkFlow, GeneralWorkFlow, TransportInfo, Response, create_response_from_form_submission
+from mangrove.transport.player.handler import handler_factory, handlers, _invalidate_reporters_if_needed
 import inspect
 
+IMPORT_BATCH_SIZE = 500
+
 
 class Player(object):
     def __init__(self, dbm, location_tree=None):
@@ -154,3 +158,161 @@ class XFormPlayer(Player):
             logger.info(log_entry)
 
         return response
+
+
+class FilePlayer(Player):
+    """
+    Imports the (form_code, values) rows parsed from a CSV or XLS file and returns one Response per row.
+
+    Data submissions are validated a batch_size rows at a time, and the entities, data records and
+    submission logs of a batch are written with one bulk save each rather than with several requests
+    per row. Registration and deletion rows go through the same per-row path as the other players.
+    """
+
+    def __init__(self, dbm, parser, channel_name, location_tree=None, batch_size=IMPORT_BATCH_SIZE):
+        assert batch_size > 0
+        Player.__init__(self, dbm, location_tree)
+        self.parser = parser
+        self.channel_name = channel_name
+        self.batch_size = batch_size
+
+    def accept(self, file_contents):
+        rows = self.parser.parse(file_contents)
+        transport_info = TransportInfo(transport=self.channel_name, source=self.channel_name, destination="")
+        form_models = {}
+        responses = []
+        for start in range(0, len(rows), self.batch_size):
+            responses.extend(self._import_batch(rows[start:start + self.batch_size], transport_info, form_models))
+        return responses
+
+    def _process(self, form_code, values):
+        form_model = get_form_model_by_code(self.dbm, form_code)
+        values = GeneralWorkFlow().process(values)
+        if form_model.is_registration_form():
+            values = RegistrationWorkFlow(self.dbm, form_model, self.location_tree).process(values)
+
+        return form_model, values
+
+    def _import_row(self, transport_info, form_code, values):
+        submission = self._create_submission(transport_info, form_code, copy(values))
+        try:
+            form_model, values = self._process(form_code, values)
+            response = self.submit(form_model, values, submission, [])
+        except MangroveException as exception:
+            return _error_response(submission.uuid, exception.message, values)
+        return _with_row_errors(response, values)
+
+    def _get_form_model(self, form_models, form_code):
+        if form_code not in form_models:
+            try:
+                form_models[form_code] = get_form_model_by_code(self.dbm, form_code)
+            except FormModelDoesNotExistsException:
+                form_models[form_code] = None
+        return form_models[form_code]
+
+    def _can_import_in_bulk(self, form_model):
+        return form_model is not None and not form_model.is_registration_form() and\
+               form_model.form_code not in handlers
+
+    def _validate(self, form_model, values):
+        if form_model.is_inactive():
+            raise InactiveFormModelException(form_model.form_code)
+        form_model.bind(values)
+        cleaned_data, errors = form_model.validate_submission(values=values)
+        return DataFormSubmission(form_model, cleaned_data, errors)
+
+    def _import_batch(self, rows, transport_info, form_models):
+        responses = [None] * len(rows)
+        submissions = []
+        pending = []
+        for index, (form_code, values) in enumerate(rows):
+            form_model = self._get_form_model(form_models, form_code)
+            if not self._can_import_in_bulk(form_model):
+                responses[index] = self._import_row(transport_info, form_code, values)
+                continue
+            submission = Submission(self.dbm, transport_info, form_code, form_model.revision, copy(values))
+            try:
+                form_submission = self._validate(form_model, values)
+            except MangroveException as exception:
+                submission._set_status(False, exception.message, is_test_mode=form_model.is_in_test_mode())
+                submissions.append(submission)
+                responses[index] = _error_response(submission.uuid, exception.message, values)
+                continue
+            pending.append((index, values, submission, form_submission))
+
+        valid = [form_submission for index, values, submission, form_submission in pending
+                 if form_submission.is_valid and form_submission.short_code is not None]
+        entities = get_by_short_codes(self.dbm, set(_entity_key(form_submission) for form_submission in valid))
+        records = {}
+        for index, values, submission, form_submission in pending:
+            entity = entities.get(_entity_key(form_submission)) if form_submission.is_valid else None
+            if entity is None:
+                continue
+            records[index] = (entity, entity._new_data_record(form_submission._values,
+                form_submission._get_event_time_value(), dict(form_code=form_submission.form_code)))
+
+        updated_entities = OrderedDict((entity.id, entity) for entity, record in records.values())
+        failed_entity_ids = self._save_entities(updated_entities.values())
+        saved = []
+        for index, values, submission, form_submission in pending:
+            if index in records and records[index][0].id in failed_entity_ids:
+                responses[index] = self._import_row(transport_info, submission.form_code, values)
+                continue
+            saved.append((index, values, submission, form_submission))
+
+        record_indexes = [index for index, values, submission, form_submission in saved if index in records]
+        results = self.dbm._save_documents([records[index][1] for index in record_indexes]) if record_indexes else []
+        record_results = dict(zip(record_indexes, results))
+
+        for index, values, submission, form_submission in saved:
+            form_model = form_submission.form_model
+            submission.values[form_model.entity_question.code] = form_submission.short_code
+            submissions.append(submission)
+            if form_submission.is_valid and index not in records:
+                error = DataObjectNotFound("Entity", "Unique Identification Number (ID)", form_submission.short_code)
+                submission._set_status(False, error.message, is_test_mode=form_model.is_in_test_mode())
+                responses[index] = _error_response(submission.uuid, error.message, values)
+                continue
+            if index in record_results:
+                success, record_id, rev_or_exception = record_results[index]
+                if not success:
+                    submission._set_status(False, str(rev_or_exception), is_test_mode=form_model.is_in_test_mode())
+                    responses[index] = _error_response(submission.uuid, str(rev_or_exception), values)
+                    continue
+                form_submission.data_record_id = record_id
+            response = create_response_from_form_submission([], submission.uuid, form_submission)
+            submission._set_status(response.success, response.errors, response.datarecord_id,
+                form_model.is_in_test_mode())
+            responses[index] = _with_row_errors(response, values)
+
+        if submissions:
+            self.dbm._save_documents([submission._doc for submission in submissions])
+        return responses
+
+    def _save_entities(self, entities):
+        """
+        Saves the entities whose latest data was updated and returns the ids of those that could not be
+        saved, typically because they were changed concurrently. Their rows are then imported one by one.
+        """
+        if not entities:
+            return set()
+        results = self.dbm._save_documents([entity._doc for entity in entities])
+        for entity_type in set(tuple(entity.type_path) for entity in entities):
+            _invalidate_reporters_if_needed(self.dbm, list(entity_type))
+        return set(entity_id for success, entity_id, rev_or_exception in results if not success)
+
+
+def _entity_key(form_submission):
+    return tuple(form_submission.entity_type), form_submission.short_code
+
+
+def _error_response(submission_id, errors, values):
+    response = Response(reporters=[], submission_id=submission_id)
+    response.errors = dict(error=errors, row=values)
+    return response
+
+
+def _with_row_errors(response, values):
+    if not response.success:
+        response.errors = dict(error=response.errors.values(), row=values)
+    return response
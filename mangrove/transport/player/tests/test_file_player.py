@@ -0,0 +1,119 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from collections import OrderedDict
+from unittest.case import TestCase
+from couchdb.http import ResourceConflict
+from mock import Mock, patch
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.entity import Entity
+from mangrove.form_model.form_model import FormModel
+from mangrove.transport.facade import Channel
+from mangrove.transport.player.player import FilePlayer
+
+
+class FormSubmissionStub(object):
+    def __init__(self, form_model, short_code, errors=None):
+        self.form_model = form_model
+        self.form_code = form_model.form_code
+        self.short_code = short_code
+        self.entity_type = ['clinic']
+        self.errors = errors or OrderedDict()
+        self.is_valid = not errors
+        self.cleaned_data = OrderedDict()
+        self.is_registration = False
+        self.data_record_id = None
+        self._values = []
+
+    @property
+    def saved(self):
+        return self.data_record_id is not None
+
+    def _get_event_time_value(self):
+        return None
+
+
+def saved_documents(documents):
+    return [(True, 'record_%s' % index, 'rev') for index, document in enumerate(documents)]
+
+
+class TestFilePlayer(TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.dbm._save_documents.side_effect = saved_documents
+        self.parser = Mock()
+        self.form_model = Mock(spec=FormModel)
+        self.form_model.form_code = 'cli001'
+        self.form_model.revision = 'rev'
+        self.form_model.entity_question.code = 'eid'
+        self.form_model.is_inactive.return_value = False
+        self.form_model.is_registration_form.return_value = False
+        self.form_model.is_in_test_mode.return_value = False
+        self.entity = Mock(spec=Entity)
+        self.entity.id = 'entity_1'
+        self.entity.type_path = ['clinic']
+        self.entity._doc = Mock()
+
+        self.patchers = [patch('mangrove.transport.player.player.get_form_model_by_code'),
+                         patch('mangrove.transport.player.player.get_by_short_codes'),
+                         patch('mangrove.transport.player.player.DataFormSubmission')]
+        get_form_model, get_by_short_codes, data_form_submission = [patcher.start() for patcher in self.patchers]
+        get_form_model.return_value = self.form_model
+        get_by_short_codes.return_value = {(('clinic',), 'cli1'): self.entity}
+        data_form_submission.side_effect = self._form_submission
+        self.get_by_short_codes = get_by_short_codes
+        self.player = FilePlayer(self.dbm, self.parser, Channel.CSV, batch_size=2)
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def _form_submission(self, form_model, cleaned_data, errors):
+        return FormSubmissionStub(form_model, self._short_codes.pop(0), errors)
+
+    def _accept(self, short_codes, validation_errors=None):
+        self._short_codes = list(short_codes)
+        self.form_model.validate_submission.return_value = OrderedDict(), validation_errors or OrderedDict()
+        self.parser.parse.return_value = [('cli001', {'eid': short_code}) for short_code in short_codes]
+        return self.player.accept('file contents')
+
+    def test_should_write_each_batch_with_bulk_saves(self):
+        responses = self._accept(['cli1', 'cli1', 'cli1'])
+
+        self.assertEqual(3, len(responses))
+        self.assertTrue(all(response.success for response in responses))
+        self.assertEqual(2, self.get_by_short_codes.call_count)
+        self.assertEqual(6, self.dbm._save_documents.call_count)
+        self.assertFalse(self.dbm._save_document.called)
+        self.assertEqual(3, self.entity._new_data_record.call_count)
+
+    def test_should_report_rows_for_unknown_entities(self):
+        responses = self._accept(['cli2'])
+
+        self.assertFalse(responses[0].success)
+        self.assertEqual({'eid': 'cli2'}, responses[0].errors['row'])
+        submission_docs = self.dbm._save_documents.call_args[0][0]
+        self.assertFalse(submission_docs[0].status)
+
+    def test_should_report_validation_errors_with_row(self):
+        responses = self._accept(['cli1'], OrderedDict(q2='invalid'))
+
+        self.assertFalse(responses[0].success)
+        self.assertEqual(['invalid'], responses[0].errors['error'])
+        self.assertFalse(self.entity._new_data_record.called)
+
+    def test_should_import_row_by_row_when_entity_save_conflicts(self):
+        self.dbm._save_documents.side_effect = [[(False, 'entity_1', ResourceConflict())], [(True, 's', 'rev')]]
+        with patch.object(FilePlayer, '_import_row') as import_row:
+            import_row.return_value = 'row response'
+            responses = self._accept(['cli1'])
+
+        self.assertEqual(['row response'], responses)
+
+    def test_should_import_registration_rows_one_by_one(self):
+        self.form_model.is_registration_form.return_value = True
+        with patch.object(FilePlayer, 'submit') as submit:
+            submit.return_value.success = True
+            responses = self._accept(['cli1'])
+
+        self.assertTrue(responses[0].success)
+        self.assertTrue(self.dbm._save_document.called)
+        self.assertFalse(self.entity._new_data_record.called)
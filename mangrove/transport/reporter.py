@@ -1,12 +1,47 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
-from mangrove.datastore.entity import Entity, get_all_entities
-from mangrove.datastore.queries import get_entities_by_type
+import copy
+from threading import Lock
+from mangrove.datastore.entity import Entity
 
 from mangrove.errors.MangroveException import NumberNotRegisteredException, MultipleReportersForANumberException
 from mangrove.form_model.form_model import MOBILE_NUMBER_FIELD, NAME_FIELD
 from mangrove.transport.submissions import  get_submissions_for_activity_period
+from mangrove.utils.cache import LRUCache
+from mangrove.utils.types import is_string, is_sequence
 
 REPORTER_ENTITY_TYPE = ["reporter"]
+REPORTERS_BY_MOBILE_NUMBER_VIEW = "reporters_by_mobile_number"
+
+_reporter_caches = {}
+_reporter_caches_lock = Lock()
+
+
+def enable_reporter_cache(dbm, max_size=10000):
+    """
+    Keep the reporter documents looked up by mobile number in memory for this dbm.
+    The cache is cleared by invalidate_reporter_cache whenever reporters are registered, edited or deleted.
+    """
+    with _reporter_caches_lock:
+        if dbm not in _reporter_caches:
+            _reporter_caches[dbm] = LRUCache(max_size)
+        return _reporter_caches[dbm]
+
+
+def disable_reporter_cache(dbm):
+    with _reporter_caches_lock:
+        _reporter_caches.pop(dbm, None)
+
+
+def invalidate_reporter_cache(dbm):
+    cache = _reporter_caches.get(dbm)
+    if cache is not None:
+        cache.clear()
+
+
+def is_reporter_type(entity_type):
+    if is_string(entity_type):
+        entity_type = [entity_type]
+    return is_sequence(entity_type) and [e_type.lower() for e_type in entity_type] == REPORTER_ENTITY_TYPE
 
 
 def find_reporter(dbm, from_number):
@@ -22,21 +57,33 @@ def find_reporter_entity(dbm, from_number):
 
 
 def find_reporters_by_from_number(dbm, from_number):
-    reporters = get_all_entities(dbm, entity_type=REPORTER_ENTITY_TYPE)
+    reporter_docs = _load_reporter_docs(dbm, from_number)
+    if not len(reporter_docs):
+        raise NumberNotRegisteredException(from_number)
+    return [_to_entity(dbm, doc) for doc in reporter_docs]
 
-    def is_mobilenumber_same(reporter): return reporter.value(MOBILE_NUMBER_FIELD) == from_number
 
+def get_reporters_who_submitted_data_for_frequency_period(dbm, form_code, from_time=None, to_time=None):
+    submissions = get_submissions_for_activity_period(dbm, form_code, from_time, to_time)
+    source_mobile_numbers = list(set([submission.source for submission in submissions]))
+    if not len(source_mobile_numbers):
+        return []
+    rows = dbm.load_all_rows_in_view(REPORTERS_BY_MOBILE_NUMBER_VIEW, keys=source_mobile_numbers, include_docs=True)
+    return [_to_entity(dbm, row['doc']) for row in rows]
 
-    from_reporter_list = filter(is_mobilenumber_same, reporters)
 
-    if not len(from_reporter_list):
-        raise NumberNotRegisteredException(from_number)
-    return from_reporter_list
+def _load_reporter_docs(dbm, from_number):
+    cache = _reporter_caches.get(dbm)
+    if cache is not None:
+        docs = cache.get(from_number)
+        if docs is not None:
+            return copy.deepcopy(docs)
+    rows = dbm.load_all_rows_in_view(REPORTERS_BY_MOBILE_NUMBER_VIEW, key=from_number, include_docs=True)
+    docs = [row['doc'] for row in rows]
+    if cache is not None and len(docs):
+        cache.put(from_number, copy.deepcopy(docs))
+    return docs
 
 
-def get_reporters_who_submitted_data_for_frequency_period(dbm, form_code, from_time=None, to_time=None):
-    submissions = get_submissions_for_activity_period(dbm, form_code, from_time, to_time)
-    source_mobile_numbers = set([submission.source for submission in submissions])
-    all_reporters = get_entities_by_type(dbm, 'reporter')
-    reporters = [reporter for reporter in all_reporters if reporter.value(MOBILE_NUMBER_FIELD) in source_mobile_numbers]
-    return reporters
+def _to_entity(dbm, doc):
+    return Entity.new_from_doc(dbm, Entity.__document_class__.wrap(doc))
@@ -17,20 +17,38 @@ def submission_count(dbm, form_code, from_time, to_time, view_name="submissionlo
 
 
 def get_submissions(dbm, form_code, from_time, to_time, page_number=0, page_size=None, view_name="submissionlog"):
-    startkey, endkey = _get_start_and_end_key(form_code, from_time, to_time)
     if page_size is None:
-        rows = dbm.load_all_rows_in_view(view_name, reduce=False, descending=True,
-            startkey=startkey,
-            endkey=endkey)
-    else:
-        rows = dbm.load_all_rows_in_view(view_name, reduce=False, descending=True,
-            startkey=startkey,
-            endkey=endkey, skip=page_number * page_size, limit=page_size)
-    submissions = [Submission.new_from_doc(dbm=dbm, doc=Submission.__document_class__.wrap(row['value'])) for row in
-                   rows]
+        return list(iter_submissions(dbm, form_code, from_time, to_time, view_name=view_name))
+    startkey, endkey = _get_start_and_end_key(form_code, from_time, to_time)
+    rows = dbm.load_all_rows_in_view(view_name, reduce=False, descending=True,
+        startkey=startkey,
+        endkey=endkey, skip=page_number * page_size, limit=page_size)
+    submissions = [_to_submission(dbm, row) for row in rows]
     return submissions
 
 
+def get_submissions_page(dbm, form_code, from_time, to_time, page_size, continuation=None,
+                         view_name="submissionlog"):
+    """
+    Returns (submissions, continuation) for one page of the submission log, latest first.
+    Pass the returned continuation back to get the following page; it is None after the last page.
+    """
+    startkey, endkey = _get_start_and_end_key(form_code, from_time, to_time)
+    rows, next_continuation = dbm.load_view_page(view_name, page_size, continuation, reduce=False, descending=True,
+        startkey=startkey, endkey=endkey)
+    return [_to_submission(dbm, row) for row in rows], next_continuation
+
+
+def iter_submissions(dbm, form_code, from_time, to_time, view_name="submissionlog"):
+    """
+    Yields the submissions of a form, latest first, without loading the whole submission log at once.
+    """
+    startkey, endkey = _get_start_and_end_key(form_code, from_time, to_time)
+    rows = dbm.iter_view_rows(view_name, reduce=False, descending=True, startkey=startkey, endkey=endkey)
+    for row in rows:
+        yield _to_submission(dbm, row)
+
+
 def submissions_by_form_code(dbm, form_code):
     return get_submissions(dbm, form_code, None, None)
 
@@ -134,11 +152,14 @@ class Submission(DataObject):
         super(Submission, self).delete()
 
     def update(self, status, errors, data_record_id=None, is_test_mode=False):
+        self._set_status(status, errors, data_record_id, is_test_mode)
+        self.save()
+
+    def _set_status(self, status, errors, data_record_id=None, is_test_mode=False):
         self._doc.status = status
         self._doc.data_record_id = data_record_id
         self._doc.error_message = self._to_string(errors)
         self._doc.test = is_test_mode
-        self.save()
 
     def _to_string(self, errors):
         if is_string(errors):
@@ -150,6 +171,10 @@ class Submission(DataObject):
         return None
 
 
+def _to_submission(dbm, row):
+    return Submission.new_from_doc(dbm=dbm, doc=Submission.__document_class__.wrap(row['value']))
+
+
 def _get_start_and_end_key(form_code, from_time, to_time):
     end = [form_code] if from_time is None else [form_code, from_time]
     start = [form_code, {}] if to_time is None else [form_code, to_time]
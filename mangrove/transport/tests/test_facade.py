@@ -53,11 +53,11 @@ class TestRegistrationWorkFlow(unittest.TestCase):
         self.dbm = Mock(spec=DatabaseManager)
         self.form_model_mock = Mock(spec=FormModel)
         self.form_model_mock.get_field_by_name = self._location_field
-        self.get_entity_count = patch('mangrove.transport.facade.get_entity_count_for_type', new=dummy_get_entity_count_for_type,spec=True)
-        self.get_entity_count.start()
+        self.next_short_code_number = patch('mangrove.transport.facade.next_short_code_number', new=dummy_next_short_code_number,spec=True)
+        self.next_short_code_number.start()
 
     def tearDown(self):
-        self.get_entity_count.stop()
+        self.next_short_code_number.stop()
 
     def test_should_generate_default_code_if_short_code_is_empty(self):
         registration_work_flow = RegistrationWorkFlow(self.dbm, self.form_model_mock, DummyLocationTree())
@@ -91,8 +91,8 @@ class TestRegistrationWorkFlow(unittest.TestCase):
         return geo_code_field
 
 
-def dummy_get_entity_count_for_type(dbm, entity_type):
-    return 0
+def dummy_next_short_code_number(dbm, entity_type):
+    return 1
 
 def dummy_get_location_hierarchy(foo):
     return [u'arantany']
@@ -0,0 +1,52 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from unittest import TestCase
+from mock import Mock
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.documents import EntityDocument
+from mangrove.errors.MangroveException import NumberNotRegisteredException
+from mangrove.transport.reporter import find_reporters_by_from_number, enable_reporter_cache, disable_reporter_cache, invalidate_reporter_cache, REPORTERS_BY_MOBILE_NUMBER_VIEW, is_reporter_type
+
+
+class TestReporterLookup(TestCase):
+    def setUp(self):
+        self.dbm = Mock(spec=DatabaseManager)
+        self.reporter_doc = EntityDocument(short_code='rep1').unwrap()
+        self.dbm.load_all_rows_in_view.return_value = [{'doc': self.reporter_doc}]
+
+    def tearDown(self):
+        disable_reporter_cache(self.dbm)
+
+    def test_should_lookup_reporters_by_mobile_number_key(self):
+        reporters = find_reporters_by_from_number(self.dbm, '1234')
+        self.assertEqual(['rep1'], [reporter.short_code for reporter in reporters])
+        self.dbm.load_all_rows_in_view.assert_called_once_with(REPORTERS_BY_MOBILE_NUMBER_VIEW, key='1234',
+            include_docs=True)
+
+    def test_should_raise_exception_if_number_is_not_registered(self):
+        self.dbm.load_all_rows_in_view.return_value = []
+        self.assertRaises(NumberNotRegisteredException, find_reporters_by_from_number, self.dbm, '1234')
+
+    def test_should_serve_repeated_lookups_from_cache_when_enabled(self):
+        enable_reporter_cache(self.dbm)
+        find_reporters_by_from_number(self.dbm, '1234')
+        reporters = find_reporters_by_from_number(self.dbm, '1234')
+        self.assertEqual('rep1', reporters[0].short_code)
+        self.assertEqual(1, self.dbm.load_all_rows_in_view.call_count)
+
+    def test_should_reload_reporters_after_cache_is_invalidated(self):
+        enable_reporter_cache(self.dbm)
+        find_reporters_by_from_number(self.dbm, '1234')
+        invalidate_reporter_cache(self.dbm)
+        find_reporters_by_from_number(self.dbm, '1234')
+        self.assertEqual(2, self.dbm.load_all_rows_in_view.call_count)
+
+    def test_should_not_share_cached_documents_with_callers(self):
+        enable_reporter_cache(self.dbm)
+        find_reporters_by_from_number(self.dbm, '1234')[0]._doc.short_code = 'changed'
+        self.assertEqual('rep1', find_reporters_by_from_number(self.dbm, '1234')[0].short_code)
+
+    def test_should_identify_reporter_entity_type(self):
+        self.assertTrue(is_reporter_type('Reporter'))
+        self.assertTrue(is_reporter_type(['reporter']))
+        self.assertFalse(is_reporter_type(['clinic']))
+        self.assertFalse(is_reporter_type(None))
@@ -0,0 +1,74 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from collections import OrderedDict
+from threading import Lock
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    A small thread safe, size bound, least-recently-used cache.
+
+    Keeps hit and miss counters so that callers can tell how effective
+    the cache is.
+    """
+
+    def __init__(self, max_size=1000):
+        assert max_size > 0
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None, is_valid=None):
+        """
+        Return the cached value for key, or default.
+
+        is_valid is an optional callable that is given the cached value; when it
+        returns False the entry is dropped and the lookup counts as a miss. It is
+        called without holding the cache lock, so it may do I/O.
+        """
+        with self._lock:
+            value = self._entries.pop(key, _missing)
+            if value is not _missing:
+                self._entries[key] = value
+        if value is not _missing and (is_valid is None or is_valid(value)):
+            with self._lock:
+                self.hits += 1
+            return value
+        with self._lock:
+            self.misses += 1
+            if value is not _missing and self._entries.get(key) is value:
+                del self._entries[key]
+        return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def items(self):
+        """Returns a snapshot of the (key, value) pairs, least recently used first."""
+        with self._lock:
+            return self._entries.items()
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._entries), max_size=self.max_size)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
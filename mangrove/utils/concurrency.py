@@ -0,0 +1,46 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import sys
+from Queue import Queue, Empty
+from threading import Thread
+
+MAX_THREADS = 8
+
+
+def run_concurrently(functions, max_threads=MAX_THREADS):
+    """
+    Calls each of functions with no arguments, in at most max_threads threads, and returns their
+    results in the same order. If any call raises, the first exception in that order is re-raised
+    once all the calls have finished.
+    """
+    assert max_threads > 0
+    functions = list(functions)
+    if len(functions) <= 1:
+        return [function() for function in functions]
+
+    pending = Queue()
+    for index, function in enumerate(functions):
+        pending.put((index, function))
+    results = [None] * len(functions)
+    errors = [None] * len(functions)
+
+    def _work():
+        while True:
+            try:
+                index, function = pending.get_nowait()
+            except Empty:
+                return
+            try:
+                results[index] = function()
+            except Exception:
+                errors[index] = sys.exc_info()
+
+    threads = [Thread(target=_work) for i in range(min(max_threads, len(functions)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
@@ -1,7 +1,8 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 from calendar import timegm
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from math import ceil
 import iso8601
 import pytz
 import time
@@ -78,3 +79,14 @@ def convert_date_time_to_epoch(date_time, tzinfo=None):
         return int(time.mktime(date_time.timetuple())) * 1000 + date_time.microsecond / 1000
     else:
         return int(timegm(date_time.astimezone(pytz.UTC).timetuple())) * 1000 + date_time.microsecond / 1000
+
+
+def week_of_year(date_time):
+    """
+    The week number the weekly views give a UTC datetime: weeks start on Monday and week 1 holds
+    January 4th, counted within the calendar year of the date.
+    """
+    target = date_time + timedelta(days=3 - date_time.weekday())
+    jan4 = datetime(target.year, 1, 4, tzinfo=pytz.UTC)
+    day_difference = (target - jan4).total_seconds() / 86400.0
+    return 1 + int(ceil(day_difference / 7))
@@ -0,0 +1,196 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Mergeable sketches: a HyperLogLog for distinct counts and a t-digest for quantiles.
+
+Both can be built in pieces, per entity or per period, merged later and stored as JSON,
+so combined results never need the raw values again.
+"""
+from base64 import b64decode, b64encode
+from bisect import bisect_left
+from hashlib import sha1
+from math import ceil, log
+import json
+from mangrove.utils.types import is_string
+
+DEFAULT_DISTINCT_ERROR = 0.02
+DEFAULT_QUANTILE_ERROR = 0.01
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+MIN_COMPRESSION = 20
+BUFFER_FACTOR = 5
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values added, with a relative standard error of about error.
+    Small counts, up to a few hundred for the default error, are practically exact.
+    """
+
+    def __init__(self, error=DEFAULT_DISTINCT_ERROR, precision=None):
+        if precision is None:
+            assert 0 < error < 1
+            precision = int(ceil(log((1.04 / error) ** 2, 2)))
+        self.precision = min(MAX_PRECISION, max(MIN_PRECISION, precision))
+        self.registers = {}
+
+    @property
+    def size(self):
+        return 1 << self.precision
+
+    def add(self, value):
+        hashed = int(sha1(_canonical(value)).hexdigest()[:16], 16)
+        remaining_bits = 64 - self.precision
+        index = hashed >> remaining_bits
+        rank = remaining_bits - (hashed & ((1 << remaining_bits) - 1)).bit_length() + 1
+        if rank > self.registers.get(index, 0):
+            self.registers[index] = rank
+
+    def merge(self, other):
+        assert self.precision == other.precision, "Only sketches of the same precision can be merged"
+        for index, rank in other.registers.items():
+            if rank > self.registers.get(index, 0):
+                self.registers[index] = rank
+        return self
+
+    def count(self):
+        size = self.size
+        zeros = size - len(self.registers)
+        harmonic = zeros + sum(2.0 ** -rank for rank in self.registers.values())
+        estimate = _alpha(size) * size * size / harmonic
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * log(float(size) / zeros)
+        return int(round(estimate))
+
+    def to_json(self):
+        if len(self.registers) * 8 < self.size:
+            return dict(precision=self.precision, sparse=sorted(self.registers.items()))
+        registers = bytearray(self.size)
+        for index, rank in self.registers.items():
+            registers[index] = rank
+        return dict(precision=self.precision, registers=b64encode(str(registers)))
+
+    @classmethod
+    def from_json(cls, data):
+        sketch = cls(precision=data['precision'])
+        if 'sparse' in data:
+            sketch.registers = dict((index, rank) for index, rank in data['sparse'])
+        else:
+            registers = bytearray(b64decode(data['registers']))
+            sketch.registers = dict((index, rank) for index, rank in enumerate(registers) if rank)
+        return sketch
+
+
+class TDigest(object):
+    """
+    Estimates quantiles of the numbers added. Centroids stay small at the tails, so extreme quantiles
+    are the most accurate; fewer values than the compression are kept individually and give exact
+    results. Quantiles are interpolated between the centres of the values.
+    """
+
+    def __init__(self, error=DEFAULT_QUANTILE_ERROR, compression=None):
+        if compression is None:
+            assert 0 < error < 1
+            compression = int(ceil(1.0 / error))
+        self.compression = max(MIN_COMPRESSION, compression)
+        self.means = []
+        self.weights = []
+        self.min = None
+        self.max = None
+        self._buffer = []
+
+    @property
+    def count(self):
+        return sum(self.weights) + sum(weight for mean, weight in self._buffer)
+
+    def add(self, value, weight=1):
+        self._buffer.append((value, weight))
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) > BUFFER_FACTOR * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        if other.min is None:
+            return self
+        self._buffer.extend(zip(other.means, other.weights))
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        assert 0 <= q <= 1
+        self._compress()
+        if not self.means:
+            return None
+        total = float(sum(self.weights))
+        positions, values = [0.0], [self.min]
+        cumulative = 0.0
+        for mean, weight in zip(self.means, self.weights):
+            positions.append(cumulative + weight / 2.0)
+            values.append(mean)
+            cumulative += weight
+        positions.append(total)
+        values.append(self.max)
+
+        target = q * total
+        index = bisect_left(positions, target)
+        if index == 0:
+            return values[0]
+        start, end = positions[index - 1], positions[index]
+        if end == start:
+            return values[index]
+        return values[index - 1] + (values[index] - values[index - 1]) * (target - start) / (end - start)
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        centroids = sorted(zip(self.means, self.weights) + self._buffer)
+        self._buffer = []
+        total = float(sum(weight for mean, weight in centroids))
+        means, weights = [], []
+        cumulative = 0.0
+        for mean, weight in centroids:
+            if means:
+                merged = weights[-1] + weight
+                q = (cumulative + merged / 2.0) / total
+                if merged <= 4 * total * q * (1 - q) / self.compression:
+                    means[-1] += (mean - means[-1]) * float(weight) / merged
+                    weights[-1] = merged
+                    continue
+                cumulative += weights[-1]
+            means.append(mean)
+            weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def to_json(self):
+        self._compress()
+        return dict(compression=self.compression, means=self.means, weights=self.weights, min=self.min,
+                    max=self.max)
+
+    @classmethod
+    def from_json(cls, data):
+        digest = cls(compression=data['compression'])
+        digest.means, digest.weights = list(data['means']), list(data['weights'])
+        digest.min, digest.max = data['min'], data['max']
+        return digest
+
+
+def _alpha(size):
+    if size <= 16:
+        return 0.673
+    if size <= 32:
+        return 0.697
+    if size <= 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / size)
+
+
+def _canonical(value):
+    """The same bytes for equal values, whether str or unicode and in whatever process."""
+    if is_string(value):
+        return "s" + (value.encode('utf-8') if isinstance(value, unicode) else value)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value, sort_keys=True, default=str)
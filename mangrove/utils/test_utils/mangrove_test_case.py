@@ -1,15 +1,16 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import os
 import unittest
 from mangrove.bootstrap import initializer
 from mangrove.datastore.database import get_db_manager, _delete_db_and_remove_db_manager
 
+# set MANGROVE_TEST_SERVER=memory:// to run these tests without a CouchDB server
+TEST_SERVER = os.environ.get('MANGROVE_TEST_SERVER', 'http://localhost:5984/')
+
 class MangroveTestCase(unittest.TestCase):
     def setUp(self):
-        self.manager = get_db_manager('http://localhost:5984/', 'mangrove-test')
+        self.manager = get_db_manager(TEST_SERVER, 'mangrove-test')
         initializer._create_views(self.manager)
 
     def tearDown(self):
         _delete_db_and_remove_db_manager(self.manager)
-
-
-  
\ No newline at end of file
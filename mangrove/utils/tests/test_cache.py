@@ -0,0 +1,39 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from unittest import TestCase
+from mangrove.utils.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_should_return_cached_value_and_count_hits_and_misses(self):
+        cache = LRUCache(max_size=2)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(dict(hits=1, misses=1, size=1, max_size=2), cache.stats())
+
+    def test_should_evict_least_recently_used_entry(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+    def test_should_invalidate_and_clear(self):
+        cache = LRUCache()
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.invalidate('a')
+        self.assertFalse('a' in cache)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+    def test_should_drop_entry_that_is_no_longer_valid(self):
+        cache = LRUCache()
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a', is_valid=lambda value: value > 1))
+        self.assertFalse('a' in cache)
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(1, cache.misses)
@@ -0,0 +1,35 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import threading
+import unittest
+from mangrove.utils.concurrency import run_concurrently
+
+
+class TestRunConcurrently(unittest.TestCase):
+    def test_should_return_results_in_order(self):
+        functions = [lambda i=i: i * i for i in range(20)]
+
+        self.assertEqual([i * i for i in range(20)], run_concurrently(functions, max_threads=4))
+
+    def test_should_run_calls_in_parallel(self):
+        started = threading.Event()
+
+        def _wait():
+            return started.wait(5) or started.is_set()
+
+        self.assertEqual([True, None], run_concurrently([_wait, started.set]))
+
+    def test_should_reraise_the_first_exception_after_all_calls(self):
+        calls = []
+        first = ValueError("first")
+
+        def _fail(error):
+            def _call():
+                raise error
+            return _call
+
+        try:
+            run_concurrently([_fail(first), _fail(KeyError("second")), lambda: calls.append(1)], max_threads=1)
+            self.fail("should have raised")
+        except ValueError as error:
+            self.assertIs(first, error)
+        self.assertEqual([1], calls)
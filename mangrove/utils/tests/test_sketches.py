@@ -0,0 +1,62 @@
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import json
+import random
+import unittest
+from mangrove.utils.sketches import HyperLogLog, TDigest
+
+
+class TestHyperLogLog(unittest.TestCase):
+    def test_should_count_small_sets_exactly(self):
+        sketch = HyperLogLog()
+        for value in ["rep1", u"rep1", "rep2", 3, 3.0, None, "rep2"]:
+            sketch.add(value)
+
+        self.assertEqual(4, sketch.count())
+
+    def test_should_estimate_large_sets_within_the_error(self):
+        sketch = HyperLogLog(error=0.02)
+        for i in range(50000):
+            sketch.add("entity%d" % i)
+
+        self.assertAlmostEqual(50000, sketch.count(), delta=50000 * 0.06)
+
+    def test_should_merge_and_survive_json(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(3000):
+            (first if i % 2 else second).add(i % 2000)
+        merged = HyperLogLog.from_json(json.loads(json.dumps(first.to_json()))).merge(second)
+
+        self.assertAlmostEqual(2000, merged.count(), delta=2000 * 0.06)
+        self.assertEqual(merged.registers, HyperLogLog.from_json(merged.to_json()).registers)
+
+
+class TestTDigest(unittest.TestCase):
+    def test_should_be_exact_for_few_values(self):
+        digest = TDigest()
+        for value in [4, 1, 3, 2]:
+            digest.add(value)
+
+        self.assertEqual(2.5, digest.quantile(0.5))
+        self.assertEqual(1, digest.quantile(0))
+        self.assertEqual(4, digest.quantile(1))
+
+    def test_should_estimate_quantiles_of_many_values(self):
+        values = range(100000)
+        random.Random(1).shuffle(values)
+        digest = TDigest(error=0.01)
+        for value in values:
+            digest.add(value)
+
+        self.assertTrue(len(digest.means) < 1000)
+        for q in [0.01, 0.5, 0.9, 0.99]:
+            self.assertAlmostEqual(q * 100000, digest.quantile(q), delta=100000 * 0.01)
+
+    def test_should_merge_digests_and_survive_json(self):
+        first, second = TDigest(), TDigest()
+        for value in range(1000):
+            (first if value < 500 else second).add(value)
+        merged = TDigest.from_json(json.loads(json.dumps(first.to_json()))).merge(second)
+
+        self.assertEqual(1000, merged.count)
+        self.assertAlmostEqual(900, merged.quantile(0.9), delta=10)
+        self.assertEqual(None, TDigest().quantile(0.5))